@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the rsync executable.
+
+Use it as ``rsync_exe`` of ``RsyncBackup`` to benchmark the parsing and
+indexing code paths without any file system I/O.
+
+    :RHB_FAKE_RSYNC_REPLAY:
+        path of a recorded itemize output, e.g. a ``*.dryrun`` file from a
+        backup log folder. It is printed for every ``--dry-run`` call.
+
+    :RHB_FAKE_RSYNC_ENTRIES:
+        number of synthetic itemize lines printed for ``--dry-run`` calls
+        if no replay file is set (default 100000).
+
+All other calls only print rsync's ``--stats`` summary and exit.
+"""
+
+import os
+import sys
+
+
+def synthetic(count):
+    """Yield ``count`` itemize lines: 80% created, 10% changed and 10%
+    deleted files in directories of 1000 files."""
+    for i in range(count):
+        path = 'dir{}/file{}.txt'.format(i // 1000, i)
+        if i % 1000 == 0:
+            yield 'cd+++++++++|dir{}/|\n'.format(i // 1000)
+        if i % 10 == 1:
+            yield '>f.st......|{}|\n'.format(path)
+        elif i % 10 == 2:
+            yield '*deleting  |{}|\n'.format(path)
+        else:
+            yield '>f+++++++++|{}|\n'.format(path)
+
+
+def main(argv):
+    out = sys.stdout
+    if '--dry-run' in argv:
+        replay = os.environ.get('RHB_FAKE_RSYNC_REPLAY')
+        if replay:
+            with open(replay, 'r') as fl:
+                for line in fl:
+                    out.write(line)
+        else:
+            count = int(os.environ.get('RHB_FAKE_RSYNC_ENTRIES', 100000))
+            out.writelines(synthetic(count))
+    if '--stats' in argv:
+        out.write('\nNumber of files: 0\nTotal transferred file size: 0 ' +
+                  'bytes\n\nsent 0 bytes  received 0 bytes  0.00 bytes/sec\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
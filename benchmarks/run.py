@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness for ``RsyncBackup`` and ``BackupInfo``.
+
+    python3 benchmarks/run.py all
+    python3 benchmarks/run.py parse --entries 10000000
+    python3 benchmarks/run.py tree --profile deep --churn 0.05
+    python3 benchmarks/run.py engine --profile small
+
+``parse`` and ``versions`` only need python, ``tree`` runs real backups and
+is skipped if rsync is not installed. ``engine`` compares rsync with the
+native engine on the same tree.
+"""
+
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from time import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rsync_history_backup.basic import RsyncBackup  # noqa: E402
+from rsync_history_backup.analyzer import BackupInfo  # noqa: E402
+from rsync_history_backup.report import RunReport  # noqa: E402
+import synthetic  # noqa: E402
+
+FAKE_RSYNC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fake_rsync.py')
+
+
+class Timer:
+    """Collects named timings."""
+
+    def __init__(self, benchmark):
+        self.benchmark = benchmark
+        self.results = []
+
+    def __call__(self, name, func, *args, **kwargs):
+        start = time()
+        res = func(*args, **kwargs)
+        seconds = time() - start
+        self.results.append({'benchmark': self.benchmark, 'step': name,
+                             'seconds': round(seconds, 4),
+                             'peak_rss': RunReport.peak_rss()})
+        print("{:<10} {:<36} {:>10.3f}s".format(self.benchmark, name,
+                                                 seconds))
+        return res
+
+
+def bench_parse(args, tmp):
+    """Parse and index ``--entries`` itemize lines of the fake rsync."""
+    timer = Timer('parse')
+    os.environ['RHB_FAKE_RSYNC_ENTRIES'] = str(args.entries)
+    if args.replay:
+        os.environ['RHB_FAKE_RSYNC_REPLAY'] = os.path.abspath(args.replay)
+    src, dst = os.path.join(tmp, 'src'), os.path.join(tmp, 'dst')
+    os.makedirs(src)
+    os.makedirs(dst)
+    rhb = RsyncBackup(src, dst, name='bench', rsync_exe=FAKE_RSYNC)
+    change_log = timer('dry_run ({} entries)'.format(args.entries),
+                       rhb.dry_run)
+    timer('save_file_logs + index', rhb._save_file_logs, change_log)
+    return timer.results
+
+
+def bench_versions(args, tmp):
+    """Look up file versions in ``--snapshots`` history snapshots."""
+    timer = Timer('versions')
+    info_dir = os.path.join(tmp, 'dst')
+    history = os.path.join(info_dir, 'history', 'bench')
+    files = ['dir{}/file{}.txt'.format(i % 50, i)
+             for i in range(args.files)]
+    for s in range(args.snapshots):
+        # one run per second
+        time_stamp = (datetime(2000, 1, 1) + timedelta(seconds=s)).strftime(
+            RsyncBackup.time_format)
+        snapshot = os.path.join(history, time_stamp)
+        for path in files[s % 10::10]:
+            os.makedirs(os.path.dirname(os.path.join(snapshot, path)),
+                        exist_ok=True)
+            open(os.path.join(snapshot, path), 'w').close()
+    info = BackupInfo(info_dir, 'bench')
+    query = files[:args.queries]
+    timer('scan ({} files x {} snapshots)'.format(
+        len(query), args.snapshots), info.get_files_versions, query)
+    timer('reindex', info.reindex)
+    timer('index ({} files)'.format(len(query)),
+          info.get_files_versions, query)
+    return timer.results
+
+
+def bench_tree(args, tmp):
+    """Run real backups of a synthetic tree before and after a churn."""
+    timer = Timer('tree')
+    if not shutil.which(args.rsync):
+        print("tree: rsync not found, skipped.")
+        return timer.results
+    src, dst = os.path.join(tmp, 'src'), os.path.join(tmp, 'dst')
+    os.makedirs(dst)
+    files = timer('generate ({})'.format(args.profile), synthetic.generate,
+                  src, args.profile, args.files_per_tree)
+    rhb = RsyncBackup(src, dst, name='bench', rsync_exe=args.rsync)
+    timer('run_backup (initial)', rhb.run_backup)
+    synthetic.churn(src, files, args.churn)
+    rhb = RsyncBackup(src, dst, name='bench', rsync_exe=args.rsync)
+    timer('dry_run (churn {})'.format(args.churn),
+          lambda: rhb.dry_run() and rhb.change_log.discard())
+    timer('run_backup (churn {})'.format(args.churn), rhb.run_backup)
+    return timer.results
+
+
+def bench_engine(args, tmp):
+    """Back up the same synthetic tree with rsync and the native engine."""
+    timer = Timer('engine')
+    src = os.path.join(tmp, 'src')
+    files = timer('generate ({})'.format(args.profile), synthetic.generate,
+                  src, args.profile, args.files_per_tree)
+    engines = ['native']
+    if shutil.which(args.rsync):
+        engines.insert(0, 'rsync')
+    else:
+        print("engine: rsync not found, only the native engine is run.")
+    initial = os.path.join(tmp, 'initial')
+    shutil.copytree(src, initial, symlinks=True)
+    for engine in engines:
+        if engine != engines[0]:
+            shutil.rmtree(src)
+            shutil.copytree(initial, src, symlinks=True)
+        dst = os.path.join(tmp, 'dst-' + engine)
+        os.makedirs(dst)
+        rhb = RsyncBackup(src, dst, name='bench', rsync_exe=args.rsync,
+                          engine=engine)
+        timer('{}: run_backup (initial)'.format(engine), rhb.run_backup)
+        synthetic.churn(src, files, args.churn)
+        rhb = RsyncBackup(src, dst, name='bench', rsync_exe=args.rsync,
+                          engine=engine)
+        timer('{}: dry_run (churn {})'.format(engine, args.churn),
+              lambda: rhb.dry_run() and rhb.change_log.discard())
+        timer('{}: run_backup (churn {})'.format(engine, args.churn),
+              rhb.run_backup)
+    return timer.results
+
+
+BENCHMARKS = {'parse': bench_parse, 'versions': bench_versions,
+              'tree': bench_tree, 'engine': bench_engine}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ['all'],
+                        nargs='?', default='all')
+    parser.add_argument("--entries", type=int, default=1000000,
+                        help="itemize lines for 'parse'.")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="recorded itemize output (*.dryrun) for 'parse'.")
+    parser.add_argument("--snapshots", type=int, default=200,
+                        help="history snapshots for 'versions'.")
+    parser.add_argument("--files", type=int, default=20000,
+                        help="files in the history for 'versions'.")
+    parser.add_argument("--queries", type=int, default=1000,
+                        help="files looked up in 'versions'.")
+    parser.add_argument("--profile", choices=sorted(synthetic.PROFILES),
+                        default='small',
+                        help="source tree for 'tree' and 'engine'.")
+    parser.add_argument("--files-per-tree", type=int, default=None,
+                        help="override the file count of the profile.")
+    parser.add_argument("--churn", type=float, default=0.01,
+                        help="fraction of files changed between runs.")
+    parser.add_argument("--rsync", default='rsync', help="rsync executable.")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as json.")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose
+                        else logging.WARNING)
+
+    names = sorted(BENCHMARKS) if args.benchmark == 'all' \
+        else [args.benchmark]
+    results = []
+    for name in names:
+        tmp = tempfile.mkdtemp(prefix='rhb-bench-')
+        try:
+            results += BENCHMARKS[name](args, tmp)
+        finally:
+            shutil.rmtree(tmp)
+    if args.json:
+        with open(args.json, 'w') as fl:
+            json.dump(results, fl, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
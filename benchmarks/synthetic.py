@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic source trees for the benchmarks.
+
+    :profiles:
+        ``small``: many small files in a flat-ish tree,
+        ``huge``: a few large files,
+        ``deep``: small files in deeply nested directories.
+"""
+
+import os
+import random
+
+PROFILES = {
+    'small': {'files': 20000, 'size': 2048, 'depth': 2, 'fanout': 20},
+    'huge': {'files': 8, 'size': 256 * 1024**2, 'depth': 1, 'fanout': 2},
+    'deep': {'files': 5000, 'size': 512, 'depth': 12, 'fanout': 2},
+}
+
+
+def _dirs(root, depth, fanout):
+    """Returns the leaf directories of a tree with the given shape."""
+    level = [root]
+    for d in range(depth):
+        level = [os.path.join(path, 'd{}_{}'.format(d, i))
+                 for path in level for i in range(fanout)]
+    return level
+
+
+def _write(path, size, rnd):
+    with open(path, 'wb') as fl:
+        if size > 1024**2:
+            # large files are sparse, the content does not matter for rsync
+            fl.truncate(size)
+        else:
+            fl.write(rnd.getrandbits(8 * size).to_bytes(size, 'little'))
+
+
+def generate(root, profile='small', files=None, size=None, seed=0):
+    """Create a synthetic source tree below ``root``.
+
+    * Return:
+
+        ``list`` of the created file paths relative to ``root``.
+    """
+    cfg = dict(PROFILES[profile])
+    cfg['files'] = files or cfg['files']
+    cfg['size'] = size or cfg['size']
+    rnd = random.Random(seed)
+    leaves = _dirs(root, cfg['depth'], cfg['fanout'])
+    res = []
+    for i in range(cfg['files']):
+        directory = leaves[i % len(leaves)]
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'f{}.bin'.format(i))
+        _write(path, cfg['size'], rnd)
+        res.append(os.path.relpath(path, root))
+    return res
+
+
+def churn(root, files, rate=0.01, seed=1):
+    """Change, delete and create ``rate`` of the files each.
+
+    * Return:
+
+        ``list`` of the file paths relative to ``root`` after the churn.
+    """
+    rnd = random.Random(seed)
+    files = list(files)
+    count = max(1, int(len(files) * rate))
+    for path in rnd.sample(files, count):
+        with open(os.path.join(root, path), 'ab') as fl:
+            fl.write(b'changed')
+    for path in rnd.sample(files, count):
+        os.remove(os.path.join(root, path))
+        files.remove(path)
+    for i in range(count):
+        path = os.path.join(os.path.dirname(files[i % len(files)]),
+                            'new{}_{}.bin'.format(seed, i))
+        _write(os.path.join(root, path), 1024, rnd)
+        files.append(path)
+    return files
@@ -2,9 +2,16 @@ import sys
 import os
 import logging
 import json
+import subprocess
 from rsync_history_backup.basic import RsyncBackup
 from rsync_history_backup.analyzer import BackupInfo
-from rsync_history_backup.utils import bcolors
+from rsync_history_backup.scheduler import BackupScheduler
+from rsync_history_backup.watcher import ChangeWatcher
+from rsync_history_backup.restore import Restorer
+from rsync_history_backup.retention import RetentionPolicy, Pruner
+from rsync_history_backup.lock import RunLock
+from rsync_history_backup.scrub import Scrubber
+from rsync_history_backup.utils import Helper, bcolors
 
 
 def init_action(src, dst):
@@ -60,7 +67,7 @@ def _init_rhb(src, dst, cfg, local_dir):
         if local_dir:
             logger.warning("Local configuration found, but using " +
                            "given config file.")
-        rhb = RsyncBackup.load_config_file(open(config, 'r'))
+        rhb = RsyncBackup.load_config_file(open(cfg, 'r'))
     elif src and dst:
         logger.debug("Source and destination set:\n{}; {}".format(src, dst))
         if local_dir:
@@ -77,59 +84,97 @@ def _init_rhb(src, dst, cfg, local_dir):
                         "the '--src' and '-dst' flag or " +
                         "be in a directory with a rhb local directory.")
         sys.exit(1)
-    logger.debug("rhb: src={}; dst={}".format(rhb.source, rhb.destination))
+    for bkp in rhb if isinstance(rhb, list) else [rhb]:
+        logger.debug("rhb: src={}; dst={}".format(bkp.source, bkp.destination))
     return rhb
 
 
-def backup_action(src, dst, cfg, local_dir):
+def backup_action(src, dst, cfg, local_dir, jobs=1, per_dst_device=1,
+                  per_src_device=1, resume=False, on_locked=None):
     rhb = _init_rhb(src, dst, cfg, local_dir)
-    return rhb.run_backup()
+    for bkp in rhb if isinstance(rhb, list) else [rhb]:
+        bkp.resume = bkp.resume or resume
+        bkp.on_locked = on_locked or bkp.on_locked
+    if not isinstance(rhb, list):
+        return rhb.run_backup()
+    scheduler = BackupScheduler(rhb, workers=jobs,
+                                per_destination_device=per_dst_device,
+                                per_source_device=per_src_device)
+    return all(res.success for res in scheduler.run())
 
 
 def dryrun_action(src, dst, cfg, local_dir):
     logger = logging.getLogger('rhb.dryrun_action')
     rhb = _init_rhb(src, dst, cfg, local_dir)
-    try:
-        out = rhb.dry_run()
-    except FileNotFoundError as e:
-        logger.critical("{}: {}".format(rhb.source, e))
-        sys.exit(1)
+    for bkp in rhb if isinstance(rhb, list) else [rhb]:
+        try:
+            out = bkp.dry_run()
+        except FileNotFoundError as e:
+            logger.critical("{}: {}".format(bkp.source, e))
+            sys.exit(1)
 
-    if not out:
-        return True
-
-    for t in out:
-        if not out[t]:
-            continue
-        print('\n' + t.upper() + ':', "({} changes)".format(len(out[t])))
-        if len(out[t]) > 100:
+        if not out:
             continue
-        for f in out[t]:
-            print(" - " + f.replace(rhb.source + '/', ''))
 
+        for t in out:
+            if not out[t]:
+                continue
+            print('\n' + t.upper() + ':', "({} changes)".format(len(out[t])))
+            if len(out[t]) > 100:
+                continue
+            for f in out[t]:
+                print(" - " + f.replace(bkp.source + '/', ''))
+
+        out.discard()
     return True
 
 
-def versions_action(config, local_dir, path, show=False):
-    logger = logging.getLogger("rhb.versions_action()")
-    if not path:
-        logger.critical("You have to set a file you want to analyze.")
+def watch_action(local_dir):
+    logger = logging.getLogger('rhb.watch_action')
+    if not local_dir:
+        logger.critical("You have to be in a directory with " +
+                        "a rhb local directory.")
         sys.exit(1)
+    watcher = ChangeWatcher(local_dir, os.path.join(local_dir, '.rhb'))
+    watcher.run()
+    return True
+
+
+def _load_config(config, local_dir):
+    """Returns the configuration of the backup and the source directory it
+    belongs to."""
+    logger = logging.getLogger("rhb._load_config()")
     if config:
         cfg = json.load(open(config, 'r'))
-        backup_info = BackupInfo(cfg['destination'], cfg['name'])
-        file_name = os.path.abspath(path).replace(cfg['source'], '')
+        source = cfg['source']
     elif local_dir:
         cfg = json.load(open(os.path.join(
             local_dir, '.rhb', 'config.json'),
             'r'
         ))
-        backup_info = BackupInfo(cfg['destination'], cfg['name'])
-        file_name = os.path.abspath(path).replace(local_dir, '')
+        source = local_dir
     else:
         logger.critical("You have either to set a config file or" +
                         "be in a directory with a rhb local directory.")
         sys.exit(1)
+    return cfg, source
+
+
+def _load_backup_info(config, local_dir):
+    """Returns the ``BackupInfo`` of the configured backup and the source
+    directory it belongs to."""
+    cfg, source = _load_config(config, local_dir)
+    return BackupInfo(cfg['destination'], cfg['name'],
+                      rsync_exe=cfg.get('rsync_exe', 'rsync')), source
+
+
+def versions_action(config, local_dir, path, show=False):
+    logger = logging.getLogger("rhb.versions_action()")
+    if not path:
+        logger.critical("You have to set a file you want to analyze.")
+        sys.exit(1)
+    backup_info, source = _load_backup_info(config, local_dir)
+    file_name = os.path.abspath(path).replace(source, '')
     if not backup_info.save_history:
         logger.warning("This backup has no history stored.")
         return False
@@ -137,11 +182,11 @@ def versions_action(config, local_dir, path, show=False):
     if file_name:
         file_name = file_name[1:] if file_name[0] == '/' else file_name
 
-    def print_versions(file_name):
+    def print_versions(file_name, versions):
         vers = []
         if os.path.isfile(os.path.join(backup_info.current_dir, file_name)):
             vers.append("current")
-        vers += backup_info.get_file_versions(file_name)
+        vers += versions
         if len(vers) > 0:
             print(bcolors.colorize(file_name, 'BOLD'))
             print(len(vers), "version(s) found:")
@@ -153,25 +198,220 @@ def versions_action(config, local_dir, path, show=False):
                   "Run 'rhb backup' or 'rhb dryrun' to be sure.")
 
     if os.path.isdir(path):
-        for fi in os.listdir(path):
-            tmp = os.path.join(path, fi)
-            if os.path.isfile(tmp):
-                print_versions(os.path.join(file_name, fi))
-                print("")
+        files = [os.path.join(file_name, fi) for fi in sorted(os.listdir(path))
+                 if os.path.isfile(os.path.join(path, fi))]
+        versions = backup_info.get_files_versions(files)
+        for fi in files:
+            print_versions(fi, versions[fi])
+            print("")
     elif os.path.isfile(os.path.join(backup_info.current_dir, file_name)):
-        print_versions(file_name)
+        print_versions(file_name, backup_info.get_file_versions(file_name))
     # print('Destination:', backup_info.location)
 
     return True
 
 
-def get_action(local_dir, path, version=None):
-    if local_dir:
-        logger.debug("Local settings found: {}".format(local_dir))
-        rhb = RsyncBackup.load_config_file(
-            open(os.path.join(local_dir, '.rhb', 'config.json'), 'r')
-        )
+def reindex_action(config, local_dir):
+    logger = logging.getLogger("rhb.reindex_action()")
+    backup_info, _ = _load_backup_info(config, local_dir)
+    logger.info("Rebuilding version index of '{}'.".format(backup_info.name))
+    backup_info.reindex()
+    logger.info(" -> finished.")
+    return True
+
+
+def ls_action(config, local_dir, path, time_stamp=None):
+    logger = logging.getLogger("rhb.ls_action()")
+    backup_info, source = _load_backup_info(config, local_dir)
+    folder = os.path.relpath(os.path.abspath(path), source)
+    if folder.startswith('..'):
+        logger.critical("'{}' is not part of the backup.".format(path))
+        sys.exit(1)
+    folder = '' if folder == '.' else folder
+    if time_stamp:
+        time_stamp = Restorer.normalize(time_stamp)
+    for name in backup_info.list_at(folder, time_stamp):
+        print(bcolors.colorize(name, 'OKBLUE') if name.endswith('/')
+              else name)
+    return True
+
+
+def _is_binary(path, size=8192):
+    with open(path, 'rb') as fl:
+        return b'\0' in fl.read(size)
+
+
+def _print_content_diff(backup_info, entry, kind, time_from, time_to):
+    """Stream the unified diff of ``entry`` between two points in time."""
+    out = sys.stdout
+    old = backup_info.version_at(entry, time_from)
+    new = backup_info.version_at(entry, time_to)
+    if kind == 'changed':
+        with backup_info.version_file(entry, old) as a, \
+                backup_info.version_file(entry, new) as b:
+            if not os.path.isfile(a) or not os.path.isfile(b):
+                return
+            if _is_binary(a) or _is_binary(b):
+                out.write("Binary files a/{0} and b/{0} differ\n".format(
+                    entry))
+                return
+            out.flush()
+            proc = subprocess.Popen(['diff', '-u', '--label', 'a/' + entry,
+                                     '--label', 'b/' + entry, a, b],
+                                    stdout=subprocess.PIPE)
+            for line in proc.stdout:
+                sys.stdout.buffer.write(line)
+            proc.wait()
+            sys.stdout.buffer.flush()
+        return
+    version, sign = (new, '+') if kind == 'created' else (old, '-')
+    with backup_info.version_file(entry, version) as path:
+        if not os.path.isfile(path):
+            return
+        if _is_binary(path):
+            out.write("Binary file {} {}\n".format(entry, kind))
+            return
+    lines = sum(1 for _ in backup_info.get_file_content(entry, version,
+                                                         stream=True))
+    if kind == 'created':
+        out.write("--- /dev/null\n+++ b/{}\n@@ -0,0 +1,{} @@\n".format(
+            entry, lines))
     else:
-        logger.critical("You have to be in a directory with " +
-                        "a rhb local directory.")
+        out.write("--- a/{}\n+++ /dev/null\n@@ -1,{} +0,0 @@\n".format(
+            entry, lines))
+    for line in backup_info.get_file_content(entry, version, stream=True):
+        out.write(sign + line if line.endswith('\n') else
+                  sign + line + '\n\\ No newline at end of file\n')
+
+
+def diff_action(config, local_dir, time_from, time_to, path, as_json=False,
+                content=False):
+    """Print the changes of the runs after ``time_from`` up to and including
+    ``time_to`` (see :meth:`BackupInfo.diff`)."""
+    logger = logging.getLogger("rhb.diff_action()")
+    backup_info, source = _load_backup_info(config, local_dir)
+    folder = os.path.relpath(os.path.abspath(path), source)
+    if folder.startswith('..'):
+        logger.critical("'{}' is not part of the backup.".format(path))
+        sys.exit(1)
+    folder = '' if folder == '.' else folder
+    time_from, time_to = [None if time in (None, 'current')
+                          else Restorer.normalize(time)
+                          for time in (time_from, time_to)]
+    changes = backup_info.diff(time_from, time_to, folder)
+    if as_json:
+        json.dump(dict(changes, **{'from': time_from or 'current',
+                                   'to': time_to or 'current',
+                                   'path': folder}),
+                  sys.stdout, indent=2)
+        print("")
+        return True
+    signs = {'created': ('+', 'OKGREEN'), 'deleted': ('-', 'FAIL'),
+             'changed': ('~', 'WARNING')}
+    entries = sorted((entry, kind) for kind in changes
+                     for entry in changes[kind])
+    for entry, kind in entries:
+        sign, color = signs[kind]
+        if content and not entry.endswith('/'):
+            print(bcolors.colorize("{} {}".format(sign, entry), 'BOLD'))
+            _print_content_diff(backup_info, entry, kind, time_from, time_to)
+        else:
+            print(bcolors.colorize("{} {}".format(sign, entry), color))
+    return True
+
+
+def prune_action(config, local_dir, keep=None, dry_run=False,
+                 batch_size=1000, pause=0.0):
+    logger = logging.getLogger("rhb.prune_action()")
+    cfg, _ = _load_config(config, local_dir)
+    backup_info, _ = _load_backup_info(config, local_dir)
+    rules = keep or cfg.get('retention')
+    if not rules:
+        logger.critical("No retention policy set. Use '--keep' or the " +
+                        "'retention' setting of the config file.")
+        sys.exit(1)
+    try:
+        policy = RetentionPolicy(rules)
+    except ValueError as e:
+        logger.critical(str(e))
+        sys.exit(1)
+    lock = RunLock(backup_info.log_dir, cfg.get('on_locked', 'wait'),
+                   cfg.get('lock_timeout'))
+    if not lock.acquire():
+        return True
+    try:
+        stats = Pruner(backup_info, policy, batch_size, pause, dry_run).run()
+    finally:
+        backup_info.close()
+        lock.release()
+    print(bcolors.colorize(backup_info.name, 'BOLD') +
+          (" (dry run)" if dry_run else ""))
+    print(" - runs:    {runs} ({kept} kept, {expired} expired)".format(
+        **stats))
+    print(" - files:   {moved} merged, {deleted} deleted".format(**stats))
+    print(" - reclaim: {}".format(Helper.size_human_readable(stats['bytes'])))
+    return True
+
+
+def verify_action(config, local_dir, fraction=0.0, rate=None, jobs=None,
+                  compare_source=False):
+    logger = logging.getLogger("rhb.verify_action()")
+    backup_info, source = _load_backup_info(config, local_dir)
+    try:
+        rate = Helper.parse_size(rate) if rate else None
+    except ValueError as e:
+        logger.critical(str(e))
         sys.exit(1)
+    if compare_source and not os.path.isdir(source):
+        logger.critical("The source '{}' is not a local folder."
+                        .format(source))
+        sys.exit(1)
+    stats = Scrubber(backup_info, source if compare_source else None,
+                     fraction, rate, jobs).run()
+    print(bcolors.colorize(backup_info.name, 'BOLD'))
+    print(" - files:   {} ({})".format(
+        stats['files'], Helper.size_human_readable(stats['bytes'])))
+    print(" - hashed:  {} ({}), {} new or changed".format(
+        stats['hashed'], Helper.size_human_readable(stats['hashed_bytes']),
+        stats['new']))
+    problems = [('corrupt', 'FAIL'), ('unreadable', 'FAIL'),
+                ('source', 'WARNING')]
+    for kind, color in problems:
+        for path in sorted(stats[kind]):
+            print(bcolors.colorize(" ! {:<10} {}".format(kind, path), color))
+    return not any(stats[kind] for kind, _ in problems)
+
+
+def get_action(config, local_dir, path, version=None, output=None,
+               generate_links=False, delete_links=False, jobs=None):
+    logger = logging.getLogger("rhb.get_action()")
+    backup_info, source = _load_backup_info(config, local_dir)
+    restorer = Restorer(backup_info, version, jobs)
+    if delete_links:
+        if not output:
+            logger.critical("Set the folder of the links with '--output'.")
+            sys.exit(1)
+        count = restorer.unlink(output)
+        logger.info("{} link(s) removed.".format(count))
+        return True
+
+    file_name = os.path.relpath(os.path.abspath(path), source)
+    if file_name.startswith('..'):
+        logger.critical("'{}' is not part of the backup.".format(path))
+        sys.exit(1)
+    file_name = '' if file_name == '.' else file_name
+    if not output:
+        output = os.path.join(os.getcwd(), '{} ({})'.format(
+            os.path.basename(file_name) or backup_info.name,
+            restorer.time_stamp or 'current'))
+    if os.path.lexists(output) and os.listdir(output):
+        logger.critical("The output folder '{}' is not empty.".format(output))
+        sys.exit(1)
+    logger.info("Restoring '{}' as of {} to '{}'.".format(
+        file_name or '.', restorer.time_stamp or 'current', output))
+    if generate_links:
+        count = restorer.link(file_name, output)
+    else:
+        count = restorer.restore(file_name, output)
+    logger.info(" -> {} file(s) restored.".format(count))
+    return count > 0
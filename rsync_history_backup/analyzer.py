@@ -1,15 +1,69 @@
 import sys
 import os
 import glob
+import mmap
+import mimetypes
 from datetime import datetime
+import shutil
 import logging
+import tempfile
 from time import time
-from rsync_history_backup.utils import Helper
+from contextlib import contextmanager
+from rsync_history_backup.utils import Helper, LRUCache
+from rsync_history_backup.index import VersionIndex
+from rsync_history_backup.delta import Delta
+from rsync_history_backup.manifest import ManifestCache
+from rsync_history_backup.changelog import ChangeLog
+from rsync_history_backup.pack import SnapshotPack
+try:
+    import magic
+except ImportError:
+    magic = None
+
+
+class FileView:
+    """Read only, memory mapped view of a file with range reads.
+
+    * Parameters:
+
+        :path:
+            ``string``;
+            path to the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fl = open(path, 'rb')
+        self.size = os.fstat(self.fl.fileno()).st_size
+        self.data = mmap.mmap(self.fl.fileno(), 0, access=mmap.ACCESS_READ) \
+            if self.size else b''
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def read(self, start=0, length=None):
+        """Returns ``length`` bytes (all by default) from ``start``."""
+        end = self.size if length is None else min(start + length, self.size)
+        return self.data[start:end]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.fl.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 class BackupInfo():
 
-    def __init__(self, location, name):
+    def __init__(self, location, name, rsync_exe='rsync'):
         self.logger = logging.getLogger("rhb.BackupInfo")
 
         if not os.path.isdir(location):
@@ -17,10 +71,13 @@ class BackupInfo():
                                     "Make sure your device is mounted.")
         self.location = location
         self.name = name
+        self.rsync_exe = rsync_exe
         self.time_stamp = '%Y-%m-%d %H-%M-%S'
         self.save_history = (True if os.path.exists(self.history_dir) and
                              os.listdir(self.history_dir) else False)
         self.runs = None
+        self._info_cache = LRUCache(1024)
+        self._packs = LRUCache(16, on_evict=lambda pack: pack.close())
 
     @property
     def size_human_readable(self):
@@ -38,36 +95,283 @@ class BackupInfo():
     def current_dir(self):
         return os.path.join(self.location, 'current', self.name)
 
+    def close(self):
+        """Close the cached snapshot packs."""
+        for pack in self._packs.values():
+            pack.close()
+        self._packs.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def forget_pack(self, version):
+        """Close and drop the cached pack of ``version``, e.g. after it was
+        removed or rewritten."""
+        pack = self._packs.pop(version, None)
+        if pack is not None:
+            pack.close()
+
+    def packed(self, file_name, version):
+        """Returns the :class:`SnapshotPack` of ``version`` if it holds
+        ``file_name``, otherwise ``None``."""
+        snapshot = os.path.join(self.history_dir, version)
+        pack = self._packs.get(version)
+        if pack is None:
+            if not SnapshotPack.exists(snapshot):
+                return None
+            pack = self._packs[version] = SnapshotPack(snapshot)
+        return pack if file_name in pack else None
+
+    def materialize(self, file_name, version, target_dir):
+        """Rebuild a delta encoded version of ``file_name`` in
+        ``target_dir``.
+
+        The chain of deltas is replayed starting from the next newer
+        snapshot holding a full copy of the file (or ``current/``).
+
+        * Return:
+
+            ``string``;
+            path of the rebuilt file.
+        """
+        self.logger.debug(' - [materialize() called.]')
+        newer = sorted(v for v in self.get_file_versions(file_name)
+                       if v > version)
+        chain = [os.path.join(self.history_dir, version, file_name) +
+                 Delta.SUFFIX]
+        base = None
+        for v in newer:
+            path = os.path.join(self.history_dir, v, file_name)
+            if os.path.isfile(path):
+                base = path
+                break
+            if not os.path.isfile(path + Delta.SUFFIX) and \
+                    self.packed(file_name, v):
+                base = self.packed(file_name, v).extract(file_name,
+                                                         target_dir)
+                break
+            chain.append(path + Delta.SUFFIX)
+        if base is None:
+            base = os.path.join(self.current_dir, file_name)
+        for batch in reversed(chain):
+            base = Delta.decode(batch, base, target_dir, self.rsync_exe)
+        return base
+
+    def _version_path(self, file_name, version):
+        """Returns the path of ``file_name`` in ``version`` and a temporary
+        folder to remove afterwards (``None`` unless the version had to be
+        rebuilt from deltas or extracted from the snapshot pack)."""
+        if not version or version in ['current', 'None']:
+            return os.path.join(self.current_dir, file_name), None
+        path = os.path.join(self.history_dir, version, file_name)
+        if os.path.lexists(path):
+            return path, None
+        if os.path.isfile(path + Delta.SUFFIX):
+            tmp = tempfile.mkdtemp(prefix='rhb-')
+            return self.materialize(file_name, version, tmp), tmp
+        pack = self.packed(file_name, version)
+        if pack is None:
+            return path, None
+        tmp = tempfile.mkdtemp(prefix='rhb-')
+        return pack.extract(file_name, tmp), tmp
+
+    @contextmanager
+    def version_file(self, file_name, version=None):
+        """Context manager which yields the path of a version of
+        ``file_name``, delta encoded versions are rebuilt temporarily."""
+        path, tmp = self._version_path(file_name, version)
+        try:
+            yield path
+        finally:
+            if tmp:
+                shutil.rmtree(tmp)
+
+    @staticmethod
+    def _mime_type(path):
+        if magic is not None:
+            mime_type = magic.from_file(path, mime=True)
+            return mime_type.decode('utf-8') \
+                if isinstance(mime_type, bytes) else mime_type
+        mime_type = mimetypes.guess_type(path)[0]
+        if mime_type:
+            return mime_type
+        with open(path, 'rb') as fl:
+            return 'application/octet-stream' if b'\0' in fl.read(8192) \
+                else 'text/plain'
+
+    def _file_meta(self, file_name, version):
+        """Returns the cached size and mime type of a file version.
+
+        Entries of current/ are validated by their modification time, the
+        history does not change.
+        """
+        key = (file_name, version or 'current')
+        stat = None
+        if key[1] == 'current':
+            st = os.stat(os.path.join(self.current_dir, file_name))
+            stat = (st.st_mtime_ns, st.st_size)
+        meta = self._info_cache.get(key)
+        if meta is None or meta['stat'] != stat:
+            with self.version_file(file_name, version) as path:
+                meta = {'stat': stat, 'size': os.path.getsize(path),
+                        'mime_type': self._mime_type(path)}
+            self._info_cache[key] = meta
+        return meta
+
     def get_file_info(self, file_name, version=None):
         file_name = file_name.replace(self.current_dir + '/', '')
-        if version and version not in ['current', 'None']:
-            path = os.path.join(self.history_dir, version, file_name)
-        else:
-            path = os.path.join(self.current_dir, file_name)
+        if version in ['current', 'None']:
+            version = None
+        meta = self._file_meta(file_name, version)
+        path = os.path.join(self.history_dir, version, file_name) \
+            if version else os.path.join(self.current_dir, file_name)
+        if not os.path.lexists(path):
+            if version and self.packed(file_name, version):
+                path = os.path.join(self.history_dir, version,
+                                    SnapshotPack.FILE_NAME)
+            else:
+                path += Delta.SUFFIX
         return {
-            'name': os.path.basename(path),
-            'mime_type': magic.from_file(path, mime=True).decode('utf-8'),
-            'size': os.path.getsize(path),
-            'size_human_readable':
-                Helper.size_human_readable(os.path.getsize(path)),
+            'name': os.path.basename(file_name),
+            'mime_type': meta['mime_type'],
+            'size': meta['size'],
+            'size_human_readable': Helper.size_human_readable(meta['size']),
             'versions': self.get_file_versions(file_name),
             'abs_path': path
         }
 
-    def get_file_content(self, file_name, version=None):
-        if version and version not in ['current', 'None']:
-            path = os.path.join(self.history_dir, version, file_name)
-        else:
-            path = os.path.join(self.current_dir, file_name)
-        if not os.path.isfile(path) or os.path.getsize(path) > (20 * 1024**2):
-            return None
+    def get_file_content(self, file_name, version=None, stream=False):
+        """Returns the content of a text file version (up to 20 MB).
+
+        With ``stream`` a generator of its lines is returned instead, which
+        reads the file lazily and has no size limit. Use
+        :meth:`iter_file_chunks` or :meth:`open_file_view` for binary
+        content.
+        """
+        if stream:
+            return self._stream_file_content(file_name, version)
+        with self.version_file(file_name, version) as path:
+            if not os.path.isfile(path) or \
+                    os.path.getsize(path) > (20 * 1024**2):
+                return None
 
-        f = open(path, 'r')
-        content = f.read()
-        f.close()
+            f = open(path, 'r')
+            content = f.read()
+            f.close()
 
         return content
 
+    def _stream_file_content(self, file_name, version):
+        with self.version_file(file_name, version) as path:
+            if not os.path.isfile(path):
+                return
+            with open(path, 'r', errors='replace') as fl:
+                for line in fl:
+                    yield line
+
+    def iter_file_chunks(self, file_name, version=None, chunk_size=1024**2,
+                         start=0, end=None):
+        """Yield the content of a file version as ``bytes`` chunks.
+
+        * Parameters:
+
+            :chunk_size:
+                ``int``;
+                maximal size of a chunk.
+
+            :start:
+                ``int``;
+                offset of the first byte.
+
+            :end:
+                ``int``;
+                offset after the last byte, ``None`` for the end of file.
+        """
+        with self.version_file(file_name, version) as path:
+            with open(path, 'rb') as fl:
+                fl.seek(start)
+                remaining = None if end is None else max(end - start, 0)
+                while remaining is None or remaining > 0:
+                    size = chunk_size if remaining is None \
+                        else min(chunk_size, remaining)
+                    chunk = fl.read(size)
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+
+    @contextmanager
+    def open_file_view(self, file_name, version=None):
+        """Context manager which yields a :class:`FileView` of a file
+        version for random range reads."""
+        with self.version_file(file_name, version) as path:
+            with FileView(path) as view:
+                yield view
+
+    def version_at(self, file_name, time_stamp=None):
+        """Returns the history version of ``file_name`` at ``time_stamp`` as
+        understood by :meth:`diff`, i.e. its first snapshot after it, or
+        ``None`` for the version in current/."""
+        if not time_stamp:
+            return None
+        later = [version for version in self.get_file_versions(file_name)
+                 if version > time_stamp]
+        return min(later) if later else None
+
+    def diff(self, time_from, time_to=None, path=''):
+        """Compare the backup at two points in time.
+
+        The change logs of all runs in between are merged, neither
+        current/ nor the history is scanned. A run id stands for the state
+        after that run, any other time stamp (or a prefix like
+        ``2020-01-31``) for the state before the runs at or after it. So
+        the runs ``time_from < run <= time_to`` are merged and the diff of
+        two consecutive runs shows the changes of the second one.
+
+        * Parameters:
+
+            :time_from:
+                ``string``;
+                older point in time, ``None`` for the current state.
+
+            :time_to:
+                ``string``;
+                newer point in time, ``None`` for the current state (the
+                state after the last run). If it is older than
+                ``time_from`` the changes are reversed.
+
+            :path:
+                ``string``;
+                only compare below this path.
+
+        * Return:
+
+            ``dict``;
+            sorted ``list`` of the created, deleted and changed paths.
+        """
+        reverse = time_from is None or (time_to is not None and
+                                        time_to < time_from)
+        if reverse:
+            time_from, time_to = time_to, time_from
+        res = {}
+        if time_from is None:
+            time_from = time_to = ''
+        for run in ChangeLog.runs(self.log_dir):
+            if run <= time_from or (time_to is not None and run > time_to):
+                continue
+            res = ChangeLog.merge(res, ChangeLog.changes(self.log_dir, run,
+                                                         path.strip('/')))
+        swap = {'created': 'deleted', 'deleted': 'created'} if reverse \
+            else {}
+        changes = {kind: [] for kind in ChangeLog.KINDS}
+        for entry in sorted(res):
+            changes[swap.get(res[entry], res[entry])].append(entry)
+        return changes
+
     def get_file_versions(self, file_path):
         """
 
@@ -87,13 +391,56 @@ class BackupInfo():
         res = {file_path: [] for file_path in file_paths}
         if not os.path.exists(self.history_dir):
             return res
+        if VersionIndex.exists(self.log_dir):
+            with VersionIndex(self.log_dir) as index:
+                return index.versions(file_paths)
         for dt in os.listdir(self.history_dir):
             dirname = os.path.join(self.history_dir, dt)
             for file_path in file_paths:
-                if os.path.exists(os.path.join(dirname, file_path)):
+                path = os.path.join(dirname, file_path)
+                if os.path.exists(path) or \
+                        os.path.exists(path + Delta.SUFFIX) or \
+                        self.packed(file_path, dt):
                     res[file_path].append(dt)
         return res
 
+    def list_at(self, path='', time_stamp=None):
+        """List a folder of the backup as it was at ``time_stamp``.
+
+        The listing is reconstructed from the change logs and cached as a
+        manifest per run, no snapshot is scanned.
+
+        * Parameters:
+
+            :path:
+                ``string``;
+                folder relative from the current/ root (``''`` for the
+                root).
+
+            :time_stamp:
+                ``string``;
+                point in time, ``None`` for the current state.
+
+        * Return:
+
+            ``list``;
+            sorted names of the entries, folders with a trailing ``/``.
+        """
+        cache = ManifestCache(self.log_dir, self.current_dir)
+        with cache.get(time_stamp) as manifest:
+            return manifest.children(path)
+
+    def reindex(self):
+        """Rebuild the version index from the logs and the history tree.
+
+        * Return:
+
+            ``int``;
+            number of indexed snapshots.
+        """
+        with VersionIndex(self.log_dir) as index:
+            return index.rebuild(self.history_dir)
+
     def serialize(self):
         param = vars(self)
         for key in param:
@@ -6,24 +6,57 @@ import subprocess
 import logging
 import json
 import re
-from datetime import datetime
+import stat
+import errno
+import select
+import threading
+from time import time
+from datetime import datetime, timedelta
 from tempfile import mkstemp
+from contextlib import contextmanager
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from rsync_history_backup.changelog import ChangeLog
+from rsync_history_backup.index import VersionIndex, CurrentIndex
+from rsync_history_backup.sharding import ShardPlan
+from rsync_history_backup.report import RsyncStats, RunReport, \
+    RsyncProgress, ProgressEvent, EtaEstimator, RssSampler
+from rsync_history_backup.watcher import ChangeWatcher
+from rsync_history_backup.dedup import ObjectStore
+from rsync_history_backup.delta import Delta
+from rsync_history_backup.pack import SnapshotPack
+from rsync_history_backup.journal import RunJournal
+from rsync_history_backup.lock import RunLock
+from rsync_history_backup.engine import NativeSync, ExcludeFilter
+from rsync_history_backup.checksums import SourceChecksums
+from rsync_history_backup.analyzer import BackupInfo
+from rsync_history_backup.retention import RetentionPolicy, Pruner
+from rsync_history_backup.utils import Helper
 
 if sys.version_info < (3, 0):
     raise RuntimeError("Must use python 3.0 or greater.")
 
+RUN_ID = re.compile(r'^\d{4}-\d\d-\d\d \d\d-\d\d-\d\d(\.\d{6})?')
+
 
 class RsyncBackup:
+    time_format = r'%Y-%m-%d %H-%M-%S.%f'
 
     def __init__(self, source, destination,
                  name=None, rsync_exe='rsync', exclude_file='',
-                 save_history=True, save_dryrun=True,
+                 save_history=True, save_dryrun=True, single_scan=False,
+                 history_mode='copy', shards=1, shard_by='top',
+                 prometheus_file=None, watch=False, hash_workers=None,
+                 delta_threshold=0, retention=None, min_free_space=0,
+                 on_low_space='abort', resume=False, on_locked='wait',
+                 lock_timeout=None, engine='rsync',
+                 compare_with='destination', manifest_verify_days=7,
+                 pack_threshold=0, change_detection='metadata',
                  sync_options=["--recursive", "--update", "--delete", "--owner",
                                "--group", "--times", "--links", "--safe-links",
                                "--super", "--one-file-system", "--devices"],
                  hist_options=["--update", "--owner", "--group", "--times",
                                "--links", "--super"]):
-        self.time_format = r'%Y-%m-%d %H-%M-%S'
         self.logger = logging.getLogger("rhb.RsyncBackup")
         self.source = os.path.abspath(source) + '/'
         # if not os.path.exists(destination):
@@ -46,10 +79,64 @@ class RsyncBackup:
             self.exclude_option = []
         self.save_history = save_history
         self.save_dryrun = save_dryrun
+        self.single_scan = single_scan
+        if history_mode not in ('copy', 'link', 'dedup'):
+            raise ValueError("Unknown history mode '{}'.".format(history_mode))
+        self.history_mode = history_mode
+        self.hash_workers = hash_workers
+        self.delta_threshold = delta_threshold
+        self.pack_threshold = pack_threshold
+        self.retention = retention
+        if on_low_space not in ('abort', 'prune'):
+            raise ValueError("Unknown on_low_space action '{}'.".format(
+                on_low_space))
+        self.min_free_space = min_free_space
+        self.on_low_space = on_low_space
+        self.resume = resume
+        if on_locked not in RunLock.MODES:
+            raise ValueError("Unknown on_locked action '{}'.".format(
+                on_locked))
+        self.on_locked = on_locked
+        self.lock_timeout = lock_timeout
+        if engine not in ('rsync', 'native'):
+            raise ValueError("Unknown engine '{}'.".format(engine))
+        self.engine = engine
+        self._native_sync = None
+        if compare_with not in ('destination', 'manifest'):
+            raise ValueError("Unknown compare_with value '{}'.".format(
+                compare_with))
+        self.compare_with = compare_with
+        self.manifest_verify_days = manifest_verify_days
+        self.manifest_scan = False
+        if change_detection not in ('metadata', 'content'):
+            raise ValueError("Unknown change_detection mode '{}'.".format(
+                change_detection))
+        self.change_detection = change_detection
+        self.content_changes = []
+        self.shards = shards
+        self.shard_by = shard_by
+        self.shard_plan = None
+        self.prometheus_file = prometheus_file
+        self.watch = watch
+        self.watcher = None
+        self.scope_options = []
+        self.report = None
+        self.scan_stats = RsyncStats()
+        self.history_stats = RsyncStats()
+        self.transfer_stats = RsyncStats()
+        self._lock = threading.Lock()
+        self.listeners = []
+        self.progress_interval = 1.0
+        self._progress = {}
+        self._transfer_started = None
+        self._eta = None
+        self.max_idle = 0.0
         self.sync_options = sync_options + self.exclude_option
+        if engine == 'native' or compare_with == 'manifest':
+            # Options the native engine can not read fail before any run.
+            NativeSync.expand_options(self.sync_options)
         self.hist_options = hist_options
         self.time_stamp = None
-        self.dryrun = None
         self.change_log = None
 
     @staticmethod
@@ -71,7 +158,11 @@ class RsyncBackup:
             for src in cfg['sources']:
                 tmp = cfg.copy()
                 tmp.pop('sources', None)
-                res.append(RsyncBackup(**dict(set(tmp) & set(src))))
+                src = {'source': src} if isinstance(src, str) else src
+                tmp['name'] = src.get('name', os.path.basename(
+                    os.path.normpath(src['source'])))
+                tmp.update(src)
+                res.append(RsyncBackup(**tmp))
             return res
         return None
 
@@ -105,8 +196,8 @@ class RsyncBackup:
                              'This is a bug and should happen automatically.')
         return os.path.join(self.history_dir, self.time_stamp)
 
-    def _run_rsync(self, source, destination, options=[], check_output=True):
-        """Run rsync.
+    def _run_rsync(self, source, destination, options=[]):
+        """Run rsync and return its console output.
 
         * Parameters:
 
@@ -123,153 +214,1032 @@ class RsyncBackup:
                 ``list``;
                 list of all rsync options which should be set.
 
-            :check_output:
-                ``bool``;
-                if ``True`` the rsync process will be started as a subprocess
-                and it's console output will be piped and then returned.
-                If ``False`` the rsync console output is piped to
-                ``std::out``
-
         * Return:
 
-            If ``check_output`` is ``True`` the rsync console output else
-            it will return ``True`` when process is finished.
+            ``bytes``;
+            the rsync console output.
         """
 
         self.logger.debug(' - [_run_rsync() called.]')
-        # print(self.rsync_exe, ' '.join(options + [source, destination]))
-
-        if not check_output:
-            os.system(' '.join([self.rsync_exe] + options +
-                      [source, destination]))
-            return True
-
         return subprocess.check_output(
             [self.rsync_exe] + options +
             [source, destination]
         )
 
+    def _wait(self, proc, sampler):
+        """Stop the ``RssSampler`` ``sampler`` of the rsync process
+        ``proc``, wait for the process and record its peak memory in the
+        run report.
+
+        * Return:
+
+            ``int``;
+            the exit code of rsync.
+        """
+        rss = sampler.stop()
+        ret = proc.wait()
+        if self.report is not None:
+            self.report.child_finished(rss)
+        return ret
+
+    def _stream_rsync(self, source, destination, options=[]):
+        """Run rsync and yield its console output line by line.
+
+        Unlike ``_run_rsync()`` the output is never buffered as a whole, so
+        memory usage does not depend on the number of itemized files.
+
+        * Raises:
+
+            ``subprocess.CalledProcessError`` if rsync exits with an error.
+        """
+        self.logger.debug(' - [_stream_rsync() called.]')
+        cmd = [self.rsync_exe] + options + [source, destination]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        sampler = RssSampler(proc.pid)
+        try:
+            for line in proc.stdout:
+                yield line.decode('utf-8', errors='surrogateescape')
+        finally:
+            proc.stdout.close()
+            ret = self._wait(proc, sampler)
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, cmd)
+
+    def _new_time_stamp(self):
+        """Returns the time stamp of a new run, unique and later than the
+        one of every earlier run even if the clock was set back."""
+        now = datetime.now()
+        runs = []
+        for folder in (self.log_dir, self.history_dir):
+            if os.path.isdir(folder):
+                runs += [m.group(0) for m in map(RUN_ID.match,
+                                                 os.listdir(folder)) if m]
+        if runs:
+            last = Helper.parse_time_stamp(max(runs))
+            if now <= last:
+                now = last + timedelta(microseconds=1)
+        return now.strftime(self.time_format)
+
     def _get_changes(self):
         self.logger.debug(' - [_get_changes() called.]')
         self.logger.info("Looking for changes.")
         if not os.path.exists(self.current_dir):
             os.makedirs(self.current_dir)
-        options = ['--dry-run', '--itemize-changes', '--out-format="%i|%n|"'] +\
-            self.sync_options
+        options = ['--dry-run', '--itemize-changes', '--out-format=%i|%n|',
+                   '--stats'] + self.sync_options
 
-        self.time_stamp = datetime.now().strftime(self.time_format)
-        dryrun = self._run_rsync(self.source, self.current_dir, options)
-        dryrun = dryrun.decode("utf-8") \
-            .replace('"', '') \
-            .replace('.d..t......|./|\n', '')
+        self.time_stamp = self._new_time_stamp()
+        self.scope_options = self._watched_scope()
+        if self.scope_options == ['--files-from=']:
+            self.logger.info(" -> no changes recorded by the watcher.")
+            self.watcher.finish()
+            return False
+        options += self.scope_options
+        self.shard_plan = ShardPlan(self.source, self.current_dir,
+                                    self.log_dir,
+                                    1 if self.scope_options else self.shards,
+                                    self.shard_by)
+        change_log = ChangeLog(self.log_dir, self.time_stamp,
+                               keep_raw=self.save_dryrun)
 
-        self.dryrun = dryrun
-        if not dryrun:
+        def scan(shard_filter):
+            stats = RsyncStats()
+            for line in self._stream_rsync(self.source, self.current_dir,
+                                           options + shard_filter):
+                if not stats.parse_line(line):
+                    change_log.parse_line(line)
+            return stats
+
+        self.scan_stats = RsyncStats()
+        self.manifest_scan = self._use_manifest()
+        self.content_changes = []
+        try:
+            if self.manifest_scan:
+                with CurrentIndex(self.log_dir) as manifest:
+                    self.scan_stats = self._native_scan(change_log, manifest)
+            elif self.engine == 'native':
+                self.scan_stats = self._native_scan(change_log)
+            else:
+                for stats in self._parallel(scan, self.shard_plan.filters):
+                    self.scan_stats.merge(stats)
+            if self.change_detection == 'content':
+                self.content_changes = self._content_scan(change_log)
+        except BaseException:
+            change_log.discard()
+            raise
+        change_log.close()
+
+        if not change_log:
+            change_log.discard()
             self.logger.info(" -> no changes found.")
             return False
-        self.change_log = self.__get_change_log(dryrun)
-        self.logger.info(
-            " -> {} change(s) found.".format(len(dryrun.split('\n')) - 1)
-        )
+        self.change_log = change_log
+        self.logger.info(" -> {} change(s) found.".format(change_log.lines))
         return self.change_log
 
-    def __get_change_log(self, dryrun_text):
-        self.logger.debug(' - [__get_change_log() called.]')
-        regs = {
-            'created': '^[\>fcd]{2}[\.\+]{9}\|(.*)\|',
-            'deleted': '^\*deleting  \|(.*)\|',
-            'changed': '^[\>f\.st]{11}\|(.*)\|'
-        }
-        res = {}
-        for reg_name in regs.keys():
-            reg = re.compile(regs[reg_name])
-            res[reg_name] = [el for el in reg.findall(dryrun_text) if el]
+    @property
+    def native_sync(self):
+        """The :class:`NativeSync` from the source into the current
+        directory."""
+        if self._native_sync is None:
+            self._native_sync = NativeSync(self.source, self.current_dir,
+                                           self.sync_options)
+        return self._native_sync
 
-        return res
+    def _use_manifest(self):
+        """Check if the changes can be found with the manifest of
+        ``current/``. Otherwise the destination is walked and the manifest
+        rebuilt afterwards (a verify run), which happens at least every
+        ``manifest_verify_days``."""
+        if self.compare_with != 'manifest':
+            return False
+        if not CurrentIndex.exists(self.log_dir):
+            self.logger.info("No manifest of the destination yet.")
+            return False
+        with CurrentIndex(self.log_dir) as manifest:
+            verified = manifest.verified()
+        if verified is None or time() - verified > \
+                self.manifest_verify_days * 24 * 3600:
+            self.logger.info("Verifying the destination.")
+            return False
+        return True
+
+    def _update_manifest(self, change_log):
+        """Update the manifest of ``current/`` with the changes of this run
+        or rebuild it after a verify run.
+
+        * Return:
+
+            ``int``;
+            number of updated entries.
+        """
+        self.logger.debug(' - [_update_manifest() called.]')
+        with CurrentIndex(self.log_dir) as manifest:
+            if not self.manifest_scan:
+                return manifest.rebuild(self.current_dir)
+            return manifest.update(self.current_dir, chain(
+                change_log['created'], change_log['changed'],
+                change_log['deleted']))
+
+    def _native_scan(self, change_log, manifest=None):
+        """Find the changes without rsync and add them to
+        ``change_log``, by comparing the source with ``current/`` or its
+        ``manifest``.
+
+        * Return:
+
+            ``RsyncStats`` of the scan.
+        """
+        engine = self.native_sync if manifest is None else NativeSync(
+            self.source, self.current_dir, self.sync_options,
+            manifest=manifest)
+        items, stats = engine.scan(self._scope_paths())
+        for kind, entry, item, _ in items:
+            change_log.record(kind, entry, item)
+        return stats
+
+    def _scope_paths(self):
+        """Returns the ``list`` of paths this run is restricted to by the
+        watcher or ``None`` for the whole source."""
+        if not self.scope_options:
+            return None
+        file_name = self.scope_options[0].split('=', 1)[1]
+        with open(file_name, 'r', encoding='utf-8',
+                  errors='surrogateescape') as fl:
+            return [line.rstrip('\n') for line in fl if line.strip()]
+
+    def _source_checksums(self):
+        """Returns the :class:`SourceChecksums` of this backup, kept in
+        ``.rhb/checksums`` of the source if it has local settings and in the
+        log directory otherwise."""
+        if os.path.isdir(self.local_settings_dir):
+            path = os.path.join(self.local_settings_dir, 'checksums',
+                                '{}.sqlite'.format(self.name))
+        else:
+            path = os.path.join(self.log_dir, 'source.sqlite')
+        return SourceChecksums(path, self.hash_workers)
+
+    def _content_scan(self, change_log):
+        """Add the files whose content changed although size and
+        modification time did not to ``change_log`` (``change_detection``
+        ``'content'``).
+
+        * Return:
+
+            ``list`` of these files.
+        """
+        self.logger.debug(' - [_content_scan() called.]')
+        change_log.flush()
+        found = set(change_log['created']) | set(change_log['changed'])
+        with self._source_checksums() as checksums:
+            changed = checksums.check(
+                self.source, self.current_dir, found,
+                ExcludeFilter.from_options(self.sync_options),
+                self._scope_paths())
+        for entry in changed:
+            change_log.record('changed', entry, '>fc........')
+        return changed
+
+    def _update_checksums(self, change_log):
+        """Record the checksums of the files transferred by this run.
+
+        * Return:
+
+            ``int``;
+            number of recorded files.
+        """
+        self.logger.debug(' - [_update_checksums() called.]')
+        since = int(Helper.parse_time_stamp(self.time_stamp).timestamp() *
+                    10**9)
+        with self._source_checksums() as checksums:
+            return checksums.update(
+                self.source, self.current_dir,
+                chain(change_log['created'], change_log['changed']),
+                change_log['deleted'], since)
+
+    def _watched_scope(self):
+        """Returns the rsync options restricting this run to the paths
+        recorded by the watcher (see ``rhb watch``).
+
+        An empty ``list`` means a full scan is required, because watching
+        is disabled, the watcher is not running or has lost events.
+        ``['--files-from=']`` means no path has changed.
+        """
+        self.watcher = None
+        if not self.watch or not os.path.isdir(self.local_settings_dir):
+            return []
+        self.watcher = ChangeWatcher(self.source, self.local_settings_dir)
+        reliable = self.watcher.is_reliable()
+        self.watcher.claim()
+        if not reliable:
+            self.logger.info("Watcher not reliable, scanning everything.")
+            return []
+        path, count = self.watcher.write_scope(self.current_dir)
+        self.logger.info(" -> {} path(s) recorded by the watcher.".format(
+            count))
+        if not count:
+            return ['--files-from=']
+        return ['--files-from={}'.format(path), '--delete-missing-args']
 
     def _save_file_logs(self, change_log):
         self.logger.debug(' - [_save_file_logs() called.]')
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
-        if self.save_dryrun and self.dryrun:
-            file_name = '{}.{}'.format(self.time_stamp, 'dryrun')
-            fl = open(os.path.join(self.log_dir, file_name), 'w+')
-            fl.write(self.dryrun)
-            fl.flush()
-            fl.close()
-        else:
+        if not self.save_dryrun:
             self.logger.warning(
                 "Not saving the 'dryrun' file might cause problems.")
-
-        for k in change_log.keys():
-            if not change_log[k]:
-                continue
-
-            file_name = '{}.{}'.format(self.time_stamp, k)
-            fl = open(os.path.join(self.log_dir, file_name), 'w+')
-            fl.write('\n'.join(change_log[k]))
-            fl.flush()
-            fl.close()
+        change_log.save()
         self.logger.debug("Log files saved.")
+        if self.shard_plan:
+            self.shard_plan.update_weights(change_log)
+        if self.save_history:
+            new_index = not VersionIndex.exists(self.log_dir)
+            with VersionIndex(self.log_dir) as index:
+                if new_index:
+                    index.rebuild(self.history_dir)
+                index.add(self.time_stamp, chain(change_log['deleted'],
+                                                 change_log['changed']))
+            self.logger.debug("Version index updated.")
         return True
 
+    def _estimate_space(self, change_log):
+        """Estimate the bytes the destination needs for this run.
+
+        The transfer size is taken from the ``--stats`` of the dry run, the
+        history size from the sizes of the changed and deleted entries in
+        ``current/`` (nothing is walked). Linked histories need no space.
+
+        * Return:
+
+            ``tuple`` of the transfer and the history bytes.
+        """
+        transfer = self.scan_stats.get('total_transferred_file_size', 0)
+        history = 0
+        history_dir = self.history_dir if os.path.isdir(self.history_dir) \
+            else self.destination
+        linked = self.history_mode in ('link', 'dedup') and \
+            not set(self.sync_options) & {'--inplace', '--append',
+                                          '--append-verify'} and \
+            os.stat(self.current_dir).st_dev == os.stat(history_dir).st_dev
+        if self.save_history and not linked:
+            for entry in chain(change_log['deleted'], change_log['changed']):
+                try:
+                    st = os.lstat(os.path.join(self.current_dir, entry))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    history += st.st_size
+        return transfer, history
+
+    def preflight(self, change_log):
+        """Check that the destination has enough free space for the run
+        before any data is moved.
+
+        If it has not, the history is pruned with the ``retention`` policy
+        (if ``on_low_space`` is ``'prune'``) and the check is repeated.
+
+        * Return:
+
+            ``dict``;
+            the estimate, the free bytes and the result of the pruning.
+
+        * Raises:
+
+            ``OSError`` (``ENOSPC``) if there is not enough space.
+        """
+        self.logger.debug(' - [preflight() called.]')
+        transfer, history = self._estimate_space(change_log)
+        required = transfer + history + self.min_free_space
+        free = Helper.disk_usage(self.destination).free
+        res = {'transfer_bytes': transfer, 'history_bytes': history,
+               'required_bytes': required, 'free_bytes': free}
+        if required > free and self.on_low_space == 'prune' and \
+                self.retention:
+            self.logger.warning("Not enough space on the destination, " +
+                                "pruning the history.")
+            with BackupInfo(self.destination, self.name,
+                            self.rsync_exe) as info:
+                res['pruned'] = Pruner(
+                    info, RetentionPolicy(self.retention)).run()
+            free = res['free_bytes'] = Helper.disk_usage(
+                self.destination).free
+        if required > free:
+            raise OSError(errno.ENOSPC, (
+                "Not enough space on the destination: {} needed, {} " +
+                "free.").format(Helper.size_human_readable(required),
+                                Helper.size_human_readable(free)),
+                self.destination)
+        self.logger.info(" -> {} needed, {} free.".format(
+            Helper.size_human_readable(required),
+            Helper.size_human_readable(free)))
+        return res
+
     def _move_to_history(self, change_log):
         self.logger.debug(' - [_move_to_history() called.]')
         if not self.save_history:
             return False
-        if not len(change_log['deleted'] + change_log['changed']) > 0:
+        if not len(change_log['deleted']) + len(change_log['changed']) > 0:
             self.logger.debug("No files need to be moved to the history.")
             return True
 
         self.logger.info("Move deleted or changed files to history.")
 
         if not os.path.isdir(self.history_dir):
-            os.mkdir(self.history_dir)
+            os.makedirs(self.history_dir)
 
         if not os.path.isdir(self.history_time_stamp_dir):
             os.mkdir(self.history_time_stamp_dir)
 
-        tmp_list = '\n'.join(sorted(
-            change_log['deleted'] + change_log['changed']
-        ))
-        fd, file_name = mkstemp()
-        tmp_file = open(file_name, 'w')
-        tmp_file.write(tmp_list)
-        tmp_file.flush()
-        tmp_file.close()
-        self.logger.debug(" -> tempfile written: {}".format(file_name))
-
-        options = self.hist_options + ['--files-from={}'.format(file_name)]
-
-        out = self._run_rsync(self.current_dir, self.history_time_stamp_dir,
-                              options)
+        entries = chain(change_log['deleted'], change_log['changed'])
+        if self.history_mode == 'link' and self._can_link_history():
+            entries = self._link_to_history(change_log)
+        elif self.history_mode == 'dedup' and self._can_link_history():
+            entries = self._dedup_to_history(change_log)
+        out = self._copy_to_history(entries) if entries else True
+        self.history_stats = RsyncStats()
+        if isinstance(out, RsyncStats):
+            self.history_stats = out
+        elif out is not True:
+            for line in out.decode('utf-8', errors='replace').splitlines():
+                self.history_stats.parse_line(line)
         self.logger.debug(" -> files moved.")
-        os.close(fd)
-        os.remove(file_name)
-        self.logger.debug(" -> tempfile deleted.")
         return out
 
+    def _copy_to_history(self, entries):
+        """Copy ``entries`` from the current directory into the history
+        directory of this run with rsync (or natively)."""
+        if self.engine == 'native':
+            return self.native_sync.copy_entries(
+                list(entries), self.current_dir, self.history_time_stamp_dir)
+        with self._files_from(entries) as file_names:
+            return b''.join(self._parallel(
+                lambda file_name: self._run_rsync(
+                    self.current_dir, self.history_time_stamp_dir,
+                    self.hist_options + ['--stats',
+                                         '--files-from={}'.format(file_name)]),
+                file_names))
+
+    def _can_link_history(self):
+        """Check if the history can be stored with hard links and renames.
+
+        This requires ``current/`` and ``history/`` to be on the same device
+        and rsync to replace changed files instead of rewriting them in
+        place, otherwise the linked history version would be modified too.
+        """
+        if set(self.sync_options) & {'--inplace', '--append',
+                                     '--append-verify'}:
+            self.logger.warning(("History mode '{}' does not work with " +
+                                 "in-place updates, copying instead.").format(
+                                    self.history_mode))
+            return False
+        if os.stat(self.current_dir).st_dev != \
+                os.stat(self.history_time_stamp_dir).st_dev:
+            self.logger.info("History is on another device, copying instead.")
+            return False
+        return True
+
+    def _link_to_history(self, change_log):
+        """Store the history of this run without copying any data.
+
+        Changed files are hard linked into the history directory, rsync
+        replaces them afterwards with a new file in ``current/``. Deleted
+        files are renamed into the history directory.
+
+        * Return:
+
+            ``list`` of entries which could not be linked or renamed (e.g.
+            unsupported by the file system) and have to be copied instead.
+        """
+        self.logger.debug(' - [_link_to_history() called.]')
+        failed = []
+
+        def store(entry, func):
+            src = os.path.join(self.current_dir, entry)
+            dst = os.path.join(self.history_time_stamp_dir, entry)
+            if not os.path.lexists(src) or os.path.lexists(dst):
+                return
+            parent = os.path.dirname(dst.rstrip('/'))
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if entry.endswith('/') or os.path.isdir(src) and \
+                    not os.path.islink(src):
+                os.makedirs(dst, exist_ok=True)
+                return
+            try:
+                func(src, dst)
+            except OSError as e:
+                self.logger.debug("Linking '{}' failed: {}".format(entry, e))
+                failed.append(entry)
+
+        for entry in change_log['changed']:
+            store(entry, lambda src, dst: os.link(src, dst,
+                                                  follow_symlinks=False))
+        for entry in change_log['deleted']:
+            store(entry, os.rename)
+        return failed
+
+    def _dedup_to_history(self, change_log):
+        """Store the history of this run in the shared object store.
+
+        The changed and deleted files are hashed in parallel, every unique
+        content is stored once in ``<destination>/objects`` and hard linked
+        into the history directory.
+
+        * Return:
+
+            ``list`` of entries which could not be stored this way (e.g.
+            symbolic links or too many links) and have to be copied instead.
+        """
+        self.logger.debug(' - [_dedup_to_history() called.]')
+        store = ObjectStore(self.destination, self.hash_workers)
+        failed, files = [], []
+        for entry in chain(change_log['changed'], change_log['deleted']):
+            src = os.path.join(self.current_dir, entry)
+            dst = os.path.join(self.history_time_stamp_dir, entry)
+            if not os.path.lexists(src) or os.path.lexists(dst):
+                continue
+            if os.path.islink(src) or not os.path.isfile(src):
+                if os.path.isdir(src):
+                    os.makedirs(dst, exist_ok=True)
+                else:
+                    failed.append(entry)
+                continue
+            files.append(entry)
+
+        hashed = store.hash_files(os.path.join(self.current_dir, entry)
+                                  for entry in files)
+        for entry, (src, digest) in zip(files, hashed):
+            dst = os.path.join(self.history_time_stamp_dir, entry)
+            try:
+                if digest is None:
+                    raise OSError("'{}' could not be hashed.".format(entry))
+                store.add(src, digest)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                store.link(digest, dst)
+            except OSError as e:
+                self.logger.debug("Storing '{}' failed: {}".format(entry, e))
+                failed.append(entry)
+        self.logger.debug(" -> {} file(s) stored, {} to copy.".format(
+            len(files) - len(failed), len(failed)))
+        return failed
+
+    def _delta_encode_history(self, change_log):
+        """Replace large changed files of the history by reverse deltas
+        against the new version in the current directory.
+
+        Only files with at least ``delta_threshold`` bytes which are not
+        hard linked elsewhere (history modes 'link' and 'dedup') are encoded.
+
+        * Return:
+
+            ``int``;
+            the number of bytes saved.
+        """
+        self.logger.debug(' - [_delta_encode_history() called.]')
+        if not self.save_history or not self.delta_threshold or \
+                not change_log['changed']:
+            return 0
+        saved = 0
+        for entry in change_log['changed']:
+            old = os.path.join(self.history_time_stamp_dir, entry)
+            new = os.path.join(self.current_dir, entry)
+            if not os.path.isfile(old) or not os.path.isfile(new):
+                continue
+            try:
+                st = os.lstat(old)
+                if os.path.islink(old) or \
+                        st.st_size < self.delta_threshold or st.st_nlink > 1:
+                    continue
+                saved += Delta.encode(old, new, self.rsync_exe)
+            except (OSError, subprocess.CalledProcessError) as e:
+                self.logger.warning("Delta of '{}' failed: {}".format(entry,
+                                                                      e))
+        self.logger.info(" -> {} saved by delta encoding.".format(
+            Helper.size_human_readable(saved)))
+        return saved
+
+    def _pack_history(self, change_log):
+        """Pack the small files of the history snapshot of this run into
+        one compressed archive (see :class:`SnapshotPack`).
+
+        Only regular files up to ``pack_threshold`` bytes which are not hard
+        linked elsewhere are packed, larger files and deltas stay loose.
+
+        * Return:
+
+            ``int``;
+            the number of packed files.
+        """
+        self.logger.debug(' - [_pack_history() called.]')
+        snapshot = self.history_time_stamp_dir
+        if not self.save_history or not self.pack_threshold or \
+                not os.path.isdir(snapshot):
+            return 0
+        entries = []
+        for entry in chain(change_log['deleted'], change_log['changed']):
+            try:
+                st = os.lstat(os.path.join(snapshot, entry))
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_nlink == 1 and \
+                    st.st_size <= self.pack_threshold:
+                entries.append(entry)
+        if not entries:
+            return 0
+        SnapshotPack.pack(snapshot, entries)
+        for entry in entries:
+            os.remove(os.path.join(snapshot, entry))
+        for folder in sorted({os.path.dirname(entry) for entry in entries},
+                             key=lambda folder: folder.count('/'),
+                             reverse=True):
+            while folder:
+                try:
+                    os.rmdir(os.path.join(snapshot, folder))
+                except OSError:
+                    break
+                folder = os.path.dirname(folder)
+        self.logger.info(" -> {} file(s) packed.".format(len(entries)))
+        return len(entries)
+
+    @contextmanager
+    def _files_from(self, entries):
+        """Write ``entries`` to temporary files usable as rsync's
+        ``--files-from`` list and remove them again afterwards.
+
+        If the backup is sharded, the entries are split into one file per
+        shard and empty files are left out.
+
+        * Parameters:
+
+            :entries:
+                ``iterable``;
+                paths relative to the source of the rsync call.
+
+        * Return:
+
+            ``list`` of file names.
+        """
+        shards = len(self.shard_plan) if self.shard_plan else 1
+        tmp_files = []
+        for _ in range(shards):
+            fd, file_name = mkstemp()
+            tmp_files.append((file_name, os.fdopen(
+                fd, 'w', encoding='utf-8', errors='surrogateescape')))
+        written = set()
+        for entry in entries:
+            idx = self.shard_plan.shard_of(entry) if shards > 1 else 0
+            tmp_files[idx][1].write(entry + '\n')
+            written.add(idx)
+        for _, tmp_file in tmp_files:
+            tmp_file.close()
+        self.logger.debug(" -> {} tempfile(s) written.".format(shards))
+        try:
+            yield [tmp_files[idx][0] for idx in sorted(written)]
+        finally:
+            for file_name, _ in tmp_files:
+                os.remove(file_name)
+            self.logger.debug(" -> tempfiles deleted.")
+
+    def _parallel(self, func, items):
+        """Call ``func`` for every item, in parallel if there are several.
+
+        * Return:
+
+            ``list`` of the results in the order of ``items``.
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=len(items)) as pool:
+            return list(pool.map(func, items))
+
+    @staticmethod
+    def _strip_walk_options(options):
+        """Remove deletion from ``options`` and turn recursion off.
+
+        Used for transfers restricted by ``--files-from``: the list already
+        names every entry, so rsync must neither descend into listed
+        directories nor delete anything next to them. Short options like
+        ``-a`` imply recursion, so they are kept as given and the appended
+        ``--no-recursive`` overrides them.
+        """
+        return [opt for opt in options if not opt.startswith('--delete')] + \
+            ['--no-recursive']
+
+    def _transfer_changes(self, change_log):
+        """Transfer only the entries found by the dry run.
+
+        This avoids a second walk over the source tree: created and changed
+        entries are copied with ``--files-from`` and deleted entries are
+        removed in a separate pass with ``--delete-missing-args``
+        (rsync >= 3.1.0).
+
+        * Return:
+
+            ``False`` if the source changed between the dry run and the
+            transfer (vanished files or re-created deleted entries), so a
+            full sync is required. ``True`` otherwise.
+        """
+        self.logger.debug(' - [_transfer_changes() called.]')
+        options = self._strip_walk_options(self.sync_options)
+        if change_log['created'] or change_log['changed']:
+            with self._files_from(chain(change_log['created'],
+                                        change_log['changed'])) as file_names:
+                rets = self._parallel(lambda item: self._run_transfer(
+                    options + ['--files-from={}'.format(item[1]),
+                               '--info=progress2'], item[0]),
+                    enumerate(file_names))
+            if set(rets) & {23, 24}:
+                self.logger.warning("Source changed since the dry run " +
+                                    "(rsync exit code {}).".format(max(rets)))
+                return False
+            elif any(rets):
+                raise subprocess.CalledProcessError(max(rets), self.rsync_exe)
+
+        if change_log['deleted']:
+            with self._files_from(change_log['deleted']) as file_names:
+                self._parallel(lambda file_name: subprocess.check_call(
+                    [self.rsync_exe] + options +
+                    ['--files-from={}'.format(file_name),
+                     '--delete-missing-args', '--force',
+                     self.source, self.current_dir]), file_names)
+            for entry in change_log['deleted']:
+                if os.path.lexists(os.path.join(self.source, entry)):
+                    self.logger.warning(
+                        "'{}' was re-created since the dry run.".format(entry))
+                    return False
+        return True
+
+    def _transfer_content_changes(self):
+        """Transfer the files whose content changed with an unchanged
+        size and modification time, rsync's quick check skips them."""
+        if not self.content_changes:
+            return
+        self.logger.debug(' - [_transfer_content_changes() called.]')
+        options = self._strip_walk_options(self.sync_options) + \
+            ['--ignore-times']
+        with self._files_from(self.content_changes) as file_names:
+            self._check_transfer(self._parallel(
+                lambda item: self._run_transfer(
+                    options + ['--files-from={}'.format(item[1])], item[0]),
+                enumerate(file_names)))
+
+    def _check_transfer(self, rets):
+        """Raise if one of the rsync transfers failed.
+
+        Partial transfers (23) and vanished files (24) are routine on a live
+        source, they are only reported and picked up by the next run.
+        """
+        failed = [ret for ret in rets if ret not in (0, 23, 24)]
+        if failed:
+            raise subprocess.CalledProcessError(max(failed), self.rsync_exe)
+        if any(rets):
+            self.logger.warning("Some files were not transferred, they " +
+                                "vanished or could not be read (rsync " +
+                                "exit code {}).".format(max(rets)))
+
+    def add_listener(self, callback):
+        """Register ``callback``, it is called with a
+        :class:`~rsync_history_backup.report.ProgressEvent` whenever rsync
+        reports progress during the transfer and at least every
+        ``progress_interval`` seconds while it is silent (see
+        ``ProgressEvent.idle`` to detect stalls)."""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def _start_progress(self):
+        """Reset the progress state and seed the ETA estimate with the
+        dry run and the report of the previous run."""
+        self._progress = {}
+        self._transfer_started = time()
+        self.max_idle = 0.0
+        expected = self.scan_stats.get('total_transferred_file_size')
+        self._eta = EtaEstimator(expected, EtaEstimator.prior_from_report(
+            RunReport.load(self.log_dir)))
+
+    def _notify(self, shard, progress=None):
+        """Update the progress of ``shard`` and inform the listeners."""
+        now = time()
+        with self._lock:
+            state = self._progress.setdefault(shard, {'bytes': 0,
+                                                      'changed': now})
+            if progress is not None:
+                if progress['bytes'] != state['bytes']:
+                    state['changed'] = now
+                state.update(progress)
+            total = sum(item['bytes'] for item in self._progress.values())
+            elapsed = now - self._transfer_started
+            idle = now - state['changed']
+            self.max_idle = max(self.max_idle, idle)
+            event = ProgressEvent(
+                self.name, shard, state['bytes'], total,
+                state.get('percent'), state.get('rate'), elapsed,
+                state.get('files_transferred'), state.get('files_remaining'),
+                state.get('files_total'), idle,
+                self._eta.estimate(total, elapsed, state.get('percent')))
+            listeners = list(self.listeners)
+        for callback in listeners:
+            try:
+                callback(event)
+            except Exception:
+                self.logger.exception("Progress listener failed.")
+
+    def _run_transfer(self, options, shard=0):
+        """Run the rsync transfer from the source into the current directory.
+
+        The console output is passed through to ``stdout``, except the
+        ``--stats`` lines which are parsed into ``self.transfer_stats``.
+        Progress lines are passed to the listeners.
+
+        * Return:
+
+            ``int``;
+            the exit code of rsync.
+        """
+        self.logger.debug(' - [_run_transfer() called.]')
+        cmd = [self.rsync_exe] + options + ['--stats', self.source,
+                                            self.current_dir]
+        stats = RsyncStats()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        sampler = RssSampler(proc.pid)
+        rest = b''
+        heartbeat = self.listeners and os.name != 'nt'
+        with proc.stdout:
+            while True:
+                if heartbeat and not select.select(
+                        [proc.stdout], [], [], self.progress_interval)[0]:
+                    self._notify(shard)
+                    continue
+                chunk = proc.stdout.read1(65536)
+                if not chunk:
+                    break
+                rest += chunk
+                *lines, rest = re.split(rb'(?<=[\r\n])', rest)
+                for line in lines:
+                    text = line.decode('utf-8', 'replace')
+                    if stats.parse_line(text):
+                        continue
+                    sys.stdout.buffer.write(line)
+                    if self.listeners:
+                        progress = RsyncProgress.parse_line(text)
+                        if progress:
+                            self._notify(shard, progress)
+                sys.stdout.flush()
+        if rest and not stats.parse_line(rest.decode('utf-8', 'replace')):
+            sys.stdout.buffer.write(rest)
+            sys.stdout.flush()
+        ret = self._wait(proc, sampler)
+        with self._lock:
+            self.transfer_stats.merge(stats)
+        return ret
+
     def _new_backup(self):
         self.logger.info("Starting backup:")
-        options = self.sync_options + ['--info=progress2']
-        out = self._run_rsync(self.source, self.current_dir, options, False)
+        self.transfer_stats = RsyncStats()
+        self._start_progress()
+        if self.engine == 'native':
+            self.transfer_stats = self.native_sync.apply(
+                self.change_log, lambda progress: self._notify(0, progress),
+                self.progress_interval)
+            self.logger.info(" -> backup finished.")
+            return True
+        if (self.single_scan or self.manifest_scan) and self.change_log:
+            if self._transfer_changes(self.change_log):
+                self._transfer_content_changes()
+                self.logger.info(" -> backup finished.")
+                return True
+            self.logger.info(" -> falling back to a full sync.")
+            # The manifest is rebuilt after the full sync.
+            self.manifest_scan = False
+        options = self.sync_options + self.scope_options + \
+            ['--info=progress2']
+        filters = self.shard_plan.filters if self.shard_plan else [[]]
+        self._check_transfer(self._parallel(
+            lambda item: self._run_transfer(options + item[1], item[0]),
+            enumerate(filters)))
+        self._transfer_content_changes()
         self.logger.info(" -> backup finished.")
-        return out
+        return True
+
+    @contextmanager
+    def _journaled_phase(self, journal, name):
+        """Measure the phase ``name`` and record its completion in the
+        journal."""
+        journal.start(name)
+        with self.report.phase(name) as data:
+            yield data
+        journal.complete(name)
+
+    def _resume(self, state):
+        """Restore the state of the interrupted run described by the
+        journal ``state``.
+
+        * Return:
+
+            ``False`` if the change logs of the run are lost and it can
+            not be resumed.
+        """
+        self.logger.debug(' - [_resume() called.]')
+        self.time_stamp = state['time_stamp']
+        self.change_log = ChangeLog.recover(self.log_dir, self.time_stamp)
+        if not self.change_log:
+            self.logger.warning("The change logs of the interrupted run " +
+                                "'{}' are lost, starting a new run.".format(
+                                    self.time_stamp))
+            return False
+        self.logger.info("Resuming the run '{}' after '{}'.".format(
+            self.time_stamp, (state['completed'] or ['dry_run'])[-1]))
+        self.scope_options = state.get('scope_options', [])
+        self.manifest_scan = state.get('manifest_scan', False)
+        self.content_changes = state.get('content_changes', [])
+        self.scan_stats = RsyncStats(state.get('scan_stats', {}))
+        self.shard_plan = ShardPlan(self.source, self.current_dir,
+                                    self.log_dir,
+                                    1 if self.scope_options else self.shards,
+                                    self.shard_by)
+        if self.watch and os.path.isdir(self.local_settings_dir):
+            self.watcher = ChangeWatcher(self.source, self.local_settings_dir)
+            self.watcher.scan_started = state.get('scan_started') or time()
+        return True
 
     def run_backup(self):
-        """Run an entire backup with the given configuration"""
+        """Run an entire backup with the given configuration.
+
+        The backup is locked for the whole run, if another process holds
+        the lock the run waits, is skipped or fails (``on_locked``).
+
+        Every phase after the dry run is recorded in a journal. If a run is
+        interrupted, the next one continues it when ``resume`` is set and
+        refuses to start otherwise.
+        """
 
         self.logger.debug("Starting backup of '{}'.".format(self.source))
+        lock = RunLock(self.log_dir, self.on_locked, self.lock_timeout)
+        if not lock.acquire():
+            return True
+        try:
+            return self._run_locked()
+        finally:
+            lock.release()
 
-        self.dry_run()
-        if not self.change_log:
+    def _run_locked(self):
+        self.report = RunReport(self.name)
+        journal = RunJournal(self.log_dir)
+        state = journal.load()
+        if state and not self.resume:
+            raise RuntimeError(("The run '{}' of '{}' was interrupted. " +
+                                "Continue it with 'rhb backup --resume'.")
+                               .format(state['time_stamp'], self.name))
+        # Change logs of a run interrupted before its journal was written.
+        for file_name in ChangeLog.discard_stray(
+                self.log_dir, state['time_stamp'] if state else None):
+            self.logger.info("Removed the unfinished change log " +
+                             "'{}'.".format(file_name))
+        try:
+            resumed = False
+            if state:
+                with self.report.phase('resume') as data:
+                    resumed = self._resume(state)
+                    data['completed'] = state['completed']
+                if resumed:
+                    self.report.time_stamp = self.time_stamp
+                else:
+                    journal.finish()
+            if not resumed:
+                with self.report.phase('dry_run') as data:
+                    self.dry_run()
+                    self.report.time_stamp = self.time_stamp
+                    data['stats'] = self.scan_stats
+                    if self.change_log:
+                        data['files'] = {kind: len(self.change_log[kind])
+                                         for kind in self.change_log}
+                if not self.change_log:
+                    if self.compare_with == 'manifest' and \
+                            not self.manifest_scan:
+                        with self.report.phase('update_manifest') as data:
+                            data['entries'] = self._update_manifest(None)
+                            data['rebuilt'] = True
+                    if self.watcher:
+                        self.watcher.finish()
+                    return True
+
+                with self.report.phase('preflight') as data:
+                    try:
+                        data.update(self.preflight(self.change_log))
+                    except OSError:
+                        self.change_log.discard()
+                        raise
+                journal.begin(self.time_stamp,
+                              scope_options=self.scope_options,
+                              manifest_scan=self.manifest_scan,
+                              scan_stats=self.scan_stats,
+                              content_changes=self.content_changes,
+                              scan_started=getattr(self.watcher,
+                                                   'scan_started', None))
+
+            if not journal.is_completed('save_file_logs'):
+                with self._journaled_phase(journal, 'save_file_logs'):
+                    self._save_file_logs(self.change_log)
+            if not journal.is_completed('move_to_history'):
+                with self._journaled_phase(journal,
+                                           'move_to_history') as data:
+                    self._move_to_history(self.change_log)
+                    if self.save_history:
+                        data['files'] = len(self.change_log['deleted']) + \
+                            len(self.change_log['changed'])
+                        data['bytes'] = self.history_stats.get(
+                            'total_transferred_file_size', 0)
+            if not journal.is_completed('new_backup'):
+                with self._journaled_phase(journal, 'new_backup') as data:
+                    self._new_backup()
+                    # A fallback to a full sync rebuilds the manifest.
+                    journal.state['manifest_scan'] = self.manifest_scan
+                    data['stats'] = self.transfer_stats
+                    data['files'] = self.transfer_stats.get(
+                        'number_of_regular_files_transferred', 0)
+                    data['bytes'] = self.transfer_stats.get(
+                        'total_transferred_file_size', 0)
+                    data['max_idle'] = round(self.max_idle, 3)
+            if self.compare_with == 'manifest' and \
+                    not journal.is_completed('update_manifest'):
+                with self._journaled_phase(journal,
+                                           'update_manifest') as data:
+                    data['entries'] = self._update_manifest(self.change_log)
+                    data['rebuilt'] = not self.manifest_scan
+            if self.change_detection == 'content' and \
+                    not journal.is_completed('update_checksums'):
+                with self._journaled_phase(journal,
+                                           'update_checksums') as data:
+                    data['files'] = self._update_checksums(self.change_log)
+            if self.delta_threshold and \
+                    not journal.is_completed('delta_history'):
+                with self._journaled_phase(journal, 'delta_history') as data:
+                    data['saved_bytes'] = self._delta_encode_history(
+                        self.change_log)
+            if self.pack_threshold and \
+                    not journal.is_completed('pack_history'):
+                with self._journaled_phase(journal, 'pack_history') as data:
+                    data['files'] = self._pack_history(self.change_log)
+            journal.finish()
+            if self.watcher:
+                self.watcher.finish()
+            # self.logger.debug('Backup finished.')
             return True
+        finally:
+            self._save_report()
 
-        self._save_file_logs(self.change_log)
-        self._move_to_history(self.change_log)
-        self._new_backup()
-        # self.logger.debug('Backup finished.')
-        return True
+    def _save_report(self):
+        """Write the run report into the log directory and, if configured,
+        into the Prometheus textfile collector file."""
+        if not self.report.time_stamp:
+            return
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        path = self.report.save(self.log_dir)
+        self.logger.debug("Run report written: {}".format(path))
+        if self.prometheus_file:
+            self.report.write_prometheus(
+                self.prometheus_file.format(name=self.name))
 
     def dry_run(self):
         """Start a dry run which only shows the changes since the last backup.
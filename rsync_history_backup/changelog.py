@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import threading
+
+
+class ChangeList:
+    """File backed list of the paths of one change type.
+
+    Only the number of entries is kept in memory, iterating reads the
+    entries back from the log file.
+    """
+
+    def __init__(self, path, count=None):
+        self.path = path
+        self.count = count if count is not None else sum(1 for _ in self)
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8',
+                  errors='surrogateescape') as fl:
+            for line in fl:
+                line = line.rstrip('\n')
+                if line:
+                    yield line
+
+
+class ChangeLog:
+    """Change log of a single backup run.
+
+    The rsync dry run output is classified line by line into created,
+    deleted and changed entries, which are written straight into the
+    ``<time_stamp>.<kind>`` files of the log directory. While the run is in
+    progress the files carry a ``.part`` suffix, :meth:`save` publishes them
+    and :meth:`discard` removes them again.
+
+    It can be used like the former ``dict`` of lists: ``change_log[kind]``
+    returns a :class:`ChangeList`.
+    """
+    KINDS = ('created', 'deleted', 'changed')
+    REGS = {
+        'created': re.compile(r'^[\>fcd]{2}[\.\+]{9}\|(.*)\|'),
+        'deleted': re.compile(r'^\*deleting  \|(.*)\|'),
+        'changed': re.compile(r'^[\>f\.st]{11}\|(.*)\|')
+    }
+    IGNORE = '.d..t......|./|'
+
+    def __init__(self, directory, time_stamp, keep_raw=False):
+        self.directory = directory
+        self.time_stamp = time_stamp
+        self.keep_raw = keep_raw
+        self.counts = {kind: 0 for kind in self.KINDS}
+        self.lines = 0
+        self._files = {}
+        self._lock = threading.Lock()
+        self.saved = False
+
+    @classmethod
+    def load(cls, directory, time_stamp):
+        """Open the saved change log of the run ``time_stamp``."""
+        res = cls(directory, time_stamp)
+        for kind in cls.KINDS:
+            res.counts[kind] = len(ChangeList(res.path(kind, final=True)))
+        res.lines = len(res)
+        res.saved = True
+        return res
+
+    @classmethod
+    def runs(cls, directory):
+        """Returns the sorted time stamps of the runs with saved change
+        logs in ``directory``."""
+        res = set()
+        if os.path.isdir(directory):
+            for file_name in os.listdir(directory):
+                stem, _, kind = file_name.rpartition('.')
+                if kind in cls.KINDS:
+                    res.add(stem)
+        return sorted(res)
+
+    @classmethod
+    def changes(cls, directory, time_stamp, prefix=''):
+        """Returns a ``dict`` mapping the paths changed by the run
+        ``time_stamp`` (below ``prefix``) to their change type."""
+        res = {}
+        for kind in cls.KINDS:
+            path = os.path.join(directory, '{}.{}'.format(time_stamp, kind))
+            for entry in ChangeList(path):
+                if not prefix or entry == prefix or \
+                        entry.startswith(prefix.rstrip('/') + '/'):
+                    res[entry] = kind
+        return res
+
+    @staticmethod
+    def merge(older, newer):
+        """Combine the changes of two consecutive runs.
+
+        * Parameters:
+
+            :older:
+                ``dict``;
+                paths of the first run mapped to their change type.
+
+            :newer:
+                ``dict``;
+                paths of the second run mapped to their change type.
+
+        * Return:
+
+            ``dict``;
+            the changes from before the first until after the second run.
+        """
+        res = dict(older)
+        for entry, kind in newer.items():
+            first = res.get(entry)
+            if first == 'created' and kind == 'deleted':
+                del res[entry]
+            elif first == 'created':
+                continue
+            elif first == 'deleted' and kind == 'created':
+                res[entry] = 'changed'
+            else:
+                res[entry] = kind
+        return res
+
+    @classmethod
+    def recover(cls, directory, time_stamp):
+        """Publish the log files of an interrupted :meth:`save` and open
+        the change log of the run ``time_stamp``."""
+        res = cls(directory, time_stamp)
+        res.save()
+        return cls.load(directory, time_stamp)
+
+    @classmethod
+    def discard_stray(cls, directory, time_stamp=None):
+        """Remove the unpublished log files (``<ts>.<kind>.part``) of all
+        runs but ``time_stamp``, left by runs which were interrupted before
+        they could be resumed.
+
+        * Return:
+
+            ``list`` of the removed file names.
+        """
+        res = []
+        if not os.path.isdir(directory):
+            return res
+        for file_name in os.listdir(directory):
+            stem, _, suffix = file_name.rpartition('.')
+            run, _, kind = stem.rpartition('.')
+            if suffix == 'part' and kind in cls.KINDS + ('dryrun',) and \
+                    run != time_stamp:
+                os.remove(os.path.join(directory, file_name))
+                res.append(file_name)
+        return res
+
+    def path(self, kind, final=None):
+        """Returns the path of the log file of the given ``kind``."""
+        final = self.saved if final is None else final
+        return os.path.join(self.directory, '{}.{}{}'.format(
+            self.time_stamp, kind, '' if final else '.part'))
+
+    def _write(self, kind, entry):
+        if kind not in self._files:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self._files[kind] = open(self.path(kind), 'w', encoding='utf-8',
+                                     errors='surrogateescape')
+        self._files[kind].write(entry + '\n')
+
+    def add(self, kind, entry):
+        """Append ``entry`` to the list of the given ``kind``."""
+        with self._lock:
+            self._write(kind, entry)
+            self.counts[kind] += 1
+
+    def record(self, kind, entry, item):
+        """Add a change found without rsync (see
+        :class:`~rsync_history_backup.engine.NativeSync`).
+
+        ``kind`` is ``None`` for changes which are not logged (e.g.
+        directory time stamps), ``item`` the equivalent rsync itemize flags
+        for the ``dryrun`` log.
+        """
+        with self._lock:
+            self.lines += 1
+            if self.keep_raw:
+                self._write('dryrun', '{}|{}|'.format(item, entry))
+        if kind:
+            self.add(kind, entry)
+
+    def parse_line(self, line):
+        """Classify one line of rsync's itemized output.
+
+        * Return:
+
+            The change type of the line or ``None`` if it is not a change.
+        """
+        line = line.rstrip('\n')
+        if not line or line == self.IGNORE:
+            return None
+        with self._lock:
+            self.lines += 1
+            if self.keep_raw:
+                self._write('dryrun', line)
+        for kind in self.KINDS:
+            match = self.REGS[kind].match(line)
+            if match and match.group(1):
+                self.add(kind, match.group(1))
+                return kind
+        return None
+
+    def flush(self):
+        """Write the buffered entries, so the lists can be read while the
+        change log is still open."""
+        with self._lock:
+            for fl in self._files.values():
+                fl.flush()
+
+    def close(self):
+        with self._lock:
+            for fl in self._files.values():
+                fl.close()
+            self._files = {}
+
+    def save(self):
+        """Publish the log files under their final names."""
+        self.close()
+        if self.saved:
+            return
+        for kind in self.KINDS + ('dryrun',):
+            if os.path.isfile(self.path(kind, final=False)):
+                os.replace(self.path(kind, final=False),
+                           self.path(kind, final=True))
+        self.saved = True
+
+    def discard(self):
+        """Remove the unpublished log files."""
+        self.close()
+        if self.saved:
+            return
+        for kind in self.KINDS + ('dryrun',):
+            if os.path.isfile(self.path(kind, final=False)):
+                os.remove(self.path(kind, final=False))
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def __bool__(self):
+        # Unclassified lines (e.g. directory time stamps) still need a sync.
+        return self.lines > 0
+
+    def __iter__(self):
+        return iter(self.KINDS)
+
+    def keys(self):
+        return list(self.KINDS)
+
+    def __getitem__(self, kind):
+        if kind not in self.KINDS:
+            raise KeyError(kind)
+        return ChangeList(self.path(kind), self.counts[kind])
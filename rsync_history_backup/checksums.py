@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from rsync_history_backup.dedup import ObjectStore
+
+
+class SourceChecksums:
+    """Checksum cache of the source files of a backup.
+
+    Maps the path of every regular file of the source to its inode, size,
+    modification time, ctime and the sha256 digest of its content in
+    ``current``. Any write to a file changes its ctime, also if the
+    modification time is restored afterwards, so a file whose metadata
+    matches its row needs no hashing. Only files whose metadata changed
+    are hashed again and, if their digest differs although rsync's quick
+    check (size and modification time) considers them unchanged, reported
+    as changed.
+
+    A cache belongs to one backup, several backups of a source may be at
+    different states.
+
+    * Parameters:
+
+        :path:
+            ``string``;
+            path to the SQLite database of the cache.
+
+        :workers:
+            ``int``;
+            number of threads hashing files in parallel.
+    """
+
+    def __init__(self, path, workers=None):
+        self.logger = logging.getLogger("rhb.SourceChecksums")
+        self.path = path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.workers = workers or os.cpu_count() or 1
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (" +
+                        "path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, " +
+                        "mtime INTEGER, ctime INTEGER, digest TEXT) " +
+                        "WITHOUT ROWID")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _meta(st):
+        return st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+    def load(self):
+        """Returns a ``dict`` mapping the paths to ``(ino, size, mtime,
+        ctime, digest)``."""
+        return {row[0]: row[1:] for row in self.db.execute(
+            "SELECT path, ino, size, mtime, ctime, digest FROM files")}
+
+    def record(self, rows):
+        """Store ``(path, ino, size, mtime, ctime, digest)`` rows."""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES " +
+                                "(?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, paths):
+        """Remove the rows of ``paths``, folders (ending with ``/``) with
+        everything below them."""
+        with self.db:
+            for path in paths:
+                if path.endswith('/'):
+                    self.db.execute("DELETE FROM files WHERE path >= ? " +
+                                    "AND path < ?",
+                                    (path, path[:-1] + chr(ord('/') + 1)))
+                else:
+                    self.db.execute("DELETE FROM files WHERE path = ?",
+                                    (path,))
+
+    @staticmethod
+    def walk(source, exclude=None, paths=None):
+        """Yield ``(path, stat)`` of the regular files of ``source`` (below
+        ``paths`` if given), leaving out excluded paths and ``.rhb``."""
+        stack = [p.strip('/') for p in paths] if paths is not None else ['']
+        while stack:
+            path = stack.pop()
+            full = os.path.join(source, path)
+            if path:
+                try:
+                    st = os.lstat(full)
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    yield path, st
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    continue
+            try:
+                names = os.listdir(full)
+            except OSError:
+                continue
+            for name in names:
+                sub = os.path.join(path, name) if path else name
+                if sub == '.rhb' or exclude and exclude.excluded(
+                        sub, os.path.isdir(os.path.join(source, sub)) and
+                        not os.path.islink(os.path.join(source, sub))):
+                    continue
+                stack.append(sub)
+
+    def _hash(self, path):
+        try:
+            return ObjectStore.hash_file(path)
+        except OSError as e:
+            self.logger.debug("Hashing '{}' failed: {}".format(path, e))
+            return None
+
+    def check(self, source, current, skip=(), exclude=None, paths=None):
+        """Find the files of ``source`` whose content differs from
+        ``current`` although size and modification time are equal.
+
+        Files in ``skip`` (changes found already) are left out. Files
+        without a row are compared with their copy in ``current``, files
+        whose metadata changed with the digest of their row. Rows of
+        unchanged content are updated right away.
+
+        * Return:
+
+            ``list`` of the changed paths.
+        """
+        self.logger.debug(' - [check() called.]')
+        known = self.load()
+        seen, todo = set(), []
+        for path, st in self.walk(source, exclude, paths):
+            seen.add(path)
+            if path in skip:
+                continue
+            row = known.get(path)
+            if row is None or row[:4] != self._meta(st):
+                todo.append((path, st, row))
+        if paths is None:
+            gone = set(known).difference(seen)
+            if gone:
+                self.remove(gone)
+
+        def work(item):
+            path, st, row = item
+            full = os.path.join(source, path)
+            digest = self._hash(full)
+            try:
+                after = os.lstat(full)
+            except FileNotFoundError:
+                return path, None, None, None
+            if digest is None or self._meta(after) != self._meta(st):
+                # Unreadable or modified while hashing, rsync sees the
+                # latter.
+                return path, None, None, None
+            if row is not None and row[1:3] == (st.st_size, st.st_mtime_ns):
+                return path, st, digest, row[4]
+            try:
+                target_st = os.lstat(os.path.join(current, path))
+            except FileNotFoundError:
+                return path, None, None, None
+            if (target_st.st_size, target_st.st_mtime_ns // 10**9) != \
+                    (st.st_size, st.st_mtime_ns // 10**9):
+                # rsync reports it if it differs in size or time.
+                return path, None, None, None
+            return path, st, digest, self._hash(os.path.join(current, path))
+
+        changed, rows = [], []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for path, st, digest, expected in pool.map(work, todo):
+                if digest is None or expected is None:
+                    continue
+                if digest != expected:
+                    changed.append(path)
+                else:
+                    rows.append((path,) + self._meta(st) + (digest,))
+        self.record(rows)
+        self.logger.info(" -> {} file(s) hashed, {} changed.".format(
+            len(todo), len(changed)))
+        return sorted(changed)
+
+    def update(self, source, current, entries, deleted=(), since=None):
+        """Record the digests of the transferred ``entries`` from their
+        copy in ``current`` and remove the rows of ``deleted`` entries.
+
+        A row is only recorded if the source file still has the size and
+        modification time of the copy and its ctime is older than ``since``
+        (the start of the run, in ns), i.e. it was not written after the
+        dry run.
+
+        * Return:
+
+            ``int``;
+            number of recorded rows.
+        """
+        self.logger.debug(' - [update() called.]')
+        self.remove(list(deleted))
+        files = [entry for entry in entries if not entry.endswith('/')]
+
+        def work(entry):
+            try:
+                st = os.lstat(os.path.join(source, entry))
+                target_st = os.lstat(os.path.join(current, entry))
+            except FileNotFoundError:
+                return None
+            if not stat.S_ISREG(st.st_mode) or \
+                    (since is not None and st.st_ctime_ns >= since) or \
+                    (target_st.st_size, target_st.st_mtime_ns // 10**9) != \
+                    (st.st_size, st.st_mtime_ns // 10**9):
+                return None
+            digest = self._hash(os.path.join(current, entry))
+            return (entry,) + self._meta(st) + (digest,) if digest else None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            rows = [row for row in pool.map(work, files) if row]
+        recorded = {row[0] for row in rows}
+        self.remove([entry for entry in files if entry not in recorded])
+        self.record(rows)
+        return len(rows)
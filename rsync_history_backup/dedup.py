@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ObjectStore:
+    """Content addressed store for history files.
+
+    Every unique file content is stored once as ``objects/<aa>/<sha256>``
+    in the destination and hard linked into the history snapshots of all
+    backups sharing this destination. Hard links share their metadata, so
+    identical files in different snapshots also share mode and mtime.
+
+    * Parameters:
+
+        :destination:
+            ``string``;
+            path to the backup destination.
+
+        :workers:
+            ``int``;
+            number of threads hashing files in parallel (``hashlib``
+            releases the GIL while hashing).
+    """
+    CHUNK_SIZE = 1024**2
+
+    def __init__(self, destination, workers=None):
+        self.logger = logging.getLogger("rhb.ObjectStore")
+        self.path = os.path.join(destination, 'objects')
+        self.workers = workers or os.cpu_count() or 1
+
+    @classmethod
+    def hash_file(cls, path):
+        """Returns the sha256 hex digest of the file ``path``."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fl:
+            for chunk in iter(lambda: fl.read(cls.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def hash_files(self, paths):
+        """Hash ``paths`` in parallel.
+
+        * Return:
+
+            ``list`` of ``(path, digest)`` tuples, ``digest`` is ``None`` if
+            the file could not be read.
+        """
+        def work(path):
+            try:
+                return path, self.hash_file(path)
+            except OSError as e:
+                self.logger.debug("Hashing '{}' failed: {}".format(path, e))
+                return path, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(work, paths))
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def add(self, path, digest):
+        """Add the file ``path`` with the content ``digest`` to the store by
+        hard linking it, unless the content is stored already.
+
+        * Return:
+
+            ``string``;
+            path to the object.
+        """
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                os.link(path, obj)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return obj
+
+    def link(self, digest, target):
+        """Hard link the object ``digest`` to ``target``."""
+        os.link(self.object_path(digest), target)
+
+    def gc(self):
+        """Remove objects which are not linked from any snapshot anymore.
+
+        * Return:
+
+            ``tuple`` of the number of removed objects and freed bytes.
+        """
+        count, size = 0, 0
+        if not os.path.isdir(self.path):
+            return count, size
+        for prefix in os.listdir(self.path):
+            directory = os.path.join(self.path, prefix)
+            for name in os.listdir(directory):
+                obj = os.path.join(directory, name)
+                st = os.lstat(obj)
+                if st.st_nlink == 1:
+                    os.remove(obj)
+                    count += 1
+                    size += st.st_size
+        self.logger.debug("{} object(s) removed.".format(count))
+        return count, size
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import logging
+import subprocess
+
+
+class Delta:
+    """Reverse delta encoding of history files with rsync batch files.
+
+    An older version of a file is stored as ``<name>.rhb-delta``, an rsync
+    batch which turns the next newer version (the next history snapshot
+    containing the file or ``current/``) back into the older one.
+    """
+    SUFFIX = '.rhb-delta'
+    logger = logging.getLogger("rhb.Delta")
+
+    @classmethod
+    def encode(cls, old_file, new_file, rsync_exe='rsync', min_saving=0.1):
+        """Replace ``old_file`` by a delta against ``new_file``.
+
+        Both files need the same base name. The delta is only kept if it
+        saves at least ``min_saving`` of the file size.
+
+        * Return:
+
+            ``int``;
+            the number of bytes saved.
+        """
+        batch = old_file + cls.SUFFIX
+        new_dir = os.path.dirname(new_file) + '/'
+        subprocess.check_call(
+            [rsync_exe, '--only-write-batch={}'.format(batch),
+             '--no-whole-file', '--ignore-times', '--times', '--perms',
+             old_file, new_dir], stdout=subprocess.DEVNULL)
+        if os.path.isfile(batch + '.sh'):
+            os.remove(batch + '.sh')
+        old_size = os.path.getsize(old_file)
+        saved = old_size - os.path.getsize(batch)
+        if saved < old_size * min_saving:
+            os.remove(batch)
+            return 0
+        os.remove(old_file)
+        return saved
+
+    @classmethod
+    def decode(cls, batch, base_file, target_dir, rsync_exe='rsync'):
+        """Rebuild the version stored in ``batch`` from ``base_file``.
+
+        * Return:
+
+            ``string``;
+            path of the rebuilt file in ``target_dir``.
+        """
+        target = os.path.join(target_dir, os.path.basename(base_file))
+        if os.path.abspath(base_file) != os.path.abspath(target):
+            shutil.copy2(base_file, target)
+        subprocess.check_call(
+            [rsync_exe, '--read-batch={}'.format(batch), target_dir + '/'],
+            stdout=subprocess.DEVNULL)
+        return target
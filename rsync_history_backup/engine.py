@@ -0,0 +1,683 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import stat
+import errno
+import shutil
+import logging
+import threading
+from time import time
+from tempfile import mkstemp
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from rsync_history_backup.report import RsyncStats
+try:
+    import fcntl
+except ImportError:       # Windows
+    fcntl = None
+
+FICLONE = 0x40049409
+
+# rsync's short options without an argument and their long names.
+SHORT_OPTIONS = {
+    'a': ('--recursive', '--links', '--perms', '--times', '--group',
+          '--owner', '--devices', '--specials'),
+    'r': ('--recursive',), 'l': ('--links',), 'p': ('--perms',),
+    't': ('--times',), 'g': ('--group',), 'o': ('--owner',),
+    'D': ('--devices', '--specials'), 'u': ('--update',),
+    'x': ('--one-file-system',), 'v': ('--verbose',), 'q': ('--quiet',),
+    'h': ('--human-readable',), 'i': ('--itemize-changes',),
+    'z': ('--compress',), 'P': ('--partial', '--progress'),
+    'H': ('--hard-links',), 'A': ('--acls',), 'X': ('--xattrs',),
+    'E': ('--executability',), 'S': ('--sparse',), 'W': ('--whole-file',),
+    'c': ('--checksum',), 'd': ('--dirs',), 'L': ('--copy-links',),
+    'k': ('--copy-dirlinks',), 'K': ('--keep-dirlinks',),
+    'O': ('--omit-dir-times',), 'J': ('--omit-link-times',),
+    'm': ('--prune-empty-dirs',), 'C': ('--cvs-exclude',),
+    'I': ('--ignore-times',), 'b': ('--backup',), 'R': ('--relative',),
+    's': ('--protect-args',), '8': ('--8-bit-output',),
+}
+
+
+class ExcludeFilter:
+    """rsync filter rules of ``--exclude``, ``--include`` and
+    ``--exclude-from`` options (e.g. the ``rsync-ignore.txt``).
+
+    Supported are the rsync pattern rules: a leading ``/`` anchors the
+    pattern at the source, a trailing ``/`` only matches directories,
+    patterns without ``/`` match the last path component, ``*`` and ``?``
+    do not match ``/`` while ``**`` does. ``+ `` and ``- `` prefixes, ``!``
+    and comments (``#``, ``;``) are understood. The first matching rule
+    wins.
+
+    * Parameters:
+
+        :rules:
+            ``list``;
+            ``(include, pattern)`` tuples.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = []
+        for include, pattern in rules:
+            self.add(include, pattern)
+
+    @classmethod
+    def from_options(cls, options):
+        """Collect the filter rules of rsync ``options``."""
+        res = cls()
+        for opt in options:
+            if opt.startswith('--exclude-from='):
+                res.load(opt.split('=', 1)[1])
+            elif opt.startswith('--include-from='):
+                res.load(opt.split('=', 1)[1], include=True)
+            elif opt.startswith('--exclude='):
+                res.add(False, opt.split('=', 1)[1])
+            elif opt.startswith('--include='):
+                res.add(True, opt.split('=', 1)[1])
+        return res
+
+    def load(self, path, include=False):
+        with open(path, 'r', encoding='utf-8', errors='surrogateescape') as fl:
+            for line in fl:
+                line = line.rstrip('\n')
+                if not line.strip() or line[0] in '#;':
+                    continue
+                if line.strip() == '!':
+                    self.rules = []
+                elif line[:2] in ('+ ', '- '):
+                    self.add(line[0] == '+', line[2:])
+                else:
+                    self.add(include, line)
+
+    @staticmethod
+    def _translate(pattern):
+        res, i = '', 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith('**', i):
+                res += '.*'
+                i += 2
+                continue
+            if char == '*':
+                res += '[^/]*'
+            elif char == '?':
+                res += '[^/]'
+            elif char == '[':
+                # A leading '!' (or '^') negates the class, a ']' right
+                # after it or the '[' is a literal.
+                start = i + 1
+                negate = pattern[start:start + 1] in ('!', '^')
+                start += negate
+                end = pattern.find(']', start + 1)
+                if end < 0:
+                    res += re.escape(char)
+                else:
+                    res += '[' + ('^' if negate else '') + re.sub(
+                        r'([\\\[\]^])', r'\\\1', pattern[start:end]) + ']'
+                    i = end
+            elif char == '\\' and i + 1 < len(pattern):
+                i += 1
+                res += re.escape(pattern[i])
+            else:
+                res += re.escape(char)
+            i += 1
+        return res
+
+    def add(self, include, pattern):
+        """Add a rule, ``include`` rules protect paths from later
+        excludes."""
+        if pattern.endswith('/***'):
+            pattern = pattern[:-4]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            return
+        anchored = pattern.startswith('/')
+        regex = self._translate(pattern.lstrip('/'))
+        regex = ('^' if anchored else '(?:^|/)') + regex + '$'
+        self.rules.append((include, re.compile(regex, re.S), dir_only))
+
+    def excluded(self, path, is_dir=False):
+        """Check if ``path`` (relative to the source) is excluded."""
+        for include, regex, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(path):
+                return not include
+        return False
+
+    def __bool__(self):
+        return bool(self.rules)
+
+
+class NativeSync:
+    """In-process replacement of rsync for local backups.
+
+    Compares a source and a target tree by type, size and modification time
+    (like rsync without ``--checksum``), walking directories in parallel
+    with ``os.scandir``. Files are copied into a temporary file next to the
+    target and renamed over it, so hard linked history versions are never
+    modified. Data is cloned with a reflink where the file system supports
+    it, otherwise copied in the kernel with ``os.copy_file_range`` or
+    ``os.sendfile``.
+
+    The semantic of these rsync ``options`` is honoured: ``--update``,
+    ``--delete`` (excluded files are kept), ``--links``, ``--safe-links``,
+    ``--owner``/``--group`` (as root), ``--times``, ``--one-file-system``
+    and the filter rules, also given as short options (``-a``, ``-rt``).
+    Devices and other special files are skipped.
+
+    * Parameters:
+
+        :source:
+            ``string``;
+            path to the source directory.
+
+        :target:
+            ``string``;
+            path to the target directory.
+
+        :options:
+            ``list``;
+            rsync options of the backup.
+
+        :workers:
+            ``int``;
+            number of threads scanning and copying.
+
+        :manifest:
+            ``CurrentIndex``;
+            compare the source with this metadata manifest instead of the
+            target tree. Folder attributes are not compared then.
+    """
+    ITEMS = {
+        'created': '>f+++++++++',
+        'created_dir': 'cd+++++++++',
+        'created_link': 'cL+++++++++',
+        'changed': '>f.st......',
+        'changed_link': 'cL.st......',
+        'deleted': '*deleting  ',
+        'dir': '.d..t......'
+    }
+
+    def __init__(self, source, target, options=(), workers=None,
+                 manifest=None):
+        self.logger = logging.getLogger("rhb.NativeSync")
+        self.source = source.rstrip('/')
+        self.target = target.rstrip('/')
+        self.options = self.expand_options(options)
+        self.filter = ExcludeFilter.from_options(options)
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self.delete = any(opt.startswith('--delete') for opt in self.options)
+        self.chown = '--owner' in self.options and hasattr(os, 'geteuid') \
+            and os.geteuid() == 0
+        self.manifest = manifest
+        self.dirs = set()
+        self._reflink = fcntl is not None
+        self._copy_range = hasattr(os, 'copy_file_range')
+        self._sendfile = hasattr(os, 'sendfile')
+        self._lock = threading.Lock()
+        self._root_dev = None
+
+    @staticmethod
+    def expand_options(options):
+        """Returns the ``set`` of the long names of the rsync ``options``.
+
+        Short options, also combined ones like ``-a`` or ``-rt``, are
+        replaced by their long names and ``--no-<option>`` removes an
+        option given before, as rsync reads them.
+
+        * Raises:
+
+            ``ValueError`` for short options which take an argument or are
+            not known, their effect on the sync can not be honoured.
+        """
+        res = set()
+        for opt in options:
+            if opt.startswith('--no-'):
+                res.discard('--' + opt[5:])
+            elif opt.startswith('--') or not opt.startswith('-'):
+                res.add(opt)
+            else:
+                for char in opt[1:]:
+                    if char not in SHORT_OPTIONS:
+                        raise ValueError(
+                            "Unknown rsync option '-{}' in '{}'.".format(
+                                char, opt))
+                    res.update(SHORT_OPTIONS[char])
+        return res
+
+    # ------------------------- scan ------------------------- #
+
+    @staticmethod
+    def _list(path):
+        """Returns the ``lstat`` results of the entries of ``path`` by
+        name."""
+        res = {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        res[entry.name] = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        pass
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return res
+
+    @staticmethod
+    def _lstat(path):
+        try:
+            return os.lstat(path)
+        except FileNotFoundError:
+            return None
+
+    def _target_list(self, path):
+        if self.manifest is not None:
+            return self.manifest.children(path)
+        return self._list(os.path.join(self.target, path))
+
+    def _target_stat(self, path):
+        if self.manifest is not None:
+            return self.manifest.stat(path)
+        return self._lstat(os.path.join(self.target, path))
+
+    def _unsafe_link(self, path):
+        """Check ``--safe-links``: absolute links and links pointing out
+        of the source tree are ignored."""
+        if '--safe-links' not in self.options:
+            return False
+        link = os.readlink(os.path.join(self.source, path))
+        if link.startswith('/'):
+            return True
+        depth = path.count('/')
+        for part in link.split('/'):
+            depth += -1 if part == '..' else 0 if part in ('', '.') else 1
+            if depth < 0:
+                return True
+        return False
+
+    def _usable(self, path, st):
+        """Check if the source entry ``path`` is synced at all."""
+        if st is None:
+            return False
+        if stat.S_ISLNK(st.st_mode):
+            return '--links' in self.options and not self._unsafe_link(path)
+        if stat.S_ISREG(st.st_mode):
+            return True
+        if stat.S_ISDIR(st.st_mode):
+            return '--recursive' in self.options or not path
+        self.logger.debug("Skipping special file '{}'.".format(path))
+        return False
+
+    def _differs(self, s, d, path):
+        if stat.S_IFMT(s.st_mode) != stat.S_IFMT(d.st_mode):
+            return True
+        if stat.S_ISLNK(s.st_mode) and self.manifest is None:
+            return os.readlink(os.path.join(self.source, path)) != \
+                os.readlink(os.path.join(self.target, path))
+        if '--update' in self.options and d.st_mtime_ns > s.st_mtime_ns:
+            return False
+        return s.st_size != d.st_size or \
+            s.st_mtime_ns // 10**9 != d.st_mtime_ns // 10**9
+
+    def _deleted_tree(self, path, items):
+        """Add every entry below the target directory ``path`` as
+        deleted."""
+        if self.manifest is not None:
+            for entry, meta in self.manifest.below(path):
+                items.append(('deleted', entry + (
+                    '/' if stat.S_ISDIR(meta.st_mode) else ''),
+                    self.ITEMS['deleted'], 0))
+            return
+        for dirpath, dirs, files in os.walk(os.path.join(self.target, path)):
+            rel = os.path.relpath(dirpath, self.target)
+            for name in dirs:
+                items.append(('deleted', os.path.join(rel, name) + '/',
+                              self.ITEMS['deleted'], 0))
+            for name in files:
+                items.append(('deleted', os.path.join(rel, name),
+                              self.ITEMS['deleted'], 0))
+
+    def _compare(self, path, s, d):
+        """Compare the source entry ``s`` and the target entry ``d`` of
+        ``path``.
+
+        * Return:
+
+            ``tuple`` of the items (``(kind, path, rsync item, size)``
+            tuples, kind ``None`` for directory attributes) and the sub
+            directories to compare.
+        """
+        items, subdirs = [], []
+        s_dir = s is not None and stat.S_ISDIR(s.st_mode)
+        d_dir = d is not None and stat.S_ISDIR(d.st_mode)
+        if self.filter and self.filter.excluded(path, s_dir or d_dir):
+            return items, subdirs
+        if not self._usable(path, s):
+            s, s_dir = None, False
+        if d is not None and (s is None or not s_dir and d_dir or
+                              s_dir and not d_dir):
+            if not self.delete:
+                return items, subdirs
+            if d_dir:
+                self._deleted_tree(path, items)
+            items.append(('deleted', path + ('/' if d_dir else ''),
+                          self.ITEMS['deleted'], 0))
+            d = None
+        if s is None:
+            return items, subdirs
+        if s_dir:
+            if d is None:
+                items.append(('created', path + '/', self.ITEMS['created_dir'],
+                              0))
+            elif self.manifest is None and (s.st_mtime_ns != d.st_mtime_ns or
+                                            s.st_mode != d.st_mode):
+                items.append((None, path + '/', self.ITEMS['dir'], 0))
+                with self._lock:
+                    self.dirs.add(path)
+            if '--one-file-system' not in self.options or \
+                    s.st_dev == self._root_dev:
+                subdirs.append(path)
+        elif d is None or self._differs(s, d, path):
+            kind = 'created' if d is None else 'changed'
+            link = stat.S_ISLNK(s.st_mode)
+            items.append((kind, path, self.ITEMS[kind + '_link' if link
+                                                 else kind],
+                          0 if link else s.st_size))
+        return items, subdirs
+
+    def _compare_dir(self, path):
+        prefix = path + '/' if path else ''
+        src = self._list(os.path.join(self.source, path))
+        dst = self._target_list(path)
+        items, subdirs = [], []
+        for name in sorted(set(src) | set(dst)):
+            res = self._compare(prefix + name, src.get(name), dst.get(name))
+            items += res[0]
+            subdirs += res[1]
+        return items, subdirs, src
+
+    def _excluded_parent(self, path):
+        """Check if a parent directory of ``path`` is excluded, a scan
+        starting below it would enter the excluded tree otherwise."""
+        parts = path.split('/')[:-1]
+        return bool(self.filter) and any(
+            self.filter.excluded('/'.join(parts[:i]), True)
+            for i in range(1, len(parts) + 1))
+
+    def scan(self, paths=None):
+        """Compare the source with the target.
+
+        * Parameters:
+
+            :paths:
+                ``list``;
+                restrict the scan to these paths (and everything below
+                them), ``None`` for the whole tree.
+
+        * Return:
+
+            ``tuple`` of the sorted ``list`` of ``(kind, path, rsync item,
+            size)`` tuples (``kind`` is ``created``, ``changed``,
+            ``deleted`` or ``None`` for directory attributes, folders end
+            with ``/``) and the ``RsyncStats`` of the scan.
+        """
+        self.logger.debug(' - [scan() called.]')
+        self._root_dev = os.stat(self.source).st_dev
+        items, files, size = {}, 0, 0
+
+        def collect(found, listing=None):
+            nonlocal files, size
+            for item in found:
+                items[item[1]] = item
+            for st in (listing or {}).values():
+                files += 1
+                size += st.st_size if stat.S_ISREG(st.st_mode) else 0
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            if paths is None:
+                pending = {pool.submit(self._compare_dir, '')}
+            else:
+                pending = set()
+                for path in paths:
+                    path = path.strip('/')
+                    if self._excluded_parent(path):
+                        continue
+                    found, subdirs = self._compare(
+                        path, self._lstat(os.path.join(self.source, path)),
+                        self._target_stat(path))
+                    collect(found)
+                    pending |= {pool.submit(self._compare_dir, sub)
+                                for sub in subdirs}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found, subdirs, listing = future.result()
+                    collect(found, listing)
+                    pending |= {pool.submit(self._compare_dir, sub)
+                                for sub in subdirs}
+
+        res = sorted(items.values(), key=lambda item: item[1])
+        transferred = [item for item in res
+                       if item[0] in ('created', 'changed') and
+                       not item[1].endswith('/')]
+        stats = RsyncStats(
+            number_of_files=files, total_file_size=size,
+            number_of_regular_files_transferred=len(transferred),
+            total_transferred_file_size=sum(item[3] for item in transferred))
+        return res, stats
+
+    # ------------------------- copy ------------------------- #
+
+    def _copy_data(self, fsrc, fdst, size):
+        """Copy the content of ``fsrc`` to ``fdst``, cloning, copying in
+        the kernel or in user space, whatever works first."""
+        if self._reflink:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                # No reflink support (or another device), don't try again.
+                self._reflink = False
+        offset = 0
+        if self._copy_range:
+            try:
+                while offset < size:
+                    sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                              size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+                self._copy_range = False
+        if self._sendfile and offset < size:
+            try:
+                while offset < size:
+                    sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset,
+                                       size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                self._sendfile = False
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        shutil.copyfileobj(fsrc, fdst, 1024**2)
+
+    def _set_attributes(self, path, st, fd=None):
+        if self.chown:
+            try:
+                if fd is not None:
+                    os.fchown(fd, st.st_uid, st.st_gid)
+                else:
+                    os.lchown(path, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+        if stat.S_ISLNK(st.st_mode):
+            if os.utime in os.supports_follow_symlinks:
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns),
+                         follow_symlinks=False)
+            return
+        if fd is not None:
+            # The caller sets the times once all data is written.
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            return
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def copy_file(self, src, dst):
+        """Copy the file or symlink ``src`` to ``dst`` with its attributes.
+
+        * Return:
+
+            ``int``;
+            number of copied bytes.
+        """
+        st = os.lstat(src)
+        directory = os.path.dirname(dst)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = mkstemp(prefix='.' + os.path.basename(dst) + '.',
+                          dir=directory)
+        try:
+            if stat.S_ISLNK(st.st_mode):
+                os.close(fd)
+                os.remove(tmp)
+                os.symlink(os.readlink(src), tmp)
+                self._set_attributes(tmp, st)
+            else:
+                with open(src, 'rb') as fsrc, os.fdopen(fd, 'wb') as fdst:
+                    self._copy_data(fsrc, fdst, st.st_size)
+                    self._set_attributes(tmp, st, fdst.fileno())
+                os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            os.replace(tmp, dst)
+        except BaseException:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+        return 0 if stat.S_ISLNK(st.st_mode) else st.st_size
+
+    def copy_entries(self, entries, source=None, target=None):
+        """Copy ``entries`` (folders with a trailing ``/``) from ``source``
+        to ``target``, e.g. from ``current/`` into a history snapshot.
+
+        * Return:
+
+            ``RsyncStats``;
+            number and size of the copied files.
+        """
+        source = source or self.source
+        target = target or self.target
+        stats = RsyncStats(number_of_regular_files_transferred=0,
+                           total_transferred_file_size=0)
+
+        def work(entry):
+            if entry.endswith('/'):
+                os.makedirs(os.path.join(target, entry), exist_ok=True)
+                return None
+            try:
+                return self.copy_file(os.path.join(source, entry),
+                                      os.path.join(target, entry))
+            except FileNotFoundError:
+                self.logger.warning("'{}' vanished.".format(entry))
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for size in pool.map(work, entries):
+                if size is not None:
+                    stats['number_of_regular_files_transferred'] += 1
+                    stats['total_transferred_file_size'] += size
+        return stats
+
+    def _sync_dir(self, path):
+        src = self._lstat(os.path.join(self.source, path))
+        if src is not None and stat.S_ISDIR(src.st_mode):
+            os.makedirs(os.path.join(self.target, path), exist_ok=True)
+            self._set_attributes(os.path.join(self.target, path), src)
+
+    def apply(self, change_log, progress=None, interval=1.0):
+        """Bring the target up to date with the changes found by
+        :meth:`scan`.
+
+        * Parameters:
+
+            :change_log:
+                ``ChangeLog``;
+                the change log of the scan.
+
+            :progress:
+                ``callable``;
+                called with a ``dict`` like
+                :meth:`~rsync_history_backup.report.RsyncProgress.parse_line`
+                at most every ``interval`` seconds.
+
+        * Return:
+
+            ``RsyncStats``;
+            number and size of the transferred files.
+        """
+        self.logger.debug(' - [apply() called.]')
+        for entry in sorted(change_log['deleted'], reverse=True):
+            path = os.path.join(self.target, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+        entries = sorted(set(change_log['created']) |
+                         set(change_log['changed']))
+        folders = [entry for entry in entries if entry.endswith('/')]
+        for entry in folders:
+            os.makedirs(os.path.join(self.target, entry), exist_ok=True)
+        files = [entry for entry in entries if not entry.endswith('/')]
+        state = {'bytes': 0, 'files': 0, 'reported': time(), 'started': time()}
+
+        def report(force=False):
+            now = time()
+            if not progress or not force and \
+                    now - state['reported'] < interval:
+                return
+            state['reported'] = now
+            elapsed = max(now - state['started'], 1e-6)
+            progress({'bytes': state['bytes'],
+                      'percent': int(100 * state['files'] / len(files))
+                      if files else 100,
+                      'rate': int(state['bytes'] / elapsed),
+                      'files_transferred': state['files'],
+                      'files_remaining': len(files) - state['files'],
+                      'files_total': len(files)})
+
+        def work(entry):
+            try:
+                size = self.copy_file(os.path.join(self.source, entry),
+                                      os.path.join(self.target, entry))
+            except FileNotFoundError:
+                self.logger.warning("'{}' vanished since the scan.".format(
+                    entry))
+                return
+            with self._lock:
+                state['bytes'] += size
+                state['files'] += 1
+                report()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(work, files))
+        report(force=True)
+
+        # Folder attributes last, copying into a folder changes its mtime.
+        parents = {os.path.dirname(entry.rstrip('/')) for entry in
+                   chain.from_iterable(change_log[kind]
+                                       for kind in change_log)}
+        parents |= self.dirs | {entry.rstrip('/') for entry in folders}
+        for path in sorted(parents, key=lambda p: p.count('/'), reverse=True):
+            self._sync_dir(path)
+        return RsyncStats(number_of_regular_files_transferred=state['files'],
+                          total_transferred_file_size=state['bytes'])
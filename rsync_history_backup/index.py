@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import logging
+import sqlite3
+import threading
+from time import time
+from collections import namedtuple
+from rsync_history_backup.delta import Delta
+from rsync_history_backup.pack import SnapshotPack
+
+FileMeta = namedtuple('FileMeta', ['st_mode', 'st_size', 'st_mtime_ns'])
+
+
+class VersionIndex:
+    """On-disk index which maps file paths to the history snapshots holding
+    a version of them.
+
+    The index is a SQLite database in the log directory of a backup, so
+    version look ups do not need to probe every snapshot directory.
+
+    * Parameters:
+
+        :log_dir:
+            ``string``;
+            path to the log directory of the backup.
+    """
+    FILE_NAME = 'index.sqlite'
+
+    def __init__(self, log_dir):
+        self.logger = logging.getLogger("rhb.VersionIndex")
+        self.path = os.path.join(log_dir, self.FILE_NAME)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (" +
+                        "path TEXT NOT NULL, ts TEXT NOT NULL, " +
+                        "PRIMARY KEY (path, ts)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_ts " +
+                        "ON versions (ts)")
+
+    @classmethod
+    def exists(cls, log_dir):
+        """Returns ``True`` if an index was created for ``log_dir``."""
+        return os.path.isfile(os.path.join(log_dir, cls.FILE_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def add(self, time_stamp, entries):
+        """Register the history snapshot ``time_stamp`` for ``entries``.
+
+        Directory entries (with a trailing ``/``) are skipped.
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO versions (path, ts) VALUES (?, ?)",
+                ((entry, time_stamp) for entry in entries
+                 if not entry.endswith('/')))
+
+    def remove(self, time_stamp, entries=None):
+        """Remove ``entries`` or the whole snapshot ``time_stamp``."""
+        with self.db:
+            if entries is None:
+                self.db.execute("DELETE FROM versions WHERE ts = ?",
+                                (time_stamp,))
+            else:
+                self.db.executemany(
+                    "DELETE FROM versions WHERE path = ? AND ts = ?",
+                    ((entry, time_stamp) for entry in entries))
+
+    def versions(self, file_paths):
+        """Returns a ``dict`` mapping each of ``file_paths`` to the sorted
+        ``list`` of snapshots holding a version of it."""
+        res = {file_path: [] for file_path in file_paths}
+        for file_path in res:
+            res[file_path] = [row[0] for row in self.db.execute(
+                "SELECT ts FROM versions WHERE path = ? ORDER BY ts",
+                (file_path,))]
+        return res
+
+    def at(self, prefix, time_stamp):
+        """Returns a ``dict`` mapping every path below ``prefix`` (a
+        directory with a trailing ``/``, a file or ``''`` for all paths) to
+        its first snapshot at or after ``time_stamp``."""
+        if not prefix:
+            rows = self.db.execute(
+                "SELECT path, MIN(ts) FROM versions WHERE ts >= ? " +
+                "GROUP BY path", (time_stamp,))
+        elif prefix.endswith('/'):
+            upper = prefix[:-1] + chr(ord('/') + 1)
+            rows = self.db.execute(
+                "SELECT path, MIN(ts) FROM versions WHERE path >= ? AND " +
+                "path < ? AND ts >= ? GROUP BY path",
+                (prefix, upper, time_stamp))
+        else:
+            rows = self.db.execute(
+                "SELECT path, MIN(ts) FROM versions WHERE path = ? AND " +
+                "ts >= ? GROUP BY path", (prefix, time_stamp))
+        return dict(rows)
+
+    def rebuild(self, history_dir):
+        """Rebuild the index from the change logs and the history tree.
+
+        Snapshots with ``*.deleted`` or ``*.changed`` logs are indexed from
+        these, all others are walked once.
+        """
+        self.logger.debug(' - [rebuild() called.]')
+        log_dir = os.path.dirname(self.path)
+        with self.db:
+            self.db.execute("DELETE FROM versions")
+        if not os.path.isdir(history_dir):
+            return 0
+        count = 0
+        for time_stamp in sorted(os.listdir(history_dir)):
+            logs = [os.path.join(log_dir, '{}.{}'.format(time_stamp, kind))
+                    for kind in ('deleted', 'changed')]
+            logs = [log for log in logs if os.path.isfile(log)]
+            if logs:
+                entries = self._read_logs(logs)
+            else:
+                entries = self._walk(os.path.join(history_dir, time_stamp))
+            self.add(time_stamp, entries)
+            count += 1
+        self.logger.info(" -> {} snapshot(s) indexed.".format(count))
+        return count
+
+    @staticmethod
+    def _read_logs(logs):
+        for log in logs:
+            with open(log, 'r', encoding='utf-8',
+                      errors='surrogateescape') as fl:
+                for line in fl:
+                    line = line.rstrip('\n')
+                    if line:
+                        yield line
+
+    @staticmethod
+    def _walk(snapshot_dir):
+        for root, dirs, files in os.walk(snapshot_dir):
+            for name in files:
+                if name == SnapshotPack.FILE_NAME and root == snapshot_dir:
+                    with SnapshotPack(snapshot_dir) as pack:
+                        yield from pack
+                    continue
+                if name.endswith(Delta.SUFFIX):
+                    name = name[:-len(Delta.SUFFIX)]
+                yield os.path.relpath(os.path.join(root, name), snapshot_dir)
+
+
+class CurrentIndex:
+    """Metadata manifest of the ``current`` directory of a backup.
+
+    Holds path, size, mtime and mode of every entry of ``current/`` in a
+    SQLite database in the log directory, so changes can be detected by
+    comparing the source against it instead of walking the destination.
+    It is updated from the change log of every run and rebuilt from a walk
+    of ``current/`` by verify runs.
+
+    The look ups are thread safe.
+
+    * Parameters:
+
+        :log_dir:
+            ``string``;
+            path to the log directory of the backup.
+    """
+    FILE_NAME = 'current.sqlite'
+
+    def __init__(self, log_dir):
+        self.logger = logging.getLogger("rhb.CurrentIndex")
+        self.path = os.path.join(log_dir, self.FILE_NAME)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (" +
+                        "parent TEXT NOT NULL, name TEXT NOT NULL, " +
+                        "size INTEGER, mtime INTEGER, mode INTEGER, " +
+                        "PRIMARY KEY (parent, name)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (" +
+                        "key TEXT PRIMARY KEY, value)")
+
+    @classmethod
+    def exists(cls, log_dir):
+        """Returns ``True`` if a manifest was created for ``log_dir``."""
+        return os.path.isfile(os.path.join(log_dir, cls.FILE_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _split(path):
+        parent, _, name = path.strip('/').rpartition('/')
+        return parent, name
+
+    def verified(self):
+        """Returns the time of the last rebuild or ``None``."""
+        with self._lock:
+            row = self.db.execute("SELECT value FROM meta WHERE " +
+                                  "key = 'verified'").fetchone()
+        return row[0] if row else None
+
+    def stat(self, path):
+        """Returns the ``FileMeta`` of ``path`` or ``None``."""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT mode, size, mtime FROM entries WHERE parent = ? " +
+                "AND name = ?", self._split(path)).fetchone()
+        return FileMeta(*row) if row else None
+
+    def children(self, path):
+        """Returns a ``dict`` mapping the names in the folder ``path`` to
+        their ``FileMeta``."""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT name, mode, size, mtime FROM entries " +
+                "WHERE parent = ?", (path.strip('/'),)).fetchall()
+        return {row[0]: FileMeta(*row[1:]) for row in rows}
+
+    def below(self, path):
+        """Returns the ``list`` of ``(path, FileMeta)`` of all entries
+        below the folder ``path``."""
+        path = path.strip('/')
+        upper = path + chr(ord('/') + 1)
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT parent, name, mode, size, mtime FROM entries " +
+                "WHERE parent = ? OR (parent >= ? AND parent < ?)",
+                (path, path + '/', upper)).fetchall()
+        return [(row[0] + '/' + row[1], FileMeta(*row[2:])) for row in rows]
+
+    @staticmethod
+    def _row(path, st):
+        return CurrentIndex._split(path) + (st.st_size, st.st_mtime_ns,
+                                            st.st_mode)
+
+    def _remove(self, path):
+        parent, name = self._split(path)
+        path = path.strip('/')
+        self.db.execute("DELETE FROM entries WHERE parent = ? AND name = ?",
+                        (parent, name))
+        self.db.execute("DELETE FROM entries WHERE parent = ? OR " +
+                        "(parent >= ? AND parent < ?)",
+                        (path, path + '/', path + chr(ord('/') + 1)))
+
+    def update(self, current_dir, entries):
+        """Refresh ``entries`` (and their folders) from ``current_dir``,
+        entries which do not exist anymore are removed with everything
+        below them.
+
+        * Return:
+
+            ``int``;
+            number of refreshed entries.
+        """
+        self.logger.debug(' - [update() called.]')
+        paths = set()
+        for entry in entries:
+            entry = entry.strip('/')
+            while entry and entry not in paths:
+                paths.add(entry)
+                entry = os.path.dirname(entry)
+        with self._lock, self.db:
+            for path in sorted(paths):
+                try:
+                    st = os.lstat(os.path.join(current_dir, path))
+                except FileNotFoundError:
+                    self._remove(path)
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    self._remove(path)
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES " +
+                                "(?, ?, ?, ?, ?)", self._row(path, st))
+        return len(paths)
+
+    def rebuild(self, current_dir):
+        """Rebuild the manifest from a walk of ``current_dir``.
+
+        * Return:
+
+            ``int``;
+            number of entries.
+        """
+        self.logger.debug(' - [rebuild() called.]')
+
+        def walk(path, prefix=''):
+            with os.scandir(path) as it:
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    yield self._row(prefix + entry.name, st)
+                    if stat.S_ISDIR(st.st_mode):
+                        yield from walk(entry.path, prefix + entry.name + '/')
+
+        count = 0
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM entries")
+            if os.path.isdir(current_dir):
+                for row in walk(current_dir):
+                    self.db.execute("INSERT INTO entries VALUES " +
+                                    "(?, ?, ?, ?, ?)", row)
+                    count += 1
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES " +
+                            "('verified', ?)", (time(),))
+        self.logger.info(" -> {} entries in the manifest.".format(count))
+        return count
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+from time import time
+
+
+class RunJournal:
+    """Journal of the backup run in progress.
+
+    ``journal.json`` in the log directory records the time stamp of the
+    run, everything needed to continue it without a new dry run (the change
+    logs of that time stamp are published before any data is moved) and
+    the phases completed so far. It is removed when the run is finished, so
+    a journal found at the start of a run belongs to an interrupted one.
+
+    * Parameters:
+
+        :log_dir:
+            ``string``;
+            path to the log directory of the backup.
+    """
+    FILE_NAME = 'journal.json'
+    PHASES = ('save_file_logs', 'move_to_history', 'new_backup',
+              'update_manifest', 'update_checksums', 'delta_history',
+              'pack_history')
+
+    def __init__(self, log_dir):
+        self.logger = logging.getLogger("rhb.RunJournal")
+        self.path = os.path.join(log_dir, self.FILE_NAME)
+        self.state = None
+
+    def load(self):
+        """Returns the state of an interrupted run or ``None``."""
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'r') as fl:
+            self.state = json.load(fl)
+        return self.state
+
+    def _write(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path + '.tmp', 'w') as fl:
+            json.dump(self.state, fl, indent=2)
+            fl.flush()
+            os.fsync(fl.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+    def begin(self, time_stamp, **state):
+        """Start the journal of the run ``time_stamp``, ``state`` is stored
+        as is and returned by :meth:`load`."""
+        self.state = dict(state, time_stamp=time_stamp, started=time(),
+                          phase=None, completed=[])
+        self._write()
+
+    def start(self, phase):
+        self.state['phase'] = phase
+        self._write()
+
+    def complete(self, phase):
+        self.state['completed'].append(phase)
+        self.state['phase'] = None
+        self._write()
+        self.logger.debug(" -> phase '{}' journaled.".format(phase))
+
+    def is_completed(self, phase):
+        return self.state is not None and phase in self.state['completed']
+
+    def finish(self):
+        """Remove the journal of a finished run."""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.state = None
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+from time import time, sleep
+try:
+    import fcntl
+except ImportError:       # Windows
+    fcntl = None
+
+
+class RunLock:
+    """Advisory lock of one backup (name) at its destination.
+
+    An exclusive ``flock`` on ``run.lock`` in the log directory of the
+    backup. It is held for a whole run (or pruning), so two processes never
+    write into the same ``current`` and history folders, while backups of
+    different names can run in parallel against one destination. The lock
+    is released by the kernel if the process dies. Without ``fcntl`` the
+    lock is a no-op.
+
+    * Parameters:
+
+        :log_dir:
+            ``string``;
+            path to the log directory of the backup.
+
+        :mode:
+            ``string``;
+            what to do if the backup is locked: ``'wait'`` for it,
+            ``'skip'`` the run or ``'fail'``.
+
+        :timeout:
+            ``float``;
+            seconds to wait at most (``None`` for no limit), waiting longer
+            fails.
+    """
+    FILE_NAME = 'run.lock'
+    MODES = ('wait', 'skip', 'fail')
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, log_dir, mode='wait', timeout=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown lock mode '{}', use one of: {}".format(
+                mode, ', '.join(self.MODES)))
+        self.logger = logging.getLogger("rhb.RunLock")
+        self.path = os.path.join(log_dir, self.FILE_NAME)
+        self.mode = mode
+        self.timeout = timeout
+        self.fl = None
+
+    def _try_lock(self):
+        try:
+            fcntl.flock(self.fl, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def owner(self):
+        """Returns the content of the lock file (pid and start time of the
+        process holding it)."""
+        try:
+            with open(self.path, 'r') as fl:
+                return fl.read().strip()
+        except OSError:
+            return ''
+
+    def acquire(self):
+        """Take the lock.
+
+        * Return:
+
+            ``bool``;
+            ``False`` if the backup is locked and ``mode`` is ``'skip'``.
+        """
+        self.logger.debug(' - [acquire() called.]')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fl = open(self.path, 'a+')
+        if not fcntl:
+            return True
+        start, waiting = time(), False
+        while not self._try_lock():
+            if self.mode == 'skip':
+                self.logger.info("Backup locked by '{}', skipping.".format(
+                    self.owner()))
+                self.fl.close()
+                self.fl = None
+                return False
+            if self.mode == 'fail' or (self.timeout is not None and
+                                       time() - start >= self.timeout):
+                owner = self.owner()
+                self.fl.close()
+                self.fl = None
+                raise RuntimeError("The backup is locked by '{}' ({})."
+                                   .format(owner, self.path))
+            if not waiting:
+                self.logger.info("Waiting for the lock held by '{}'.".format(
+                    self.owner()))
+                waiting = True
+            sleep(self.POLL_INTERVAL)
+        self.fl.seek(0)
+        self.fl.truncate()
+        self.fl.write('pid {} since {}\n'.format(os.getpid(), int(time())))
+        self.fl.flush()
+        return True
+
+    def release(self):
+        if self.fl is None:
+            return
+        if fcntl:
+            self.fl.truncate(0)
+            fcntl.flock(self.fl, fcntl.LOCK_UN)
+        self.fl.close()
+        self.fl = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise RuntimeError("The backup is locked.")
+        return self
+
+    def __exit__(self, *args):
+        self.release()
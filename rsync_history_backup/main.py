@@ -8,7 +8,8 @@ import json
 from rsync_history_backup.basic import RsyncBackup
 from rsync_history_backup.analyzer import BackupInfo
 from rsync_history_backup.actions import init_action, dryrun_action, \
-    backup_action, versions_action
+    backup_action, versions_action, reindex_action, watch_action, \
+    prune_action, get_action, ls_action, diff_action, verify_action
 from rsync_history_backup.parser import parser
 
 # --------------------- FUNCTION DEFNITION -------------------- #
@@ -85,13 +86,42 @@ def run(sys_args):
         if args.dryrun:
             dryrun_action(args.src, args.dst, args.config, local_dir)
         else:
-            backup_action(args.src, args.dst, args.config, local_dir)
+            if not backup_action(args.src, args.dst, args.config, local_dir,
+                                 args.jobs, args.per_dst_device,
+                                 args.per_src_device, args.resume,
+                                 args.on_locked):
+                sys.exit(1)
+
+    elif args.which == 'watch':
+        watch_action(local_dir)
 
     elif args.which == 'versions':
         versions_action(args.config, local_dir, args.path, args.show)
 
-    # elif args.which == 'get':
-    #     get_action(local_dir, args.path, args.version)
+    elif args.which == 'reindex':
+        reindex_action(args.config, local_dir)
+
+    elif args.which == 'ls':
+        ls_action(args.config, local_dir, args.path, args.at)
+
+    elif args.which == 'diff':
+        diff_action(args.config, local_dir, args.time_from, args.time_to,
+                    args.path, args.json, args.content)
+
+    elif args.which == 'prune':
+        prune_action(args.config, local_dir, args.keep, args.dryrun,
+                     args.batch_size, args.pause)
+
+    elif args.which == 'verify':
+        if not verify_action(args.config, local_dir, args.fraction, args.rate,
+                             args.jobs, args.source):
+            sys.exit(1)
+
+    elif args.which == 'get':
+        if not get_action(args.config, local_dir, args.path, args.version,
+                          args.output, args.generate_links, args.delete_links,
+                          args.jobs):
+            sys.exit(1)
 
     else:
         raise NotImplementedError("Sorry. Your requested action is apparently" +
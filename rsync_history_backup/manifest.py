@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import logging
+from rsync_history_backup.changelog import ChangeLog, ChangeList
+
+
+def _key(entry):
+    """Sort key which keeps the entries below a folder together (``/``
+    sorts before every other character)."""
+    return entry.replace(b'/', b'\0')
+
+
+class Manifest:
+    """Memory mapped, sorted listing of all paths of a backup at one point
+    in time.
+
+    The file holds one path per line (folders with a trailing ``/``),
+    sorted so that a folder is directly followed by everything below it.
+    Look ups bisect the mapped file, only the pages touched are read.
+
+    * Parameters:
+
+        :path:
+            ``string``;
+            path to the manifest file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fl = open(path, 'rb')
+        size = os.fstat(self.fl.fileno()).st_size
+        self.data = mmap.mmap(self.fl.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.fl.close()
+
+    @staticmethod
+    def write(path, entries):
+        """Write the manifest of ``entries`` atomically to ``path``."""
+        lines = sorted((os.fsencode(entry) for entry in entries), key=_key)
+        with open(path + '.tmp', 'wb') as fl:
+            for line in lines:
+                fl.write(line + b'\n')
+        os.replace(path + '.tmp', path)
+
+    def __iter__(self):
+        if not self.data:
+            return
+        self.data.seek(0)
+        for line in iter(self.data.readline, b''):
+            yield os.fsdecode(line.rstrip(b'\n'))
+
+    def _line(self, pos):
+        """Returns the start, end and content of the line at ``pos``."""
+        start = self.data.rfind(b'\n', 0, pos) + 1
+        end = self.data.find(b'\n', pos)
+        end = len(self.data) if end < 0 else end
+        return start, end, self.data[start:end]
+
+    def _bisect(self, key):
+        """Returns the offset of the first line not sorting before
+        ``key``."""
+        lo, hi = 0, len(self.data)
+        while lo < hi:
+            start, end, line = self._line((lo + hi) // 2)
+            if _key(line) < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def __contains__(self, entry):
+        entry = os.fsencode(entry)
+        pos = self._bisect(_key(entry))
+        return pos < len(self.data) and self._line(pos)[2] == entry
+
+    def children(self, folder=''):
+        """Returns the sorted names of the entries in ``folder`` (sub
+        folders with a trailing ``/``).
+
+        Sub trees are skipped by bisecting, so listing a folder does not
+        read everything below it.
+        """
+        prefix = os.fsencode(folder.strip('/') + '/') if folder.strip('/') \
+            else b''
+        res = []
+        pos = self._bisect(_key(prefix))
+        while pos < len(self.data):
+            _, end, line = self._line(pos)
+            if not line.startswith(prefix):
+                break
+            name, sep, _ = line[len(prefix):].partition(b'/')
+            if name:
+                res.append(os.fsdecode(name + sep))
+                pos = self._bisect(_key(prefix + name) + b'\x01')
+            else:
+                pos = end + 1
+        return sorted(res)
+
+
+class ManifestCache:
+    """Reconstructs the listing of a backup before any run by replaying
+    the change logs backwards from the current state.
+
+    Manifests are cached as ``manifests/<time stamp>.manifest`` in the log
+    directory. ``current.manifest`` holds the listing after the last run
+    and is rolled forward with the logs of newer runs.
+
+    * Parameters:
+
+        :log_dir:
+            ``string``;
+            path to the log directory of the backup.
+
+        :current_dir:
+            ``string``;
+            path to the current directory of the backup.
+    """
+    DIR_NAME = 'manifests'
+    CURRENT = 'current'
+
+    def __init__(self, log_dir, current_dir):
+        self.logger = logging.getLogger("rhb.ManifestCache")
+        self.log_dir = log_dir
+        self.current_dir = current_dir
+        self.path = os.path.join(log_dir, self.DIR_NAME)
+
+    def runs(self):
+        """Returns the sorted time stamps of the runs with change logs."""
+        return ChangeLog.runs(self.log_dir)
+
+    def manifest_path(self, time_stamp):
+        return os.path.join(self.path, '{}.manifest'.format(time_stamp))
+
+    def _changes(self, time_stamp, kind):
+        return ChangeList(os.path.join(self.log_dir, '{}.{}'.format(
+            time_stamp, kind)))
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.current_dir):
+            rel = os.path.relpath(root, self.current_dir)
+            rel = '' if rel == '.' else rel + '/'
+            for name in dirs:
+                link = os.path.islink(os.path.join(root, name))
+                yield rel + name + ('' if link else '/')
+            for name in files:
+                yield rel + name
+
+    def _current(self, runs):
+        """Returns the entries after the last run, rolled forward from the
+        cached current manifest if possible."""
+        path = self.manifest_path(self.CURRENT)
+        stamp = os.path.join(self.path, self.CURRENT + '.ts')
+        last = runs[-1] if runs else ''
+        cached = None
+        if os.path.isfile(path) and os.path.isfile(stamp):
+            with open(stamp, 'r') as fl:
+                cached = fl.read().strip()
+        if cached == last:
+            with Manifest(path) as manifest:
+                return set(manifest)
+        if cached is not None and cached in runs:
+            with Manifest(path) as manifest:
+                entries = set(manifest)
+            for time_stamp in runs[runs.index(cached) + 1:]:
+                entries.difference_update(self._changes(time_stamp,
+                                                        'deleted'))
+                entries.update(self._changes(time_stamp, 'created'))
+        else:
+            self.logger.debug("Walking the current directory.")
+            entries = set(self._walk())
+        os.makedirs(self.path, exist_ok=True)
+        Manifest.write(path, entries)
+        with open(stamp, 'w') as fl:
+            fl.write(last)
+        return entries
+
+    def get(self, time_stamp=None):
+        """Returns the :class:`Manifest` of the backup at ``time_stamp``,
+        i.e. before the first run at or after it (``None`` for the current
+        state)."""
+        self.logger.debug(' - [get() called.]')
+        runs = self.runs()
+        later = [r for r in runs if time_stamp and r >= time_stamp]
+        if not later:
+            self._current(runs)
+            return Manifest(self.manifest_path(self.CURRENT))
+        target = later[0]
+        if os.path.isfile(self.manifest_path(target)):
+            return Manifest(self.manifest_path(target))
+
+        # Replay backwards from the nearest cached manifest, only the
+        # requested one is cached.
+        start = len(later)
+        for i, run in enumerate(later):
+            if os.path.isfile(self.manifest_path(run)):
+                start = i
+                break
+        if start < len(later):
+            with Manifest(self.manifest_path(later[start])) as manifest:
+                entries = set(manifest)
+        else:
+            entries = self._current(runs)
+        for run in reversed(later[:start]):
+            entries.difference_update(self._changes(run, 'created'))
+            entries.update(self._changes(run, 'deleted'))
+        os.makedirs(self.path, exist_ok=True)
+        Manifest.write(self.manifest_path(target), entries)
+        return Manifest(self.manifest_path(target))
+
+    def remove(self, time_stamp):
+        """Remove the cached manifest of ``time_stamp``."""
+        path = self.manifest_path(time_stamp)
+        if os.path.isfile(path):
+            os.remove(path)
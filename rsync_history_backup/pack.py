@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import stat
+import struct
+import logging
+import threading
+from collections import namedtuple
+from rsync_history_backup.utils import LRUCache
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PackMember = namedtuple('PackMember', ['block', 'offset', 'size',
+                                       'mtime_ns', 'mode'])
+
+
+class SnapshotPack:
+    """Archive of the small files of one history snapshot.
+
+    The files are concatenated into blocks of about ``BLOCK_SIZE`` bytes,
+    each block is compressed on its own (zstd if ``zstandard`` is
+    installed, zlib otherwise). A compressed index of the members and
+    blocks at the end of the file makes every member readable by
+    decompressing only its block.
+
+    Layout: ``MAGIC``, codec (8 bytes), blocks, index, footer (offset and
+    length of the index, ``MAGIC``).
+
+    * Parameters:
+
+        :snapshot_dir:
+            ``string``;
+            path to the history snapshot holding the pack.
+    """
+    FILE_NAME = '.rhb-pack'
+    MAGIC = b'RHBPACK1'
+    BLOCK_SIZE = 1024**2
+    FOOTER = struct.Struct('<QQ8s')
+
+    def __init__(self, snapshot_dir):
+        self.logger = logging.getLogger("rhb.SnapshotPack")
+        self.path = os.path.join(snapshot_dir, self.FILE_NAME)
+        self.fl = open(self.path, 'rb')
+        self._lock = threading.Lock()
+        self._blocks_cache = LRUCache(4)
+        header = self.fl.read(16)
+        if header[:8] != self.MAGIC:
+            raise ValueError("'{}' is no snapshot pack.".format(self.path))
+        self.codec = header[8:].rstrip(b'\0').decode('ascii')
+        self.fl.seek(-self.FOOTER.size, os.SEEK_END)
+        offset, length, magic = self.FOOTER.unpack(
+            self.fl.read(self.FOOTER.size))
+        if magic != self.MAGIC:
+            raise ValueError("The pack '{}' is truncated.".format(self.path))
+        self.fl.seek(offset)
+        index = json.loads(self._decompress(self.codec,
+                                            self.fl.read(length)))
+        self.blocks = index['blocks']
+        self.members = {name: PackMember(*member)
+                        for name, member in index['members'].items()}
+
+    @classmethod
+    def exists(cls, snapshot_dir):
+        return os.path.isfile(os.path.join(snapshot_dir, cls.FILE_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.fl.close()
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def __iter__(self):
+        return iter(sorted(self.members))
+
+    def __len__(self):
+        return len(self.members)
+
+    @staticmethod
+    def _compress(codec, data):
+        if codec == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return zlib.compress(data, 6)
+
+    @staticmethod
+    def _decompress(codec, data):
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError("Reading this pack needs the python " +
+                                   "package 'zstandard'.")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def _block(self, idx):
+        with self._lock:
+            data = self._blocks_cache.get(idx)
+            if data is None:
+                offset, length = self.blocks[idx]
+                self.fl.seek(offset)
+                data = self._decompress(self.codec, self.fl.read(length))
+                self._blocks_cache[idx] = data
+        return data
+
+    def read(self, name):
+        """Returns the content of the member ``name``."""
+        member = self.members[name]
+        return self._block(member.block)[member.offset:member.offset +
+                                         member.size]
+
+    def extract(self, name, target_dir):
+        """Write the member ``name`` into ``target_dir`` (with its base
+        name), keeping its mode and modification time.
+
+        * Return:
+
+            ``string``;
+            path of the extracted file.
+        """
+        member = self.members[name]
+        target = os.path.join(target_dir, os.path.basename(name))
+        with open(target, 'wb') as fl:
+            fl.write(self.read(name))
+        os.chmod(target, stat.S_IMODE(member.mode))
+        os.utime(target, ns=(member.mtime_ns, member.mtime_ns))
+        return target
+
+    @classmethod
+    def _write(cls, path, items):
+        """Write the members ``items`` (``(name, data, mtime_ns, mode)``
+        tuples) into a new pack at ``path``, atomically."""
+        codec = 'zstd' if zstandard is not None else 'zlib'
+        blocks, members, block = [], {}, []
+        block_size = 0
+        with open(path + '.tmp', 'wb') as out:
+            out.write(cls.MAGIC + codec.encode('ascii').ljust(8, b'\0'))
+            for name, data, mtime_ns, mode in items:
+                if block and block_size + len(data) > cls.BLOCK_SIZE:
+                    blocks.append(cls._write_block(out, codec, block))
+                    block, block_size = [], 0
+                members[name] = (len(blocks), block_size, len(data),
+                                 mtime_ns, mode)
+                block.append(data)
+                block_size += len(data)
+            if block:
+                blocks.append(cls._write_block(out, codec, block))
+            index = cls._compress(codec, json.dumps(
+                {'blocks': blocks, 'members': members}).encode('utf-8'))
+            offset = out.tell()
+            out.write(index)
+            out.write(cls.FOOTER.pack(offset, len(index), cls.MAGIC))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def _write_block(cls, out, codec, block):
+        data = cls._compress(codec, b''.join(block))
+        offset = out.tell()
+        out.write(data)
+        return offset, len(data)
+
+    @classmethod
+    def pack(cls, snapshot_dir, entries):
+        """Pack the files ``entries`` (relative to ``snapshot_dir``) into
+        the pack of the snapshot, members of an existing pack are kept.
+
+        The loose files are not removed, the pack is replaced atomically.
+        """
+        entries_set = set(entries)
+        entries = sorted(entries_set)
+        old = cls(snapshot_dir) if cls.exists(snapshot_dir) else None
+
+        def items():
+            for entry in entries:
+                with open(os.path.join(snapshot_dir, entry), 'rb') as fl:
+                    st = os.fstat(fl.fileno())
+                    yield entry, fl.read(), st.st_mtime_ns, st.st_mode
+            if old is not None:
+                for name in old:
+                    if name not in entries_set:
+                        member = old.members[name]
+                        yield name, old.read(name), member.mtime_ns, \
+                            member.mode
+
+        try:
+            cls._write(os.path.join(snapshot_dir, cls.FILE_NAME), items())
+        finally:
+            if old is not None:
+                old.close()
+
+    @classmethod
+    def remove(cls, snapshot_dir, names):
+        """Rewrite the pack of the snapshot without the members ``names``,
+        the pack is deleted if no member is left."""
+        names = set(names)
+        with cls(snapshot_dir) as old:
+            keep = [name for name in old if name not in names]
+            if len(keep) == len(old):
+                return
+            if keep:
+                cls._write(old.path, ((name, old.read(name),
+                                       old.members[name].mtime_ns,
+                                       old.members[name].mode)
+                                      for name in keep))
+        if not keep:
+            os.remove(os.path.join(snapshot_dir, cls.FILE_NAME))
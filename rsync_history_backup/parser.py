@@ -66,6 +66,25 @@ parser_bkup.add_argument("--config", "-c", action="store", metavar="FILE",
                          help="path to a config file.")
 parser_bkup.add_argument("--dryrun", "-t", action="store_true",
                          help="Won't do the actual backup, only show changes.")
+parser_bkup.add_argument("--resume", action="store_true",
+                         help="continue an interrupted backup.")
+parser_bkup.add_argument("--on-locked", choices=["wait", "skip", "fail"],
+                         help="if the backup is running already: wait for " +
+                         "it, skip or fail (default: config or wait).")
+parser_bkup.add_argument("--jobs", "-j", action="store", type=int, default=1,
+                         metavar="N",
+                         help="number of sources backed up in parallel.")
+parser_bkup.add_argument("--per-dst-device", action="store", type=int,
+                         default=1, metavar="N",
+                         help="parallel backups per destination device.")
+parser_bkup.add_argument("--per-src-device", action="store", type=int,
+                         default=1, metavar="N",
+                         help="parallel backups per source device.")
+
+parser_wtch = subparsers.add_parser('watch',
+                                    help='record changes for the next backup.',
+                                    parents=[default_parser])
+parser_wtch.set_defaults(which='watch')
 
 parser_vers = subparsers.add_parser('versions', help='show file versions.',
                                     parents=[default_parser])
@@ -75,6 +94,87 @@ parser_vers.add_argument("--config", "-c", action="store", metavar="FILE",
 parser_vers.add_argument("--show", "-s", action="store_true",
                          help="show which version the local file is.")
 
+parser_rind = subparsers.add_parser('reindex',
+                                    help='rebuild the file version index.',
+                                    parents=[default_parser])
+parser_rind.set_defaults(which='reindex')
+parser_rind.add_argument("--config", "-c", action="store", metavar="FILE",
+                         help="path to a config file.")
+
+parser__ls = subparsers.add_parser('ls', help='list a folder as it was.',
+                                   parents=[default_parser])
+parser__ls.set_defaults(which='ls')
+parser__ls.add_argument("--config", "-c", action="store", metavar="FILE",
+                        help="path to a config file.")
+parser__ls.add_argument("--at", action="store", metavar="TIME",
+                        help="list the folder as it was at TIME " +
+                        "(e.g. '2020-01-31 12-00-00' or '2020-01-31').")
+
+parser_diff = subparsers.add_parser('diff',
+                                    help='show the changes between two runs.',
+                                    description='Show the changes of the ' +
+                                    'runs after TIME1 up to and including ' +
+                                    'TIME2. A run id stands for the state ' +
+                                    'after that run, other times and ' +
+                                    'prefixes (e.g. 2020-01-31) for the ' +
+                                    'state before the runs at or after them.')
+parser_diff.set_defaults(which='diff')
+parser_diff.add_argument("time_from", metavar="TIME1",
+                         help="older point in time, a run id stands for " +
+                         "the state after that run.")
+parser_diff.add_argument("time_to", metavar="TIME2",
+                         help="newer point in time or 'current'.")
+parser_diff.add_argument("path", nargs='?', type=str, default='.',
+                         help="only compare below this path.")
+parser_diff.add_argument("--verbose", "-v", action="store_true",
+                         help="show debug output.")
+parser_diff.add_argument("--log", "-l", action="store", metavar="PATH",
+                         help="path to log file.")
+parser_diff.add_argument("--config", "-c", action="store", metavar="FILE",
+                         help="path to a config file.")
+parser_diff.add_argument("--json", action="store_true",
+                         help="print the changes as json.")
+parser_diff.add_argument("--content", action="store_true",
+                         help="show unified diffs of the files.")
+
+parser_prun = subparsers.add_parser('prune',
+                                    help='remove expired history snapshots.',
+                                    parents=[default_parser])
+parser_prun.set_defaults(which='prune')
+parser_prun.add_argument("--config", "-c", action="store", metavar="FILE",
+                         help="path to a config file.")
+parser_prun.add_argument("--keep", "-k", action="append", metavar="TIER=AGE",
+                         help="keep the newest run per hour, day, week, " +
+                         "month or year for AGE (e.g. 'daily=30d', " +
+                         "'monthly=*'). Overrides the config.")
+parser_prun.add_argument("--dryrun", "-t", action="store_true",
+                         help="only show what would be removed.")
+parser_prun.add_argument("--batch-size", action="store", type=int,
+                         default=1000, metavar="N",
+                         help="files deleted between two pauses.")
+parser_prun.add_argument("--pause", action="store", type=float, default=0.0,
+                         metavar="SECONDS",
+                         help="pause between two batches of deletions.")
+
+parser_vrfy = subparsers.add_parser('verify',
+                                    help='check the backup for corrupt ' +
+                                    'files.',
+                                    parents=[default_parser])
+parser_vrfy.set_defaults(which='verify')
+parser_vrfy.add_argument("--config", "-c", action="store", metavar="FILE",
+                         help="path to a config file.")
+parser_vrfy.add_argument("--fraction", "-f", action="store", type=float,
+                         default=0.0, metavar="SHARE",
+                         help="share of the archive to verify again, " +
+                         "oldest checksums first (e.g. 0.05, 1 for all).")
+parser_vrfy.add_argument("--rate", action="store", metavar="SIZE",
+                         help="bytes read per second at most (e.g. '50M').")
+parser_vrfy.add_argument("--jobs", "-j", action="store", type=int,
+                         default=None, metavar="N",
+                         help="number of hashing processes.")
+parser_vrfy.add_argument("--source", action="store_true",
+                         help="compare current with the source files.")
+
 parser__get = subparsers.add_parser('get', help='get file from backup folder',
                                     parents=[default_parser])
 parser__get.set_defaults(which='get')
@@ -84,7 +184,16 @@ parser__get.add_argument("--generate-links", action="store_true",
 parser__get.add_argument("--delete-links", action="store_true",
                          help="delete symlinks (only linux).")
 parser__get.add_argument("--version", action="store",
-                         help="get specific file version.")
+                         metavar="TIME",
+                         help="get the files as they were at TIME " +
+                         "(e.g. '2020-01-31 12-00-00' or '2020-01-31').")
+parser__get.add_argument("--config", "-c", action="store", metavar="FILE",
+                         help="path to a config file.")
+parser__get.add_argument("--output", "-o", action="store", metavar="FOLDER",
+                         help="folder to restore into.")
+parser__get.add_argument("--jobs", "-j", action="store", type=int,
+                         default=None, metavar="N",
+                         help="number of files copied in parallel.")
 
 parser_drop = subparsers.add_parser('drop', help='delete given file.',
                                     parents=[default_parser])
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import logging
+import threading
+from time import time
+from collections import namedtuple
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:       # Windows
+    resource = None
+
+
+class RssSampler:
+    """Follows the peak resident memory of a child process.
+
+    The kernel hands the peak RSS of rhb down to the processes it starts
+    and keeps it across ``exec``, so ``ru_maxrss`` of ``wait4()`` reports
+    the memory of rhb for every smaller rsync. The high-water mark
+    ``VmHWM`` in ``/proc/<pid>/status`` belongs to the executed program
+    only; it is read every ``interval`` seconds and once more when the
+    process is done (linux only, ``peak`` stays ``None`` elsewhere).
+
+    * Parameters:
+
+        :pid:
+            ``int``;
+            process id of the child, sampled until ``stop()`` is called
+            (before the process is reaped).
+
+        :interval:
+            ``float``;
+            seconds between two samples.
+    """
+
+    def __init__(self, pid, interval=0.2):
+        self.path = '/proc/{}/status'.format(pid)
+        self.interval = interval
+        self.peak = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        try:
+            with open(self.path) as fl:
+                for line in fl:
+                    if line.startswith('VmHWM:'):
+                        # in kilobytes
+                        rss = int(line.split()[1]) * 1024
+                        self.peak = max(self.peak or 0, rss)
+                        return
+        except (OSError, ValueError):
+            pass
+
+    def _run(self):
+        while True:
+            self._sample()
+            if self._done.wait(self.interval):
+                return
+
+    def stop(self):
+        """Stop sampling and return the peak RSS in bytes (``None`` if it
+        is unknown)."""
+        self._done.set()
+        self._thread.join()
+        self._sample()
+        return self.peak
+
+
+class RsyncStats(dict):
+    """Numbers reported by rsync's ``--stats`` option.
+
+    The keys are the lower case labels of rsync with underscores, e.g.
+    ``total_transferred_file_size`` or ``number_of_files``.
+    """
+    REG = re.compile(r'^([A-Z][A-Za-z ]+): ([\d,.]+)')
+    SUMMARY = re.compile(r'^sent ([\d,.]+) bytes\s+received ([\d,.]+) bytes')
+
+    @staticmethod
+    def _number(text):
+        text = text.replace(',', '').rstrip('.')
+        return float(text) if '.' in text else int(text)
+
+    def parse_line(self, line):
+        """Parse one output line of rsync.
+
+        * Return:
+
+            ``True`` if the line was part of the statistics.
+        """
+        match = self.REG.match(line)
+        if match:
+            key = match.group(1).strip().lower().replace(' ', '_')
+            self[key] = self._number(match.group(2))
+            return True
+        match = self.SUMMARY.match(line)
+        if match:
+            self['sent'] = self._number(match.group(1))
+            self['received'] = self._number(match.group(2))
+            return True
+        return line.startswith('total size is ')
+
+    def merge(self, other):
+        """Add the numbers of ``other`` (e.g. of another shard)."""
+        for key, value in other.items():
+            self[key] = self.get(key, 0) + value
+        return self
+
+
+ProgressEvent = namedtuple('ProgressEvent', [
+    'name', 'shard', 'bytes', 'total_bytes', 'percent', 'rate', 'elapsed',
+    'files_transferred', 'files_remaining', 'files_total', 'idle', 'eta'])
+ProgressEvent.__doc__ = """Progress of a running transfer.
+
+``bytes``, ``percent``, ``rate`` (bytes per second) and the file counts are
+the ones reported by the rsync process of ``shard``, ``total_bytes`` and
+``eta`` (seconds, ``None`` if unknown) cover all shards. ``idle`` is the
+time since the shard reported progress the last time."""
+
+
+class RsyncProgress:
+    """Parser of rsync's ``--info=progress2`` lines."""
+    REG = re.compile(r'^\s*([\d,.]+)([KMGTP]?)\s+(\d+)%\s+([\d,.]+)' +
+                     r'([kKMGTP]?)B/s\s+(\d+):(\d\d):(\d\d)' +
+                     r'(?:\s+\(xfr#(\d+), (?:to|ir)-chk=(\d+)/(\d+)\))?')
+    UNITS = {'': 1, 'k': 1024, 'K': 1024, 'M': 1024**2, 'G': 1024**3,
+             'T': 1024**4, 'P': 1024**5}
+
+    @classmethod
+    def _bytes(cls, number, unit):
+        return int(float(number.replace(',', '')) * cls.UNITS[unit])
+
+    @classmethod
+    def parse_line(cls, line):
+        """Returns a ``dict`` with the numbers of a progress line or
+        ``None`` if it is no progress line."""
+        match = cls.REG.match(line)
+        if not match:
+            return None
+        g = match.groups()
+        return {
+            'bytes': cls._bytes(g[0], g[1]),
+            'percent': int(g[2]),
+            'rate': cls._bytes(g[3], g[4]),
+            'files_transferred': int(g[8]) if g[8] else None,
+            'files_remaining': int(g[9]) if g[9] else None,
+            'files_total': int(g[10]) if g[10] else None
+        }
+
+
+class EtaEstimator:
+    """Estimates the remaining time of a transfer.
+
+    The throughput of the previous run serves as prior, which is weighted
+    like ``prior_weight`` seconds of the current transfer, so the estimate
+    is usable right from the start and follows the measured rate later.
+
+    * Parameters:
+
+        :expected_bytes:
+            ``int``;
+            bytes to transfer (from the dry run), ``None`` if unknown.
+
+        :prior_rate:
+            ``float``;
+            bytes per second of the previous run, ``None`` if unknown.
+    """
+
+    def __init__(self, expected_bytes=None, prior_rate=None,
+                 prior_weight=10.0):
+        self.expected_bytes = expected_bytes
+        self.prior_rate = prior_rate
+        self.prior_weight = prior_weight if prior_rate else 0.0
+
+    @staticmethod
+    def prior_from_report(report):
+        """Returns the transfer rate of a loaded run report or
+        ``None``."""
+        phase = (report or {}).get('phases', {}).get('new_backup', {})
+        if phase.get('bytes') and phase.get('seconds'):
+            return phase['bytes'] / phase['seconds']
+        return None
+
+    def estimate(self, done, elapsed, percent=None):
+        """Returns the estimated seconds left or ``None``."""
+        weight = self.prior_weight + elapsed
+        if weight <= 0:
+            return None
+        rate = ((self.prior_rate or 0) * self.prior_weight + done) / weight
+        if self.expected_bytes and rate > 0:
+            return max(self.expected_bytes - done, 0) / rate
+        if percent:
+            return elapsed * (100 - percent) / percent
+        return None
+
+
+class RunReport:
+    """Timing and throughput report of a single backup run.
+
+    Every phase of ``RsyncBackup.run_backup()`` is recorded with its wall
+    time, the peak resident memory (``peak_rss``) and any additional
+    numbers (file counts, rsync statistics). ``peak_rss`` holds the peak of
+    the rhb process since it started (``self``, the kernel does not reset
+    it between the runs of a scheduler or watcher) and of the largest rsync
+    process which finished in the phase (``rsync``). The report is
+    written as ``<time_stamp>.report.json`` into the log directory and
+    optionally in the Prometheus textfile collector format.
+    """
+
+    def __init__(self, name, time_stamp=None):
+        self.logger = logging.getLogger("rhb.RunReport")
+        self.name = name
+        self.time_stamp = time_stamp
+        self.started = time()
+        self.finished = None
+        self.phases = {}
+        self._open = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def peak_rss():
+        """Returns the peak RSS of this process since its start in
+        bytes."""
+        if resource is None:
+            return {}
+        # ru_maxrss is in kilobytes on linux
+        return {'self': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+    def child_finished(self, rss):
+        """Record the peak RSS ``rss`` of a finished rsync process in the
+        phases in progress."""
+        if rss is None:
+            return
+        with self._lock:
+            for data in self._open:
+                peak = data.setdefault('peak_rss', {})
+                peak['rsync'] = max(peak.get('rsync', 0), rss)
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager measuring the phase ``name``."""
+        start = time()
+        data = self.phases.setdefault(name, {})
+        with self._lock:
+            self._open.append(data)
+        try:
+            yield data
+        finally:
+            with self._lock:
+                self._open.remove(data)
+            data['seconds'] = round(time() - start, 3)
+            data.setdefault('peak_rss', {}).update(self.peak_rss())
+            self.logger.debug(" -> phase '{}' took {}s.".format(
+                name, data['seconds']))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'time_stamp': self.time_stamp,
+            'started': self.started,
+            'finished': self.finished,
+            'seconds': round((self.finished or time()) - self.started, 3),
+            'phases': self.phases
+        }
+
+    def save(self, log_dir):
+        """Write the report into ``log_dir`` and return its path."""
+        self.finished = self.finished or time()
+        path = os.path.join(log_dir, '{}.report.json'.format(self.time_stamp))
+        with open(path, 'w') as fl:
+            json.dump(self.to_dict(), fl, indent=2)
+        return path
+
+    @staticmethod
+    def load(log_dir, time_stamp=None):
+        """Load the report of ``time_stamp`` or the latest one.
+
+        * Return:
+
+            ``dict`` or ``None`` if there is no report.
+        """
+        if not os.path.isdir(log_dir):
+            return None
+        if time_stamp is None:
+            reports = sorted(f for f in os.listdir(log_dir)
+                             if f.endswith('.report.json'))
+            if not reports:
+                return None
+            path = os.path.join(log_dir, reports[-1])
+        else:
+            path = os.path.join(log_dir, '{}.report.json'.format(time_stamp))
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as fl:
+            return json.load(fl)
+
+    def prometheus(self):
+        """Returns the report in the Prometheus text exposition format."""
+        label = 'name="{}"'.format(self.name.replace('"', '\\"'))
+        lines = [
+            '# HELP rhb_last_run_timestamp_seconds Start of the last run.',
+            '# TYPE rhb_last_run_timestamp_seconds gauge',
+            'rhb_last_run_timestamp_seconds{{{}}} {}'.format(
+                label, self.started),
+            '# HELP rhb_run_duration_seconds Wall time of the last run.',
+            '# TYPE rhb_run_duration_seconds gauge',
+            'rhb_run_duration_seconds{{{}}} {}'.format(
+                label, self.to_dict()['seconds']),
+            '# HELP rhb_phase_duration_seconds Wall time per phase.',
+            '# TYPE rhb_phase_duration_seconds gauge']
+        for phase, data in sorted(self.phases.items()):
+            lines.append('rhb_phase_duration_seconds{{{},phase="{}"}} {}'
+                         .format(label, phase, data.get('seconds', 0)))
+        lines += ['# HELP rhb_files Number of files per change type.',
+                  '# TYPE rhb_files gauge']
+        for kind, count in sorted(
+                self.phases.get('dry_run', {}).get('files', {}).items()):
+            lines.append('rhb_files{{{},kind="{}"}} {}'.format(
+                label, kind, count))
+        lines += ['# HELP rhb_bytes_transferred Bytes written per phase.',
+                  '# TYPE rhb_bytes_transferred gauge']
+        for phase, data in sorted(self.phases.items()):
+            if 'bytes' in data:
+                lines.append('rhb_bytes_transferred{{{},phase="{}"}} {}'
+                             .format(label, phase, data['bytes']))
+        rss = {}
+        for data in self.phases.values():
+            for proc, value in data.get('peak_rss', {}).items():
+                rss[proc] = max(rss.get(proc, 0), value)
+        lines += ['# HELP rhb_peak_rss_bytes Peak resident memory of rhb ' +
+                  'since its start and of the largest rsync of the run.',
+                  '# TYPE rhb_peak_rss_bytes gauge']
+        for proc, value in sorted(rss.items()):
+            lines.append('rhb_peak_rss_bytes{{{},process="{}"}} {}'.format(
+                label, proc, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Atomically write :meth:`prometheus` to ``path``."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fl:
+            fl.write(self.prometheus())
+        os.replace(tmp, path)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from rsync_history_backup.index import VersionIndex
+from rsync_history_backup.delta import Delta
+
+
+class Restorer:
+    """Rebuilds files or folders of a backup as they were at a given time.
+
+    The history snapshot ``history/<name>/<ts>`` holds the versions files
+    had before the run ``ts``, so the version of a path at the time ``T``
+    is the one in its first snapshot at or after ``T``, otherwise the one
+    in ``current/``. Paths created by a run at or after ``T`` (and not
+    replaced before) did not exist yet and are left out.
+
+    The snapshots are never scanned: the candidates come from the version
+    index, the ``*.created`` logs of the runs since ``T`` and one walk of
+    the restored folder in ``current/``.
+
+    * Parameters:
+
+        :backup_info:
+            ``BackupInfo``;
+            the backup to restore from.
+
+        :time_stamp:
+            ``string``;
+            point in time (``%Y-%m-%d %H-%M-%S`` or a prefix of it, e.g.
+            ``2020-01-31``), ``None`` for the current state.
+
+        :workers:
+            ``int``;
+            number of files copied in parallel.
+    """
+
+    def __init__(self, backup_info, time_stamp=None, workers=None):
+        self.logger = logging.getLogger("rhb.Restorer")
+        self.info = backup_info
+        self.time_stamp = self.normalize(time_stamp) if time_stamp else None
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+
+    @staticmethod
+    def normalize(time_stamp):
+        """Accept ISO like time stamps (``2020-01-31T12:00``) as well."""
+        return time_stamp.strip().replace('T', ' ').replace(':', '-')
+
+    def _created(self, prefix):
+        """Returns a ``dict`` mapping the paths below ``prefix`` to the
+        first run at or after the requested time which created them."""
+        res = {}
+        if not os.path.isdir(self.info.log_dir):
+            return res
+        logs = sorted(file_name[:-len('.created')]
+                      for file_name in os.listdir(self.info.log_dir)
+                      if file_name.endswith('.created'))
+        for time_stamp in reversed(logs):
+            if time_stamp < self.time_stamp:
+                break
+            path = os.path.join(self.info.log_dir, time_stamp + '.created')
+            with open(path, 'r', encoding='utf-8',
+                      errors='surrogateescape') as fl:
+                for line in fl:
+                    entry = line.rstrip('\n')
+                    if entry and self._below(entry, prefix):
+                        res[entry] = time_stamp
+        return res
+
+    @staticmethod
+    def _below(entry, prefix):
+        return not prefix or entry == prefix or \
+            entry.startswith(prefix + '/')
+
+    def plan(self, path):
+        """Returns the sorted ``list`` of ``(path, version)`` tuples to
+        restore ``path`` (relative to the backup root, ``''`` for all
+        files). ``version`` is ``None`` for files of ``current/``."""
+        self.logger.debug(' - [plan() called.]')
+        prefix = path.strip('/')
+        history, created = {}, {}
+        if self.time_stamp and os.path.isdir(self.info.history_dir):
+            if not VersionIndex.exists(self.info.log_dir):
+                self.info.reindex()
+            with VersionIndex(self.info.log_dir) as index:
+                history = index.at(prefix, self.time_stamp)
+                if prefix:
+                    history.update(index.at(prefix + '/', self.time_stamp))
+            created = self._created(prefix)
+
+        res = {}
+        current = os.path.join(self.info.current_dir, prefix)
+        if os.path.isdir(current) and not os.path.islink(current):
+            for root, dirs, files in os.walk(current):
+                for name in files + [d for d in dirs if os.path.islink(
+                        os.path.join(root, d))]:
+                    res[os.path.relpath(os.path.join(root, name),
+                                        self.info.current_dir)] = None
+        elif os.path.lexists(current) and prefix:
+            res[prefix] = None
+        res.update(history)
+        for entry, time_stamp in created.items():
+            if entry in res and (res[entry] is None or
+                                 time_stamp < res[entry]):
+                del res[entry]
+        return sorted(res.items())
+
+    def source(self, path, version):
+        """Returns the path of the stored ``version`` of ``path`` (with the
+        delta suffix if it is delta encoded)."""
+        if version is None:
+            return os.path.join(self.info.current_dir, path)
+        res = os.path.join(self.info.history_dir, version, path)
+        if not os.path.lexists(res) and \
+                os.path.isfile(res + Delta.SUFFIX):
+            return res + Delta.SUFFIX
+        return res
+
+    def _packed(self, source, path, version):
+        """Check if the version is only stored in the snapshot pack."""
+        return version is not None and not os.path.lexists(source) and \
+            self.info.packed(path, version) is not None
+
+    @staticmethod
+    def _target(path, prefix, output):
+        base = os.path.dirname(prefix.strip('/'))
+        return os.path.join(output, os.path.relpath(path, base or '.'))
+
+    def _copy(self, path, version, target):
+        source = self.source(path, version)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if source.endswith(Delta.SUFFIX):
+            self.info.materialize(path, version, os.path.dirname(target))
+        elif self._packed(source, path, version):
+            self.info.packed(path, version).extract(path,
+                                                    os.path.dirname(target))
+        elif os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+        else:
+            shutil.copy2(source, target)
+
+    def restore(self, path, output):
+        """Copy ``path`` as it was into the folder ``output``.
+
+        * Return:
+
+            ``int``;
+            number of restored files.
+        """
+        self.logger.debug(' - [restore() called.]')
+        plan = self.plan(path)
+
+        def work(item):
+            entry, version = item
+            try:
+                self._copy(entry, version, self._target(entry, path, output))
+                return True
+            except OSError as e:
+                self.logger.error("Restoring '{}' failed: {}".format(entry,
+                                                                      e))
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return sum(pool.map(work, plan))
+
+    def link(self, path, output):
+        """Present ``path`` as it was as a tree of symlinks in ``output``.
+
+        Delta encoded and packed versions can not be linked and are rebuilt
+        instead.
+
+        * Return:
+
+            ``int``;
+            number of linked files.
+        """
+        self.logger.debug(' - [link() called.]')
+        count = 0
+        for entry, version in self.plan(path):
+            target = self._target(entry, path, output)
+            source = self.source(entry, version)
+            if source.endswith(Delta.SUFFIX) or \
+                    self._packed(source, entry, version):
+                self._copy(entry, version, target)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.symlink(os.path.abspath(source), target)
+            count += 1
+        return count
+
+    def unlink(self, output):
+        """Remove a symlink tree created by :meth:`link`.
+
+        Only symlinks into the backup and the folders left empty are
+        removed.
+
+        * Return:
+
+            ``int``;
+            number of removed links.
+        """
+        location = os.path.abspath(self.info.location) + os.sep
+        count = 0
+        for root, dirs, files in os.walk(output, topdown=False):
+            for name in files + dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path) and \
+                        os.readlink(path).startswith(location):
+                    os.remove(path)
+                    count += 1
+            if not os.listdir(root):
+                os.rmdir(root)
+        return count
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import shutil
+import logging
+import tempfile
+from itertools import chain
+from time import sleep
+from datetime import datetime, timedelta
+from rsync_history_backup.changelog import ChangeLog
+from rsync_history_backup.index import VersionIndex
+from rsync_history_backup.delta import Delta
+from rsync_history_backup.dedup import ObjectStore
+from rsync_history_backup.manifest import ManifestCache
+from rsync_history_backup.pack import SnapshotPack
+from rsync_history_backup.utils import Helper
+
+
+class RetentionPolicy:
+    """Tiered retention policy for the runs of a backup.
+
+    Every tier keeps the newest run of each period (hour, day, ...) for a
+    given time span, e.g. ``{"hourly": "2d", "daily": "30d",
+    "monthly": "*"}`` keeps one run per hour for two days, one per day for
+    30 days and one per month forever. The newest run is always kept.
+
+    * Parameters:
+
+        :rules:
+            ``dict`` or ``list``;
+            tier names mapped to a duration (``<n>h``, ``<n>d``, ``<n>w``,
+            ``<n>m`` (30 days), ``<n>y`` (365 days) or ``*`` for forever),
+            or a list of ``"tier=duration"`` strings.
+    """
+    TIERS = {
+        'hourly': '%Y-%m-%d %H',
+        'daily': '%Y-%m-%d',
+        'weekly': '%G-%V',
+        'monthly': '%Y-%m',
+        'yearly': '%Y'
+    }
+    UNITS = {'h': 1, 'd': 24, 'w': 7 * 24, 'm': 30 * 24, 'y': 365 * 24}
+    DURATION = re.compile(r'^(\d+)([hdwmy])$')
+
+    def __init__(self, rules):
+        if isinstance(rules, (list, tuple)):
+            rules = dict(rule.split('=', 1) for rule in rules)
+        self.rules = {}
+        for tier, duration in rules.items():
+            if tier not in self.TIERS:
+                raise ValueError("Unknown retention tier '{}', use one of: {}"
+                                 .format(tier, ', '.join(self.TIERS)))
+            self.rules[tier] = self.parse_duration(duration)
+        if not self.rules:
+            raise ValueError("The retention policy is empty.")
+
+    @classmethod
+    def parse_duration(cls, duration):
+        """Returns the ``timedelta`` of ``duration`` (``None`` for
+        ``*``)."""
+        duration = str(duration).strip()
+        if duration == '*':
+            return None
+        match = cls.DURATION.match(duration)
+        if not match:
+            raise ValueError("Invalid retention duration '{}'."
+                             .format(duration))
+        return timedelta(hours=int(match.group(1)) *
+                         cls.UNITS[match.group(2)])
+
+    @staticmethod
+    def parse_time_stamp(time_stamp):
+        return Helper.parse_time_stamp(time_stamp)
+
+    def select(self, time_stamps, now=None):
+        """Returns the ``set`` of ``time_stamps`` to keep."""
+        now = now or datetime.now()
+        time_stamps = sorted(time_stamps)
+        keep = set(time_stamps[-1:])
+        for tier, duration in self.rules.items():
+            newest = {}
+            for time_stamp in time_stamps:
+                dt = self.parse_time_stamp(time_stamp)
+                if duration is not None and dt < now - duration:
+                    continue
+                newest[dt.strftime(self.TIERS[tier])] = time_stamp
+            keep.update(newest.values())
+        return keep
+
+
+class Pruner:
+    """Removes the runs of a backup which are expired by a
+    :class:`RetentionPolicy`.
+
+    The history snapshot ``history/<name>/<ts>`` holds the versions files
+    had *before* the run ``ts``, so the state after a kept run is restored
+    from the snapshots of the runs following it. Expired runs are therefore
+    folded into the next retained run, newest first: every file version of
+    an expired snapshot is moved into that run's snapshot and replaces the
+    version it holds, files created by the expired run are removed from
+    it. The change logs are merged the same way, so the retained run
+    describes all changes since the previous retained run. Runs older than
+    the oldest retained run are removed completely.
+
+    Files are deleted in batches of ``batch_size`` with a ``pause`` (in
+    seconds) in between, so pruning does not saturate the disk.
+
+    * Parameters:
+
+        :backup_info:
+            ``BackupInfo``;
+            the backup to prune.
+
+        :policy:
+            ``RetentionPolicy``;
+            the runs to keep.
+
+        :batch_size:
+            ``int``;
+            number of files deleted in one go.
+
+        :pause:
+            ``float``;
+            seconds to sleep between two batches.
+
+        :dry_run:
+            ``bool``;
+            only report what would be removed.
+    """
+    LOG_KINDS = ChangeLog.KINDS + ('dryrun', 'report.json')
+
+    def __init__(self, backup_info, policy, batch_size=1000, pause=0.0,
+                 dry_run=False):
+        self.logger = logging.getLogger("rhb.Pruner")
+        self.info = backup_info
+        self.policy = policy
+        self.batch_size = batch_size
+        self.pause = pause
+        self.dry_run = dry_run
+        self.deletions = []
+        self.moved = {}
+        self.unpacked = {}
+        self.logs = {}
+        self.links = {}
+        self.stats = {'runs': 0, 'kept': 0, 'expired': 0, 'moved': 0,
+                      'deleted': 0, 'bytes': 0}
+
+    def runs(self):
+        """Returns the sorted time stamps of all runs with a history
+        snapshot or change logs."""
+        res = set()
+        if os.path.isdir(self.info.history_dir):
+            res.update(os.listdir(self.info.history_dir))
+        if os.path.isdir(self.info.log_dir):
+            for file_name in os.listdir(self.info.log_dir):
+                for kind in self.LOG_KINDS:
+                    if file_name.endswith('.' + kind):
+                        res.add(file_name[:-len(kind) - 1])
+        return sorted(res)
+
+    def _snapshot(self, time_stamp):
+        return os.path.join(self.info.history_dir, time_stamp)
+
+    def _walk(self, time_stamp):
+        """Yield the files of a snapshot relative to it."""
+        snapshot = self._snapshot(time_stamp)
+        for root, dirs, files in os.walk(snapshot):
+            for name in files:
+                yield os.path.relpath(os.path.join(root, name), snapshot)
+
+    def _count(self, path):
+        """Count the bytes freed by deleting ``path``."""
+        st = os.lstat(path)
+        key = (st.st_dev, st.st_ino)
+        count, nlink, size = self.links.get(key, (0, st.st_nlink, st.st_size))
+        self.links[key] = (count + 1, nlink, size)
+        self.stats['deleted'] += 1
+
+    def _delete(self, path):
+        """Queue ``path`` for deletion and count the bytes it frees."""
+        self._count(path)
+        self.deletions.append(path)
+
+    def _materialize_dependent(self, index, time_stamp, path):
+        """Replace the delta of the next older version of ``path`` (which
+        is built on the version in ``time_stamp``) by a full copy."""
+        older = [v for v in index.versions([path])[path] if v < time_stamp]
+        if not older:
+            return
+        batch = os.path.join(self._snapshot(older[-1]), path) + Delta.SUFFIX
+        if not os.path.isfile(batch):
+            return
+        tmp = tempfile.mkdtemp(prefix='.rhb-prune-',
+                               dir=self.info.location)
+        try:
+            full = self.info.materialize(path, older[-1], tmp)
+            os.replace(full, batch[:-len(Delta.SUFFIX)])
+            os.remove(batch)
+        finally:
+            shutil.rmtree(tmp)
+
+    def _replace(self, index, target, path):
+        """Remove the version of ``path`` held by the retained run
+        ``target``, it is superseded by the version (or the absence) of
+        ``path`` before an older expired run."""
+        moved = self.moved.get(target, {}).pop(path, None)
+        full = os.path.join(self._snapshot(target), path)
+        loose = [name for name in (full, full + Delta.SUFFIX)
+                 if moved is None and os.path.lexists(name)]
+        packed = moved is None and \
+            self.info.packed(path, target) is not None
+        if moved is None and not loose and not packed:
+            return
+        if not self.dry_run:
+            self._materialize_dependent(index, target, path)
+        if moved is not None:
+            # Moved in from a newer expired run.
+            loose = [moved]
+        for name in loose:
+            self._count(name)
+            if not self.dry_run:
+                os.remove(name)
+        if packed:
+            self.unpacked.setdefault(target, set()).add(path)
+        if not self.dry_run:
+            index.remove(target, [path])
+
+    def _move(self, index, target, path, entry, src, extract=None):
+        """Move the version ``src`` of ``path`` (stored as ``entry``) into
+        the retained run ``target``, replacing its version. ``extract``
+        writes a packed version into a given folder instead."""
+        self._replace(index, target, path)
+        self.stats['moved'] += 1
+        if self.dry_run:
+            self.moved.setdefault(target, {})[path] = src
+            return
+        dst = os.path.join(self._snapshot(target), entry)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if extract is not None:
+            extract(os.path.dirname(dst))
+        else:
+            os.rename(src, dst)
+        self.moved.setdefault(target, {})[path] = dst
+
+    def _expire(self, index, time_stamp, target):
+        """Fold the run ``time_stamp`` into the retained run ``target`` (or
+        drop it if ``target`` is ``None``)."""
+        self.logger.debug("Expire '{}' into '{}'.".format(time_stamp, target))
+        if target is not None and target not in self.logs:
+            self.logs[target] = ChangeLog.changes(self.info.log_dir, target)
+        changes = ChangeLog.changes(self.info.log_dir, time_stamp)
+        snapshot = self._snapshot(time_stamp)
+        moved = []
+        for entry in self._walk(time_stamp):
+            if entry == SnapshotPack.FILE_NAME:
+                continue
+            path = entry[:-len(Delta.SUFFIX)] \
+                if entry.endswith(Delta.SUFFIX) else entry
+            src = os.path.join(snapshot, entry)
+            if target is None:
+                if not self.dry_run:
+                    self._materialize_dependent(index, time_stamp, path)
+                self._delete(src)
+                continue
+            self._move(index, target, path, entry, src)
+            moved.append(path)
+        if SnapshotPack.exists(snapshot):
+            with SnapshotPack(snapshot) as pack:
+                for path in pack:
+                    if target is None:
+                        if not self.dry_run:
+                            self._materialize_dependent(index, time_stamp,
+                                                        path)
+                        continue
+                    # Packed versions become loose files of the retained
+                    # run.
+                    self._move(index, target, path, path, pack.path,
+                               lambda folder: pack.extract(path, folder))
+                    moved.append(path)
+                self._delete(pack.path)
+            self.info.forget_pack(time_stamp)
+        if target is not None:
+            # Files created by the expired run did not exist before it.
+            for path, kind in changes.items():
+                if kind == 'created' and not path.endswith('/'):
+                    self._replace(index, target, path)
+            self.logs[target] = ChangeLog.merge(changes, self.logs[target])
+        if not self.dry_run:
+            index.remove(time_stamp)
+            if target is not None:
+                index.add(target, moved)
+        for kind in self.LOG_KINDS:
+            path = os.path.join(self.info.log_dir,
+                                '{}.{}'.format(time_stamp, kind))
+            if os.path.isfile(path):
+                self._delete(path)
+
+    def _unpack(self):
+        """Remove the replaced versions from the packs of the retained
+        runs."""
+        for time_stamp, paths in self.unpacked.items():
+            SnapshotPack.remove(self._snapshot(time_stamp), paths)
+            self.info.forget_pack(time_stamp)
+
+    def _save_logs(self):
+        for time_stamp, entries in self.logs.items():
+            change_log = ChangeLog(self.info.log_dir, time_stamp)
+            for path in sorted(entries):
+                change_log.add(entries[path], path)
+            for kind in ChangeLog.KINDS:
+                final = change_log.path(kind, final=True)
+                if not change_log.counts[kind] and os.path.isfile(final):
+                    os.remove(final)
+            change_log.save()
+
+    def _remove_deletions(self):
+        for i, path in enumerate(self.deletions, 1):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            if self.pause and i % self.batch_size == 0:
+                sleep(self.pause)
+
+    def _freed_bytes(self, has_objects):
+        res = 0
+        for count, nlink, size in self.links.values():
+            # With a deduplicating store the object itself is one more link.
+            if count >= nlink - (1 if has_objects and nlink > 1 else 0):
+                res += size
+        return res
+
+    def run(self, now=None):
+        """Prune the backup.
+
+        * Return:
+
+            ``dict``;
+            number of runs, kept and expired runs, moved and deleted files
+            and the reclaimed bytes.
+        """
+        self.logger.debug(' - [run() called.]')
+        runs = self.runs()
+        keep = self.policy.select(runs, now) if runs else set()
+        self.stats.update(runs=len(runs), kept=len(keep),
+                          expired=len(runs) - len(keep))
+        if not self.stats['expired']:
+            return self.stats
+        if not VersionIndex.exists(self.info.log_dir) and not self.dry_run:
+            self.info.reindex()
+        expired = []
+        oldest = min(keep)
+        index = None if self.dry_run else VersionIndex(self.info.log_dir)
+        try:
+            target = None
+            for time_stamp in reversed(runs):
+                if time_stamp in keep:
+                    target = time_stamp
+                    continue
+                self._expire(index, time_stamp,
+                             target if time_stamp > oldest else None)
+                expired.append(time_stamp)
+        finally:
+            if index:
+                index.close()
+        has_objects = os.path.isdir(os.path.join(self.info.location,
+                                                 'objects'))
+        self.stats['bytes'] = self._freed_bytes(has_objects)
+        if self.dry_run:
+            return self.stats
+
+        self._save_logs()
+        self._unpack()
+        self._remove_deletions()
+        manifests = ManifestCache(self.info.log_dir, self.info.current_dir)
+        for time_stamp in chain(expired, self.logs):
+            manifests.remove(time_stamp)
+        for time_stamp in expired:
+            if os.path.isdir(self._snapshot(time_stamp)):
+                shutil.rmtree(self._snapshot(time_stamp))
+        if has_objects:
+            ObjectStore(self.info.location).gc()
+        self.logger.info(" -> {} run(s) expired.".format(len(expired)))
+        return self.stats
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import threading
+from time import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+BackupResult = namedtuple('BackupResult', 'name success error duration')
+
+
+class BackupScheduler:
+    """Run several ``RsyncBackup`` objects concurrently.
+
+    Backups are started in a worker pool as soon as a worker is free and
+    the devices of their source and destination have capacity left, so
+    disks are not thrashed by too many rsync processes at once.
+
+    * Parameters:
+
+        :backups:
+            ``list``;
+            ``RsyncBackup`` objects to run.
+
+        :workers:
+            ``int``;
+            maximum number of backups running at the same time.
+
+        :per_destination_device:
+            ``int``;
+            maximum number of backups writing to the same device.
+
+        :per_source_device:
+            ``int``;
+            maximum number of backups reading from the same device.
+    """
+
+    def __init__(self, backups, workers=4, per_destination_device=1,
+                 per_source_device=1):
+        self.logger = logging.getLogger("rhb.BackupScheduler")
+        self.backups = list(backups)
+        self.workers = max(1, workers)
+        self.limits = {'src': max(1, per_source_device),
+                       'dst': max(1, per_destination_device)}
+        self._busy = {}
+        self._running = 0
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _device(path):
+        """Returns the device id of ``path`` or its nearest existing parent."""
+        path = os.path.abspath(path)
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        return os.stat(path).st_dev
+
+    def _keys(self, backup):
+        return [('src', self._device(backup.source)),
+                ('dst', self._device(backup.destination))]
+
+    def _has_capacity(self, keys):
+        return all(self._busy.get(key, 0) < self.limits[key[0]]
+                   for key in keys)
+
+    def _acquire(self, keys):
+        self._running += 1
+        for key in keys:
+            self._busy[key] = self._busy.get(key, 0) + 1
+
+    def _release(self, keys):
+        with self._cond:
+            self._running -= 1
+            for key in keys:
+                self._busy[key] -= 1
+            self._cond.notify_all()
+
+    def _run_one(self, backup, keys):
+        start = time()
+        try:
+            backup.run_backup()
+            res = BackupResult(backup.name, True, None, time() - start)
+        except Exception as e:
+            self.logger.error("Backup '{}' failed: {}".format(backup.name, e))
+            res = BackupResult(backup.name, False, e, time() - start)
+        finally:
+            self._release(keys)
+        return res
+
+    def run(self):
+        """Run all backups.
+
+        * Return:
+
+            ``list`` of ``BackupResult`` tuples in the order of the backups.
+        """
+        self.logger.debug(' - [run() called.]')
+        pending = [(i, backup, self._keys(backup))
+                   for i, backup in enumerate(self.backups)]
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            with self._cond:
+                while pending:
+                    ready = [job for job in pending
+                             if self._has_capacity(job[2])]
+                    if self._running >= self.workers or not ready:
+                        self._cond.wait(timeout=1)
+                        continue
+                    i, backup, keys = ready[0]
+                    pending.remove(ready[0])
+                    self._acquire(keys)
+                    self.logger.info("Starting backup '{}'.".format(
+                        backup.name))
+                    futures[i] = pool.submit(self._run_one, backup, keys)
+        res = [futures[i].result() for i in range(len(self.backups))]
+        failed = [r.name for r in res if not r.success]
+        self.logger.info("{} of {} backup(s) succeeded.".format(
+            len(res) - len(failed), len(res)))
+        if failed:
+            self.logger.error("Failed: {}".format(', '.join(failed)))
+        return res
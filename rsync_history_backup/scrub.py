@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import sqlite3
+import logging
+from time import time, sleep
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from rsync_history_backup.dedup import ObjectStore
+
+
+def _hash(path, source_path=None):
+    """Returns the digests of ``path`` and ``source_path`` (``None`` if a
+    file can not be read). Runs in the worker processes of the scrub."""
+    res = []
+    for p in (path, source_path):
+        try:
+            res.append(ObjectStore.hash_file(p) if p else None)
+        except OSError:
+            res.append(None)
+    return tuple(res)
+
+
+class ChecksumIndex:
+    """Checksums of the files of a backup.
+
+    ``checksums.sqlite`` in the log directory maps the path of every file
+    (relative to the destination and the backup name, e.g.
+    ``current/docs/a.txt`` or ``history/<ts>/docs/a.txt``) to its size,
+    modification time, sha256 digest and the time the digest was last
+    verified.
+
+    * Parameters:
+
+        :log_dir:
+            ``string``;
+            path to the log directory of the backup.
+    """
+    FILE_NAME = 'checksums.sqlite'
+
+    def __init__(self, log_dir):
+        self.logger = logging.getLogger("rhb.ChecksumIndex")
+        self.path = os.path.join(log_dir, self.FILE_NAME)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (" +
+                        "path TEXT PRIMARY KEY, size INTEGER, " +
+                        "mtime INTEGER, digest TEXT, verified REAL) " +
+                        "WITHOUT ROWID")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def load(self):
+        """Returns a ``dict`` mapping the paths to ``(size, mtime, digest,
+        verified)``."""
+        return {row[0]: row[1:] for row in self.db.execute(
+            "SELECT path, size, mtime, digest, verified FROM files")}
+
+    def record(self, rows):
+        """Store ``(path, size, mtime, digest, verified)`` rows."""
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES " +
+                                "(?, ?, ?, ?, ?)", rows)
+
+    def remove(self, paths):
+        with self.db:
+            self.db.executemany("DELETE FROM files WHERE path = ?",
+                                ((path,) for path in paths))
+
+
+class Scrubber:
+    """Verifies the files of ``current`` and the history snapshots of a
+    backup against their recorded checksums.
+
+    Files are hashed in a process pool. Files without a checksum or whose
+    size or modification time changed are always hashed and recorded.
+    Additionally the ``fraction`` of the archive (in bytes) with the
+    oldest checksums is hashed again: a digest which differs although size
+    and modification time are unchanged means the file is corrupt. With
+    ``fraction=0.05`` every night, all files are verified within 20 days.
+    Checksums are recorded while the scrub runs, so an interrupted scrub
+    continues with the files it did not reach.
+
+    If the ``source`` directory is given, files of ``current`` whose
+    source file has the same modification time are compared with it, a
+    different size or digest is reported as a source mismatch.
+
+    * Parameters:
+
+        :backup_info:
+            ``BackupInfo``;
+            the backup to verify.
+
+        :source:
+            ``string``;
+            path to the source directory (``None`` to skip the comparison).
+
+        :fraction:
+            ``float``;
+            share of the archive to verify again (``1`` for all files).
+
+        :rate:
+            ``int``;
+            bytes per second to read at most (``None`` for no limit).
+
+        :workers:
+            ``int``;
+            number of hashing processes (default: number of cpus).
+    """
+    BATCH_SIZE = 1000
+
+    def __init__(self, backup_info, source=None, fraction=0.0, rate=None,
+                 workers=None):
+        self.logger = logging.getLogger("rhb.Scrubber")
+        self.info = backup_info
+        self.source = source
+        self.fraction = fraction
+        self.rate = rate
+        self.workers = workers or os.cpu_count() or 1
+        self.stats = {'files': 0, 'bytes': 0, 'hashed': 0,
+                      'hashed_bytes': 0, 'new': 0, 'corrupt': [],
+                      'source': [], 'unreadable': []}
+
+    def _walk(self, root, prefix):
+        """Yield ``(path, absolute path, size, mtime)`` of the regular
+        files below ``root``, ``path`` starts with ``prefix``."""
+        stack = [root]
+        while stack:
+            folder = stack.pop()
+            try:
+                entries = list(os.scandir(folder))
+            except OSError as e:
+                self.logger.warning("Cannot list '{}': {}".format(folder, e))
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    yield (prefix + os.path.relpath(entry.path, root),
+                           entry.path, st.st_size, st.st_mtime_ns)
+
+    def files(self):
+        """Yield the files of ``current`` and of all history snapshots
+        (packs and deltas as they are stored)."""
+        if os.path.isdir(self.info.current_dir):
+            yield from self._walk(self.info.current_dir, 'current/')
+        if os.path.isdir(self.info.history_dir):
+            for time_stamp in sorted(os.listdir(self.info.history_dir)):
+                yield from self._walk(
+                    os.path.join(self.info.history_dir, time_stamp),
+                    'history/{}/'.format(time_stamp))
+
+    def plan(self, files, known):
+        """Select the files to hash: new and changed files, then the
+        ``fraction`` of the archive with the oldest checksums."""
+        changed, unchanged = [], []
+        for item in files:
+            row = known.get(item[0])
+            if row is None or row[:2] != item[2:]:
+                changed.append(item)
+            else:
+                unchanged.append((row[3], item))
+        unchanged.sort(key=lambda x: x[0])
+        budget = self.fraction * self.stats['bytes']
+        res = changed
+        for _, item in unchanged:
+            if budget <= 0:
+                break
+            res.append(item)
+            budget -= max(item[2], 1)
+        return res
+
+    def _source_path(self, item):
+        """Returns the source file to compare ``item`` with or ``None``,
+        reports a size mismatch right away."""
+        path, _, size, mtime = item
+        if not self.source or not path.startswith('current/'):
+            return None
+        source_path = os.path.join(self.source, path[len('current/'):])
+        try:
+            st = os.lstat(source_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or \
+                st.st_mtime_ns // 10**9 != mtime // 10**9:
+            return None
+        if st.st_size != size:
+            self.stats['source'].append(path)
+            return None
+        return source_path
+
+    def _check(self, item, row, digest, source_digest):
+        """Compare the digests of ``item``, returns the row to record or
+        ``None``."""
+        path, abs_path, size, mtime = item
+        if digest is None:
+            if os.path.lexists(abs_path):
+                self.stats['unreadable'].append(path)
+            return None
+        self.stats['hashed'] += 1
+        self.stats['hashed_bytes'] += size
+        if source_digest is not None and source_digest != digest:
+            self.stats['source'].append(path)
+        if row is None or row[:2] != (size, mtime):
+            self.stats['new'] += 1
+        elif row[2] != digest:
+            # Keep the recorded digest, the file is reported until it is
+            # repaired.
+            self.stats['corrupt'].append(path)
+            return None
+        return path, size, mtime, digest, time()
+
+    def _throttle(self, start, read):
+        if self.rate:
+            delay = read / self.rate - (time() - start)
+            if delay > 0:
+                sleep(delay)
+
+    def run(self):
+        """Scrub the backup.
+
+        * Return:
+
+            ``dict``;
+            number and bytes of all files and of the hashed files, number
+            of new files and the ``list`` of corrupt, unreadable and source
+            mismatching paths.
+        """
+        self.logger.debug(' - [run() called.]')
+        with ChecksumIndex(self.info.log_dir) as index:
+            known = index.load()
+            files = list(self.files())
+            self.stats['files'] = len(files)
+            self.stats['bytes'] = sum(item[2] for item in files)
+            gone = set(known).difference(item[0] for item in files)
+            if gone:
+                index.remove(gone)
+            todo = self.plan(files, known)
+            self.logger.info("Hashing {} of {} file(s).".format(
+                len(todo), len(files)))
+
+            rows, pending = [], {}
+            start, read = time(), 0
+            queue = iter(todo)
+            try:
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    while True:
+                        for item in queue:
+                            self._throttle(start, read)
+                            read += item[2]
+                            future = pool.submit(_hash, item[1],
+                                                 self._source_path(item))
+                            pending[future] = item
+                            if len(pending) >= 2 * self.workers:
+                                break
+                        if not pending:
+                            break
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            item = pending.pop(future)
+                            row = self._check(item, known.get(item[0]),
+                                              *future.result())
+                            if row is not None:
+                                rows.append(row)
+                        if len(rows) >= self.BATCH_SIZE:
+                            index.record(rows)
+                            rows = []
+            finally:
+                # Keep the work of an interrupted scrub.
+                index.record(rows)
+        self.logger.info(" -> {} file(s) hashed.".format(self.stats['hashed']))
+        return self.stats
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+
+
+class ShardPlan:
+    """Split a backup into shards by the top-level entries of the source.
+
+    Every shard gets rsync filter rules which include only its top-level
+    entries, so several rsync processes can work on one source at the same
+    time. Entries which only exist in the destination are assigned to a
+    shard as well, so ``--delete`` still removes them. The user exclude
+    rules have to come first in the rsync options, as they do in
+    ``RsyncBackup.sync_options``.
+
+    * Parameters:
+
+        :source:
+            ``string``;
+            path to the source folder.
+
+        :current_dir:
+            ``string``;
+            path to the current folder of the backup.
+
+        :log_dir:
+            ``string``;
+            path to the log folder of the backup, used to store the weights.
+
+        :shards:
+            ``int``;
+            number of shards.
+
+        :shard_by:
+            ``string``;
+            ``'top'`` distributes the top-level entries evenly, ``'balanced'``
+            uses the number of files per entry known from previous runs.
+    """
+    WEIGHTS_FILE = 'shards.json'
+
+    def __init__(self, source, current_dir, log_dir, shards=1,
+                 shard_by='top'):
+        self.logger = logging.getLogger("rhb.ShardPlan")
+        if shard_by not in ('top', 'balanced'):
+            raise ValueError("Unknown shard mode '{}'.".format(shard_by))
+        self.source = source
+        self.current_dir = current_dir
+        self.log_dir = log_dir
+        self.shard_by = shard_by
+        self.mapping = {}
+        entries = set()
+        for path in (source, current_dir):
+            if os.path.isdir(path):
+                entries.update(os.listdir(path))
+        self.shards = max(1, min(shards, len(entries)))
+        weights = self.load_weights() if shard_by == 'balanced' else {}
+        self.weights = weights
+        load = [0] * self.shards
+        for entry in sorted(entries, key=lambda e: (-weights.get(e, 1), e)):
+            idx = load.index(min(load))
+            self.mapping[entry] = idx
+            load[idx] += max(1, weights.get(entry, 1))
+        self.logger.debug("{} shard(s), load: {}".format(self.shards, load))
+
+    def __len__(self):
+        return self.shards
+
+    @staticmethod
+    def _escape(name):
+        for char in '\\*?[':
+            name = name.replace(char, '\\' + char)
+        return name
+
+    @property
+    def filters(self):
+        """Returns a ``list`` with the rsync filter options of every shard."""
+        if self.shards == 1:
+            return [[]]
+        res = [[] for _ in range(self.shards)]
+        for entry, idx in sorted(self.mapping.items()):
+            name = self._escape(entry)
+            res[idx] += ['--include=/{}'.format(name),
+                         '--include=/{}/**'.format(name)]
+        return [opts + ['--exclude=/*'] for opts in res]
+
+    def shard_of(self, entry):
+        """Returns the shard index of the relative path ``entry``."""
+        return self.mapping.get(entry.split('/', 1)[0], 0)
+
+    @property
+    def weights_file(self):
+        return os.path.join(self.log_dir, self.WEIGHTS_FILE)
+
+    def load_weights(self):
+        """Returns the number of files per top-level entry.
+
+        The numbers are kept up to date by :meth:`update_weights`. If they
+        were never stored, they are computed once from all change logs.
+        """
+        if os.path.isfile(self.weights_file):
+            with open(self.weights_file, 'r') as fl:
+                return json.load(fl)
+        weights = {}
+        if not os.path.isdir(self.log_dir):
+            return weights
+        for fname in sorted(os.listdir(self.log_dir)):
+            kind = os.path.splitext(fname)[1]
+            if kind in ('.created', '.deleted'):
+                self._count(weights, self._read(fname),
+                            1 if kind == '.created' else -1)
+        return weights
+
+    def update_weights(self, change_log):
+        """Add the created and deleted entries of ``change_log``."""
+        if self.shard_by != 'balanced':
+            return
+        weights = self.weights
+        self._count(weights, change_log['created'], 1)
+        self._count(weights, change_log['deleted'], -1)
+        with open(self.weights_file, 'w') as fl:
+            json.dump(weights, fl)
+
+    @staticmethod
+    def _count(weights, entries, sign):
+        for entry in entries:
+            top = entry.split('/', 1)[0]
+            weights[top] = max(0, weights.get(top, 0) + sign)
+
+    def _read(self, fname):
+        with open(os.path.join(self.log_dir, fname), 'r', encoding='utf-8',
+                  errors='surrogateescape') as fl:
+            for line in fl:
+                line = line.rstrip('\n')
+                if line:
+                    yield line
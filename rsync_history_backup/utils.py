@@ -4,9 +4,12 @@ import sys
 import numbers
 import collections
 import logging
+from datetime import datetime
 if os.name == 'nt':       # Windows
     import ctypes
 
+TIME_FORMATS = (r'%Y-%m-%d %H-%M-%S.%f', r'%Y-%m-%d %H-%M-%S')
+
 
 class bcolors:
     HEADER = '\033[95m'
@@ -25,6 +28,30 @@ class bcolors:
         return text
 
 
+class LRUCache(collections.OrderedDict):
+    """``dict`` which drops the least recently used entries beyond
+    ``maxsize``, ``on_evict`` is called with every dropped value."""
+
+    def __init__(self, maxsize=1024, on_evict=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            _, evicted = self.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(evicted)
+
+
 class Helper:
 
     @staticmethod
@@ -37,6 +64,32 @@ class Helper:
         for i in range(len(units)):
             if size / 1024**i < 100:
                 return format_string % (float(size / (1024**i)), units[i])
+        return format_string % (float(size / 1024**(len(units) - 1)),
+                                units[-1])
+
+    @staticmethod
+    def parse_size(size):
+        """Returns the number of bytes of a size like ``'512'``, ``'20M'``
+        or ``'1.5G'`` (suffixes ``K``, ``M``, ``G``, ``T``)."""
+        size = str(size).strip().upper().rstrip('B')
+        units = ['', 'K', 'M', 'G', 'T']
+        unit = size[-1:] if size[-1:] in units[1:] else ''
+        try:
+            return int(float(size[:len(size) - len(unit)]) *
+                       1024**units.index(unit))
+        except ValueError:
+            raise ValueError("Invalid size '{}'.".format(size))
+
+    @staticmethod
+    def parse_time_stamp(time_stamp):
+        """Returns the ``datetime`` of a run time stamp, with
+        (``%Y-%m-%d %H-%M-%S.%f``) or without fractions of a second."""
+        for time_format in TIME_FORMATS:
+            try:
+                return datetime.strptime(time_stamp, time_format)
+            except ValueError:
+                pass
+        raise ValueError("Invalid time stamp '{}'.".format(time_stamp))
 
     @staticmethod
     def get_size(obj):
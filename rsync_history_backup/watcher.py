@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import errno
+import struct
+import ctypes
+import ctypes.util
+import select
+import logging
+from time import time
+try:
+    import fcntl
+except ImportError:       # Windows
+    fcntl = None
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | \
+    IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal ``ctypes`` wrapper of the linux inotify API."""
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise NotImplementedError("inotify is only available on linux.")
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self):
+        """Block until events are available and yield them as
+        ``(wd, mask, cookie, name)`` tuples."""
+        data = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            yield wd, mask, cookie, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChangeWatcher:
+    """Record the paths changed in a source folder between two backups.
+
+    The watcher appends the changed paths (relative to the source) to
+    ``dirty.list`` in the local settings folder and keeps its state in
+    ``watcher.json``. ``RsyncBackup`` claims the list with :meth:`claim`
+    and only scans these paths, as long as the watcher has been running
+    since the last backup and no events were lost.
+
+    * Parameters:
+
+        :source:
+            ``string``;
+            path to the source folder.
+
+        :settings_dir:
+            ``string``;
+            path to the local settings folder (``.rhb``) of the source.
+    """
+    DIRTY_FILE = 'dirty.list'
+    CLAIMED_FILE = 'dirty.claimed'
+    SCOPE_FILE = 'dirty.scope'
+    STATE_FILE = 'watcher.json'
+    LAST_SCAN_FILE = 'last_scan.json'
+    LOCK_FILE = 'dirty.lock'
+
+    def __init__(self, source, settings_dir):
+        self.logger = logging.getLogger("rhb.ChangeWatcher")
+        self.source = os.path.abspath(source)
+        self.settings_dir = os.path.abspath(settings_dir)
+        self.watches = {}
+        self.dirty = set()
+        self.inotify = None
+
+    # ------------------------- daemon ------------------------- #
+
+    def _write_state(self, **state):
+        path = os.path.join(self.settings_dir, self.STATE_FILE)
+        with open(path + '.tmp', 'w') as fl:
+            json.dump(state, fl)
+        os.replace(path + '.tmp', path)
+
+    def _overflow(self, reason):
+        self.logger.warning("Events lost ({}), the next backup will do a "
+                            "full scan.".format(reason))
+        self._write_state(pid=os.getpid(), started=self.started,
+                          overflow=True)
+
+    def _add_tree(self, path):
+        """Watch ``path`` and all directories below it."""
+        for root, dirs, _ in os.walk(path):
+            if os.path.abspath(root) == self.settings_dir:
+                dirs[:] = []
+                continue
+            try:
+                wd = self.inotify.add_watch(root)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    self._overflow("inotify watch limit reached")
+                    raise
+                continue    # vanished in the meantime
+            self.watches[wd] = os.path.relpath(root, self.source)
+            dirs[:] = [d for d in dirs
+                       if not os.path.islink(os.path.join(root, d))]
+
+    def _record(self, rel_path):
+        if rel_path.startswith('.rhb/') or rel_path == '.rhb':
+            return
+        self.dirty.add(rel_path)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self._overflow("event queue overflow")
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        if wd not in self.watches:
+            return
+        parent = self.watches[wd]
+        rel_path = os.path.normpath(os.path.join(parent, name)) if name \
+            else parent
+        if rel_path == '.':
+            return
+        if mask & IN_ISDIR:
+            self._record(rel_path + '/')
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(os.path.join(self.source, rel_path))
+        else:
+            self._record(rel_path)
+
+    def flush(self):
+        """Append the recorded paths to the dirty list."""
+        if not self.dirty:
+            return
+        with self._locked():
+            with open(os.path.join(self.settings_dir, self.DIRTY_FILE), 'a',
+                      encoding='utf-8', errors='surrogateescape') as fl:
+                for rel_path in sorted(self.dirty):
+                    fl.write(rel_path + '\n')
+        self.logger.debug("{} path(s) recorded.".format(len(self.dirty)))
+        self.dirty = set()
+
+    def run(self, flush_interval=1.0):
+        """Watch the source until interrupted."""
+        self.inotify = Inotify()
+        self.started = time()
+        self._write_state(pid=os.getpid(), started=self.started,
+                          overflow=False)
+        self.logger.info("Watching '{}'.".format(self.source))
+        self._add_tree(self.source)
+        self.logger.info(" -> {} directories watched.".format(
+            len(self.watches)))
+        last_flush = time()
+        try:
+            while True:
+                ready, _, _ = select.select([self.inotify.fd], [], [],
+                                            flush_interval)
+                if ready:
+                    for wd, mask, _, name in self.inotify.read():
+                        self._handle(wd, mask, name)
+                if not ready or time() - last_flush >= flush_interval:
+                    self.flush()
+                    last_flush = time()
+        except KeyboardInterrupt:
+            self.logger.info("Watcher stopped.")
+        finally:
+            self.flush()
+            self.inotify.close()
+            os.remove(os.path.join(self.settings_dir, self.STATE_FILE))
+
+    # ------------------------- backup ------------------------- #
+
+    def _locked(self):
+        return _FileLock(os.path.join(self.settings_dir, self.LOCK_FILE))
+
+    def _load(self, file_name):
+        path = os.path.join(self.settings_dir, file_name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r') as fl:
+            return json.load(fl)
+
+    def is_reliable(self):
+        """Check if the dirty list covers all changes since the last scan.
+
+        This is the case if the watcher process is alive, has not lost any
+        events and has been running since the last completed scan.
+        """
+        state = self._load(self.STATE_FILE)
+        last_scan = self._load(self.LAST_SCAN_FILE)
+        if not state or not last_scan or state.get('overflow'):
+            return False
+        try:
+            os.kill(state['pid'], 0)
+        except OSError as e:
+            if e.errno != errno.EPERM:
+                return False
+        return state['started'] <= last_scan['started']
+
+    def claim(self):
+        """Move the dirty list aside, so the watcher starts a new one.
+
+        Paths of a previously claimed list (of a failed backup) are kept.
+
+        * Return:
+
+            ``string``;
+            path to the claimed list.
+        """
+        dirty = os.path.join(self.settings_dir, self.DIRTY_FILE)
+        claimed = os.path.join(self.settings_dir, self.CLAIMED_FILE)
+        self.scan_started = time()
+        with self._locked():
+            if not os.path.isfile(dirty):
+                open(claimed, 'a').close()
+            elif not os.path.isfile(claimed):
+                os.replace(dirty, claimed)
+            else:
+                with open(claimed, 'ab') as out, open(dirty, 'rb') as fl:
+                    out.write(fl.read())
+                os.remove(dirty)
+        return claimed
+
+    def entries(self, current_dir):
+        """Returns the sorted, unique paths of the claimed list.
+
+        Directories which were deleted in the source are expanded with the
+        files of the backup below them, so their deletion is logged for
+        every file.
+        """
+        res = set()
+        path = os.path.join(self.settings_dir, self.CLAIMED_FILE)
+        with open(path, 'r', encoding='utf-8', errors='surrogateescape') as fl:
+            for line in fl:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                res.add(line.rstrip('/'))
+                if line.endswith('/') and not os.path.lexists(
+                        os.path.join(self.source, line)):
+                    backup_dir = os.path.join(current_dir, line)
+                    for root, dirs, files in os.walk(backup_dir):
+                        for name in dirs + files:
+                            res.add(os.path.relpath(os.path.join(root, name),
+                                                    current_dir))
+        return sorted(res)
+
+    def write_scope(self, current_dir):
+        """Write :meth:`entries` into a file for rsync's ``--files-from``.
+
+        * Return:
+
+            ``tuple`` of the file path and the number of entries.
+        """
+        entries = self.entries(current_dir)
+        path = os.path.join(self.settings_dir, self.SCOPE_FILE)
+        with open(path, 'w', encoding='utf-8', errors='surrogateescape') as fl:
+            for entry in entries:
+                fl.write(entry + '\n')
+        return path, len(entries)
+
+    def finish(self):
+        """Mark the claimed paths as backed up."""
+        for file_name in (self.CLAIMED_FILE, self.SCOPE_FILE):
+            path = os.path.join(self.settings_dir, file_name)
+            if os.path.isfile(path):
+                os.remove(path)
+        with open(os.path.join(self.settings_dir, self.LAST_SCAN_FILE),
+                  'w') as fl:
+            json.dump({'started': self.scan_started}, fl)
+
+
+class _FileLock:
+    """Exclusive ``flock`` on a lock file (no-op without ``fcntl``)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.fl = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self.fl, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl:
+            fcntl.flock(self.fl, fcntl.LOCK_UN)
+        self.fl.close()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from rsync_history_backup.basic import RsyncBackup
+
+
+class StripWalkOptionsTest(unittest.TestCase):
+    """Transfers with ``--files-from`` must neither recurse nor delete."""
+
+    def _strip(self, options):
+        return RsyncBackup._strip_walk_options(options)
+
+    def test_archive_clusters_do_not_recurse(self):
+        for cluster in ('-a', '-av', '-rlptgoD'):
+            options = self._strip([cluster, '--delete', '--update'])
+            self.assertEqual(options,
+                             [cluster, '--update', '--no-recursive'])
+
+    def test_recursion_is_turned_off_last(self):
+        options = self._strip(['--recursive', '--delete-excluded', '--times',
+                               '--exclude-from=rsync-ignore.txt', '-r'])
+        self.assertEqual(options, ['--recursive', '--times',
+                                   '--exclude-from=rsync-ignore.txt', '-r',
+                                   '--no-recursive'])
+
+    def test_default_sync_options(self):
+        rhb = RsyncBackup('/tmp/rhb-src', '/tmp/rhb-dst', name='test')
+        options = self._strip(rhb.sync_options)
+        self.assertFalse([opt for opt in options
+                          if opt.startswith('--delete')])
+        self.assertEqual(options[-1], '--no-recursive')
+        self.assertIn('--times', options)
+
+
+if __name__ == '__main__':
+    unittest.main()
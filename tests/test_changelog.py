@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from rsync_history_backup.changelog import ChangeLog, ChangeList
+
+TS = '2020-01-01 12-00-00.000000'
+OUTPUT = ['.d..t......|./|',
+          'cd+++++++++|dir/|',
+          '>f+++++++++|dir/new.txt|',
+          '>f.st......|old.txt|',
+          '*deleting  |gone.txt|',
+          '.d..t......|sub/|']
+
+
+class ChangeLogTest(unittest.TestCase):
+    """The dry run output is streamed into ``<ts>.<kind>`` files."""
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp(prefix='rhb-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def _files(self):
+        return sorted(os.listdir(self.log_dir))
+
+    def _parse(self, keep_raw=False):
+        change_log = ChangeLog(self.log_dir, TS, keep_raw=keep_raw)
+        kinds = [change_log.parse_line(line + '\n') for line in OUTPUT]
+        return change_log, kinds
+
+    def test_parse_line(self):
+        change_log, kinds = self._parse()
+        self.assertEqual(kinds, [None, 'created', 'created', 'changed',
+                                 'deleted', None])
+        change_log.save()
+        self.assertEqual(list(change_log['created']), ['dir/', 'dir/new.txt'])
+        self.assertEqual(list(change_log['changed']), ['old.txt'])
+        self.assertEqual(list(change_log['deleted']), ['gone.txt'])
+        self.assertEqual(len(change_log), 4)
+
+    def test_unclassified_lines_need_a_sync(self):
+        change_log = ChangeLog(self.log_dir, TS)
+        self.assertIsNone(change_log.parse_line('.d..t......|./|\n'))
+        self.assertFalse(change_log)
+        self.assertIsNone(change_log.parse_line('.d..t......|sub/|\n'))
+        self.assertTrue(change_log)
+        self.assertEqual(len(change_log), 0)
+
+    def test_save_publishes_the_parts(self):
+        change_log, _ = self._parse(keep_raw=True)
+        change_log.flush()
+        self.assertEqual(self._files(), [
+            TS + '.changed.part', TS + '.created.part',
+            TS + '.deleted.part', TS + '.dryrun.part'])
+        self.assertEqual(ChangeLog.runs(self.log_dir), [])
+        change_log.save()
+        self.assertEqual(self._files(), [
+            TS + '.changed', TS + '.created', TS + '.deleted',
+            TS + '.dryrun'])
+        self.assertEqual(ChangeLog.runs(self.log_dir), [TS])
+        with open(os.path.join(self.log_dir, TS + '.dryrun')) as fl:
+            self.assertEqual(fl.read().splitlines(), OUTPUT[1:])
+
+    def test_discard(self):
+        change_log, _ = self._parse()
+        change_log.discard()
+        self.assertEqual(self._files(), [])
+
+    def test_discard_after_save_keeps_the_logs(self):
+        change_log, _ = self._parse()
+        change_log.save()
+        change_log.discard()
+        self.assertEqual(len(self._files()), 3)
+
+    def test_recover_an_interrupted_save(self):
+        change_log, _ = self._parse()
+        change_log.close()
+        # Crashed after publishing the first file.
+        os.replace(change_log.path('created', final=False),
+                   change_log.path('created', final=True))
+        recovered = ChangeLog.recover(self.log_dir, TS)
+        self.assertTrue(recovered.saved)
+        self.assertEqual(recovered.counts,
+                         {'created': 2, 'deleted': 1, 'changed': 1})
+        self.assertEqual(list(recovered['deleted']), ['gone.txt'])
+        self.assertFalse([name for name in self._files()
+                          if name.endswith('.part')])
+
+    def test_recover_lost_logs(self):
+        self.assertFalse(ChangeLog.recover(self.log_dir, TS))
+
+    def test_discard_stray(self):
+        saved, other = '2019-01-01 12-00-00.000000', '2020-01-02 12-00-00'
+        for time_stamp in (saved, other, TS):
+            change_log = ChangeLog(self.log_dir, time_stamp)
+            change_log.add('created', 'x')
+            if time_stamp == saved:
+                change_log.save()
+            change_log.close()
+        # The parts of the journaled run are kept.
+        self.assertEqual(ChangeLog.discard_stray(self.log_dir, TS),
+                         [other + '.created.part'])
+        self.assertEqual(self._files(), [saved + '.created',
+                                         TS + '.created.part'])
+        ChangeLog.discard_stray(self.log_dir)
+        self.assertEqual(self._files(), [saved + '.created'])
+
+    def test_changes(self):
+        change_log, _ = self._parse()
+        change_log.save()
+        self.assertEqual(ChangeLog.changes(self.log_dir, TS, 'dir'),
+                         {'dir/': 'created', 'dir/new.txt': 'created'})
+        self.assertEqual(ChangeLog.changes(self.log_dir, TS)['gone.txt'],
+                         'deleted')
+
+
+class MergeTest(unittest.TestCase):
+    """Changes of two consecutive runs combined."""
+
+    def test_merge(self):
+        older = {'a': 'created', 'b': 'created', 'c': 'deleted',
+                 'd': 'changed', 'e': 'changed', 'f': 'deleted'}
+        newer = {'a': 'deleted', 'b': 'changed', 'c': 'created',
+                 'd': 'deleted', 'e': 'changed', 'g': 'created'}
+        self.assertEqual(ChangeLog.merge(older, newer),
+                         {'b': 'created', 'c': 'changed', 'd': 'deleted',
+                          'e': 'changed', 'f': 'deleted', 'g': 'created'})
+
+    def test_merge_keeps_its_arguments(self):
+        older = {'a': 'created'}
+        ChangeLog.merge(older, {'a': 'deleted'})
+        self.assertEqual(older, {'a': 'created'})
+
+
+class ChangeListTest(unittest.TestCase):
+
+    def test_missing_file_is_empty(self):
+        entries = ChangeList('/nonexistent/rhb/log.created')
+        self.assertEqual((len(entries), bool(entries), list(entries)),
+                         (0, False, []))
+
+    def test_reads_the_entries_back(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.created') as fl:
+            fl.write('a\n\nb c\n')
+            fl.flush()
+            entries = ChangeList(fl.name)
+            self.assertEqual((len(entries), list(entries)), (2, ['a', 'b c']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from rsync_history_backup.analyzer import BackupInfo
+
+TS1 = '2020-01-01 12-00-00.000000'
+TS2 = '2020-01-02 12-00-00.000000'
+
+
+class DiffTest(unittest.TestCase):
+    """A run id stands for the state after that run."""
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp(prefix='rhb-test-')
+        self.name = 'test'
+        # TS1 is the first run, TS2 changes a, deletes b and creates c.
+        self._log(TS1, 'created', 'a', 'b')
+        self._log(TS2, 'changed', 'a')
+        self._log(TS2, 'deleted', 'b')
+        self._log(TS2, 'created', 'c')
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def _log(self, time_stamp, kind, *entries):
+        path = os.path.join(self.location, 'log', self.name,
+                            '{}.{}'.format(time_stamp, kind))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fl:
+            fl.write(''.join(entry + '\n' for entry in entries))
+
+    def _diff(self, time_from, time_to):
+        with BackupInfo(self.location, self.name) as info:
+            return info.diff(time_from, time_to)
+
+    def test_consecutive_runs(self):
+        self.assertEqual(self._diff(TS1, TS2),
+                         {'created': ['c'], 'deleted': ['b'],
+                          'changed': ['a']})
+
+    def test_last_run_to_current(self):
+        self.assertEqual(self._diff(TS2, None),
+                         {'created': [], 'deleted': [], 'changed': []})
+        self.assertEqual(self._diff(TS1, None), self._diff(TS1, TS2))
+
+    def test_reversed(self):
+        self.assertEqual(self._diff(TS2, TS1),
+                         {'created': ['b'], 'deleted': ['c'],
+                          'changed': ['a']})
+
+    def test_prefix_is_state_before_its_runs(self):
+        # '2020-01-01' is the empty state before the first run.
+        self.assertEqual(self._diff('2020-01-01', TS1),
+                         {'created': ['a', 'b'], 'deleted': [],
+                          'changed': []})
+        self.assertEqual(self._diff('2020-01-02', None),
+                         self._diff(TS1, TS2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from rsync_history_backup.engine import ExcludeFilter, NativeSync
+
+
+class ExcludeFilterTest(unittest.TestCase):
+    """rsync pattern rules, especially bracket expressions."""
+
+    def _excluded(self, pattern, path):
+        return ExcludeFilter([(False, pattern)]).excluded(path)
+
+    def test_negation_only_when_leading(self):
+        self.assertTrue(self._excluded('[a!]', 'a'))
+        self.assertTrue(self._excluded('[a!]', '!'))
+        self.assertFalse(self._excluded('[a!]', 'b'))
+        self.assertFalse(self._excluded('[!a]', 'a'))
+        self.assertTrue(self._excluded('[!a]', 'b'))
+
+    def test_leading_bracket_is_literal(self):
+        self.assertTrue(self._excluded('[]a]', ']'))
+        self.assertTrue(self._excluded('[]a]', 'a'))
+        self.assertFalse(self._excluded('[!]a]', ']'))
+        self.assertTrue(self._excluded('[!]a]', 'b'))
+
+    def test_unclosed_brackets_are_literal(self):
+        for pattern in ('[]', '[!]', 'a[b'):
+            self.assertTrue(self._excluded(pattern, pattern))
+        self.assertFalse(self._excluded('[]', 'a'))
+        self.assertFalse(self._excluded('a[b', 'ab'))
+
+    def test_ranges(self):
+        self.assertTrue(self._excluded('*.[ch]', 'src/main.c'))
+        self.assertTrue(self._excluded('x[a-c]', 'xb'))
+        self.assertFalse(self._excluded('x[a-c]', 'xd'))
+
+
+class NativeSyncScanTest(unittest.TestCase):
+    """Scans of the native engine honour the filter rules."""
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp(prefix='rhb-test-')
+        self.source = os.path.join(self.location, 'src')
+        self.target = os.path.join(self.location, 'dst')
+        os.makedirs(self.target)
+        for path in ('keep/sub/a.txt', 'skip/sub/b.txt', 'top.txt'):
+            path = os.path.join(self.source, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def _scan(self, options, paths=None):
+        items, _ = NativeSync(self.source, self.target, options).scan(paths)
+        return [item[1] for item in items]
+
+    def test_short_options_recurse(self):
+        for options in (['-a'], ['-rt']):
+            self.assertIn('keep/sub/a.txt', self._scan(options))
+        self.assertEqual(self._scan(['-t']), ['top.txt'])
+
+    def test_scoped_scan_below_excluded_folder(self):
+        options = ['-a', '--exclude=skip/']
+        self.assertNotIn('skip/', self._scan(options))
+        self.assertEqual(self._scan(options, ['skip/sub']), [])
+        self.assertEqual(self._scan(options, ['keep/sub']),
+                         ['keep/sub/', 'keep/sub/a.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from rsync_history_backup.analyzer import BackupInfo
+from rsync_history_backup.delta import Delta
+from rsync_history_backup.pack import SnapshotPack
+from rsync_history_backup.restore import Restorer
+from rsync_history_backup.retention import RetentionPolicy, Pruner
+
+K1 = '2020-01-01 12-00-00.000000'
+E1 = '2020-01-02 08-00-00.000000'
+K2 = '2020-01-02 12-00-00.000000'
+AFTER_K1 = '2020-01-01 18-00-00'
+AFTER_K2 = '2020-01-02 18-00-00'
+MTIME = 1577880000
+
+
+class PackTest(unittest.TestCase):
+    """Packed history snapshots read and prune like loose ones."""
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp(prefix='rhb-test-')
+        self.name = 'test'
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def _path(self, folder, path=''):
+        return os.path.join(self.location, folder, self.name, path)
+
+    def _write(self, folder, path, content):
+        path = self._path(folder, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fl:
+            fl.write(content)
+        os.utime(path, (MTIME, MTIME))
+
+    def _log(self, time_stamp, kind, *entries):
+        self._write('log', '{}.{}'.format(time_stamp, kind),
+                    ''.join(entry + '\n' for entry in entries))
+
+    def _pack(self, time_stamp, *entries):
+        """Pack ``entries`` of a snapshot and remove the loose files."""
+        snapshot = self._path('history', time_stamp)
+        SnapshotPack.pack(snapshot, entries)
+        for entry in entries:
+            os.remove(os.path.join(snapshot, entry))
+
+    def _read(self, info, path, version):
+        with info.version_file(path, version) as fl:
+            with open(fl) as content:
+                return content.read(), os.stat(fl).st_mtime
+
+    def _restore(self, time_stamp):
+        output = tempfile.mkdtemp(prefix='rhb-test-', dir=self.location)
+        with BackupInfo(self.location, self.name) as info:
+            Restorer(info, time_stamp).restore('', output)
+        res = {}
+        for folder, _, files in os.walk(output):
+            for name in files:
+                path = os.path.join(folder, name)
+                with open(path) as fl:
+                    res[os.path.relpath(path, output)] = fl.read()
+        shutil.rmtree(output)
+        return res
+
+    def test_read_packed_versions(self):
+        self._log(K1, 'changed', 'docs/a.txt')
+        self._log(K1, 'deleted', 'b.txt')
+        self._write('history', K1 + '/docs/a.txt', 'a0')
+        self._write('history', K1 + '/b.txt', 'b0')
+        self._write('current', 'docs/a.txt', 'a1')
+        self._pack(K1, 'docs/a.txt', 'b.txt')
+        self.assertEqual(sorted(os.listdir(self._path('history', K1))),
+                         [SnapshotPack.FILE_NAME, 'docs'])
+
+        with BackupInfo(self.location, self.name) as info:
+            self.assertEqual(info.get_file_versions('docs/a.txt'), [K1])
+            self.assertEqual(self._read(info, 'docs/a.txt', K1),
+                             ('a0', MTIME))
+            self.assertEqual(self._read(info, 'docs/a.txt', None),
+                             ('a1', MTIME))
+            self.assertEqual(info.get_file_content('b.txt', K1), 'b0')
+            self.assertIsNone(info.packed('docs/a.txt', 'current'))
+        self.assertEqual(self._restore(K1),
+                         {'docs/a.txt': 'a0', 'b.txt': 'b0'})
+        self.assertEqual(self._restore(AFTER_K1), {'docs/a.txt': 'a1'})
+
+    @unittest.skipUnless(shutil.which('rsync'), "rsync is not installed")
+    def test_materialize_from_packed_base(self):
+        # The delta of E1 is applied to the copy packed into K2.
+        old = ''.join('line {}\n'.format(i) for i in range(5000))
+        new = old.replace('line 2500\n', 'changed\n')
+        self._write('history', E1 + '/f.txt', old)
+        self._write('history', K2 + '/f.txt', new)
+        self._write('current', 'f.txt', 'current\n')
+        Delta.encode(self._path('history', E1 + '/f.txt'),
+                     self._path('history', K2 + '/f.txt'), min_saving=0)
+        self.assertTrue(os.path.isfile(
+            self._path('history', E1 + '/f.txt' + Delta.SUFFIX)))
+        self._pack(K2, 'f.txt')
+        with BackupInfo(self.location, self.name) as info:
+            self.assertEqual(self._read(info, 'f.txt', E1)[0], old)
+            self.assertEqual(self._read(info, 'f.txt', K2)[0], new)
+
+    def test_prune_packed_runs(self):
+        # K1 creates f and g, E1 changes f and deletes g, K2 changes f.
+        self._log(K1, 'created', 'f', 'g')
+        self._log(E1, 'changed', 'f')
+        self._log(E1, 'deleted', 'g')
+        self._write('history', E1 + '/f', 'f0')
+        self._write('history', E1 + '/g', 'g0')
+        self._log(K2, 'changed', 'f')
+        self._write('history', K2 + '/f', 'f1')
+        self._write('current', 'f', 'f2')
+        self._pack(E1, 'f', 'g')
+        self._pack(K2, 'f')
+
+        expected = {'f': 'f0', 'g': 'g0'}
+        self.assertEqual(self._restore(AFTER_K1), expected)
+        with BackupInfo(self.location, self.name) as info:
+            # Keep the packs open in the cache while pruning.
+            self.assertEqual(self._read(info, 'f', K2)[0], 'f1')
+            stats = Pruner(info, RetentionPolicy({'daily': '*'})).run(
+                now=datetime(2020, 1, 3))
+            self.assertEqual(stats['expired'], 1)
+            # The copy of the expired run replaces the one of K2.
+            self.assertEqual(self._read(info, 'f', K2), ('f0', MTIME))
+            self.assertIsNone(info.packed('f', K2))
+        self.assertFalse(os.path.exists(self._path('history', E1)))
+        self.assertFalse(SnapshotPack.exists(self._path('history', K2)))
+        self.assertEqual(self._restore(AFTER_K1), expected)
+        self.assertEqual(self._restore(AFTER_K2), {'f': 'f2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
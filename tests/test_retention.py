@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from rsync_history_backup.analyzer import BackupInfo
+from rsync_history_backup.restore import Restorer
+from rsync_history_backup.retention import RetentionPolicy, Pruner
+
+K1 = '2020-01-01 12-00-00.000000'
+E1 = '2020-01-02 08-00-00.000000'
+E2 = '2020-01-02 10-00-00.000000'
+K2 = '2020-01-02 12-00-00.000000'
+AFTER_K1 = '2020-01-01 18-00-00'
+AFTER_K2 = '2020-01-02 18-00-00'
+
+
+class PrunerTest(unittest.TestCase):
+    """Pruning must not change the state a kept run restores to."""
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp(prefix='rhb-test-')
+        self.name = 'test'
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def _write(self, folder, path, content):
+        path = os.path.join(self.location, folder, self.name, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fl:
+            fl.write(content)
+
+    def _log(self, time_stamp, kind, *entries):
+        self._write('log', '{}.{}'.format(time_stamp, kind),
+                    ''.join(entry + '\n' for entry in entries))
+
+    def _restore(self, time_stamp):
+        with BackupInfo(self.location, self.name) as info:
+            restorer = Restorer(info, time_stamp)
+            res = {}
+            for path, version in restorer.plan(''):
+                with open(restorer.source(path, version)) as fl:
+                    res[path] = fl.read()
+            return res
+
+    def _prune(self):
+        with BackupInfo(self.location, self.name) as info:
+            return Pruner(info, RetentionPolicy({'daily': '*'})).run(
+                now=datetime(2020, 1, 3))
+
+    def test_expired_run_is_merged_into_next_kept_run(self):
+        # K1 creates f, g and h, E1 changes f, creates c and deletes h,
+        # K2 changes f and c.
+        self._log(K1, 'created', 'f', 'g', 'h')
+        self._log(E1, 'changed', 'f')
+        self._log(E1, 'created', 'c')
+        self._log(E1, 'deleted', 'h')
+        self._write('history', E1 + '/f', 'f0')
+        self._write('history', E1 + '/h', 'h0')
+        self._log(K2, 'changed', 'f', 'c')
+        self._write('history', K2 + '/f', 'f1')
+        self._write('history', K2 + '/c', 'c1')
+        self._write('current', 'f', 'f2')
+        self._write('current', 'g', 'g0')
+        self._write('current', 'c', 'c2')
+
+        expected = {'f': 'f0', 'g': 'g0', 'h': 'h0'}
+        self.assertEqual(self._restore(AFTER_K1), expected)
+        stats = self._prune()
+        self.assertEqual(stats['expired'], 1)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.location, 'history', self.name, E1)))
+        self.assertEqual(self._restore(AFTER_K1), expected)
+        self.assertEqual(self._restore(AFTER_K2),
+                         {'f': 'f2', 'g': 'g0', 'c': 'c2'})
+
+    def test_oldest_expired_version_wins(self):
+        self._log(K1, 'created', 'f')
+        self._log(E1, 'changed', 'f')
+        self._write('history', E1 + '/f', 'f0')
+        self._log(E2, 'changed', 'f')
+        self._write('history', E2 + '/f', 'f1')
+        self._log(K2, 'changed', 'f')
+        self._write('history', K2 + '/f', 'f2')
+        self._write('current', 'f', 'f3')
+
+        self.assertEqual(self._restore(AFTER_K1), {'f': 'f0'})
+        self.assertEqual(self._prune()['expired'], 2)
+        self.assertEqual(self._restore(AFTER_K1), {'f': 'f0'})
+        with open(os.path.join(self.location, 'log', self.name,
+                               K2 + '.changed')) as fl:
+            self.assertEqual(fl.read(), 'f\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
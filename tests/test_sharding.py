@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from rsync_history_backup.engine import ExcludeFilter
+from rsync_history_backup.sharding import ShardPlan
+
+SOURCE = ['top.txt', 'a[1].txt', 'star*', 'q?', 'back\\slash',
+          'docs/', 'docs/readme.md', 'docs/deep/', 'docs/deep/er/',
+          'docs/deep/er/file.txt', 'docs/top.txt',
+          'photos/', 'photos/2020/', 'photos/2020/img.jpg',
+          'empty/', 'x/', 'x/x/', 'x/x/x']
+
+
+class ShardPlanTest(unittest.TestCase):
+    """Every path of the source belongs to exactly one shard."""
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp(prefix='rhb-test-')
+        self.source = os.path.join(self.location, 'src')
+        self.current = os.path.join(self.location, 'current')
+        self.log_dir = os.path.join(self.location, 'log')
+        os.makedirs(self.source)
+        for path in SOURCE:
+            path = os.path.join(self.source, path)
+            if path.endswith('/'):
+                os.makedirs(path)
+            else:
+                open(path, 'w').close()
+        # Only in the destination, to be deleted.
+        os.makedirs(os.path.join(self.current, 'gone', 'sub'))
+        os.makedirs(self.log_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    @staticmethod
+    def _selected(rules, path):
+        """Check if rsync transfers ``path`` with the filter ``rules``:
+        neither the path nor one of its parent folders is excluded."""
+        parts = path.rstrip('/').split('/')
+        return not any(rules.excluded('/'.join(parts[:i + 1]),
+                                      i < len(parts) - 1 or
+                                      path.endswith('/'))
+                       for i in range(len(parts)))
+
+    def _check(self, plan):
+        rules = [ExcludeFilter.from_options(opts) for opts in plan.filters]
+        for path in SOURCE + ['gone/', 'gone/sub/']:
+            shards = [idx for idx, rule in enumerate(rules)
+                      if self._selected(rule, path)]
+            self.assertEqual(shards, [plan.shard_of(path)], path)
+
+    def test_every_path_in_one_shard(self):
+        for shards in (2, 3, 7):
+            plan = ShardPlan(self.source, self.current, self.log_dir, shards)
+            self.assertEqual(len(plan), shards)
+            self.assertEqual(len(set(plan.mapping.values())), shards)
+            self._check(plan)
+
+    def test_balanced(self):
+        with open(os.path.join(self.log_dir, ShardPlan.WEIGHTS_FILE),
+                  'w') as fl:
+            json.dump({'docs': 100, 'photos': 50}, fl)
+        plan = ShardPlan(self.source, self.current, self.log_dir, 3,
+                         'balanced')
+        self.assertNotEqual(plan.shard_of('docs/top.txt'),
+                            plan.shard_of('photos/2020/img.jpg'))
+        self._check(plan)
+
+    def test_single_shard(self):
+        plan = ShardPlan(self.source, self.current, self.log_dir, 1)
+        self.assertEqual(plan.filters, [[]])
+        self.assertEqual({plan.shard_of(path) for path in SOURCE}, {0})
+
+    def test_not_more_shards_than_entries(self):
+        plan = ShardPlan(os.path.join(self.source, 'x'),
+                         os.path.join(self.current, 'x'), self.log_dir, 4)
+        self.assertEqual(len(plan), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()